@@ -0,0 +1,98 @@
+"""Compares serial and pipelined `hwspec-get` round-trips over a pty loopback.
+
+A responder thread plays the device on the master side of the pty. Every
+command is answered `--rtt` seconds after it arrives (the USB/UART round-trip)
+and the device needs `--processing` seconds per command, so the serial path
+pays the round-trip for every command while a pipelined batch pays it once.
+
+    python -m benchmarks.bench_batch --rtt 0.004 --iterations 20
+"""
+import argparse
+import os
+import select
+import threading
+import time
+import tty
+from collections import deque
+
+import serial
+
+from pulse_jig.lib.jig_client import JigClient
+
+HWSPEC_KEYS = [
+    "serial",
+    "thing_type_name",
+    "thing_type_id",
+    "hw_revision",
+    "assembly_id",
+    "assembly_version",
+    "assembly_timestamp",
+    "manufacturer_name",
+    "manufacturer_id",
+    "iecex_cert",
+]
+
+
+def _respond(cmd: str) -> bytes:
+    if cmd.startswith("hwspec-get"):
+        return f"> {cmd}\r\n+OK\r\n0x01\r\n.\r\n".encode()
+    return f"> {cmd}\r\n+OK\r\n".encode()
+
+
+def _responder(fd: int, rtt: float, processing: float, stop: threading.Event):
+    pending = deque()
+    buf = b""
+    last_done = 0.0
+    while not stop.is_set():
+        wait = 0.05 if not pending else max(pending[0][0] - time.monotonic(), 0)
+        readable, _, _ = select.select([fd], [], [], wait)
+        if readable:
+            buf += os.read(fd, 4096)
+            while b"\r" in buf:
+                line, buf = buf.split(b"\r", 1)
+                due = max(time.monotonic() + rtt, last_done + processing)
+                last_done = due
+                pending.append((due, _respond(line.decode())))
+        while pending and pending[0][0] <= time.monotonic():
+            os.write(fd, pending.popleft()[1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rtt", type=float, default=0.004)
+    parser.add_argument("--processing", type=float, default=0.0005)
+    parser.add_argument("--iterations", type=int, default=20)
+    args = parser.parse_args()
+
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    stop = threading.Event()
+    thread = threading.Thread(target=_responder, args=(master, args.rtt, args.processing, stop), daemon=True)
+    thread.start()
+
+    port = serial.Serial(os.ttyname(slave), baudrate=115200)
+    client = JigClient(port)
+
+    start = time.perf_counter()
+    for _ in range(args.iterations):
+        for key in HWSPEC_KEYS:
+            client.hwspec_get(key)
+    serial_time = (time.perf_counter() - start) / args.iterations
+
+    start = time.perf_counter()
+    for _ in range(args.iterations):
+        client.hwspec_get_many(HWSPEC_KEYS)
+    batch_time = (time.perf_counter() - start) / args.iterations
+
+    stop.set()
+    thread.join()
+    port.close()
+
+    print(f"HWSpec.get ({len(HWSPEC_KEYS)} keys), rtt={args.rtt * 1000:.1f}ms")
+    print(f"  serial:    {serial_time * 1000:8.2f} ms/unit")
+    print(f"  pipelined: {batch_time * 1000:8.2f} ms/unit")
+    print(f"  saved:     {(serial_time - batch_time) * 1000:8.2f} ms/unit")
+
+
+if __name__ == "__main__":
+    main()
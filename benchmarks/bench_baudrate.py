@@ -0,0 +1,57 @@
+"""Compares the throughput of bulk output at the default and negotiated baud rates.
+
+The emulated device takes as long to send its output as a UART at its baud
+rate would, and each command only takes the default 3ms, so what's measured
+is the serial line rather than the firmware. Each rate runs verbose
+`test-port`s with `--samples` readings per port, plus a reset and boot header.
+
+    python -m benchmarks.bench_baudrate --samples 100 --iterations 3
+"""
+import argparse
+import time
+
+from pulse_jig.lib.emulator import EmulatorConfig, EmulatorTransport, FirmwareEmulator
+from pulse_jig.lib.jig_client import JigClient
+from pulse_jig.lib.transport import DEFAULT_BAUDRATE
+
+BAUDRATES = [DEFAULT_BAUDRATE, 460800, 921600]
+
+
+def _run(baudrate: int, samples: int, iterations: int):
+    config = EmulatorConfig(seed=1, latency={}, line_rate=True, samples=samples, boot_time=0)
+    port = EmulatorTransport(FirmwareEmulator(config))
+    client = JigClient(port)
+    if not client.negotiate_baudrate(baudrate):
+        raise RuntimeError(f"Couldn't switch to {baudrate} baud")
+    received = len(client.log)
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        client.test_port()
+    client.restore_baudrate()
+    port.reboot()
+    client.read_boot_header()
+    client.negotiate_baudrate(baudrate)
+    elapsed = time.perf_counter() - start
+    return elapsed, len(client.log) - received
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--samples", type=int, default=100, help="Readings per port in each test-port body")
+    parser.add_argument("--iterations", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"test-port -v x{args.iterations} ({args.samples} samples/port) and a reset")
+    baseline = None
+    for baudrate in BAUDRATES:
+        elapsed, received = _run(baudrate, args.samples, args.iterations)
+        baseline = baseline or elapsed
+        print(
+            f"  {baudrate:>7} baud: {elapsed:6.2f} s, {received / elapsed / 1024:6.1f} KiB/s, "
+            f"{baseline / elapsed:4.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""Throughput of the protocol parser against the previous readline-per-line
+approach on a multi-megabyte verbose test body written into a pty by a
+background thread.
+
+    python -m benchmarks.bench_parser --megabytes 4
+"""
+import argparse
+import os
+import threading
+import time
+import tty
+
+import serial
+
+from pulse_jig.lib.protocol import ProtocolParser, TokenKind
+
+
+def _verbose_body(size: int) -> bytes:
+    lines = []
+    total = 0
+    i = 0
+    while total < size:
+        line = f"port {i % 4 + 1} ch {i % 8}: adc=0.{i % 997:03d} min=0.400 PASS\r\n".encode()
+        lines.append(line)
+        total += len(line)
+        i += 1
+    return b"test-port -v 0x0f 1\r\n+OK\r\n" + b"".join(lines) + b"PASS\r\n.\r\n"
+
+
+def _readline_per_line(port) -> int:
+    # The pre-parser implementation of JigClient._readline / _parse_command_body
+    log = ""
+    lines = 0
+    port.timeout = 0.5
+    while True:
+        line = port.readline().decode("utf-8")
+        log += line
+        line = line.rstrip("\r\n")
+        if line == ".":
+            return lines
+        lines += 1
+
+
+def _parser(port) -> int:
+    parser = ProtocolParser(port)
+    parser.expect_response(has_body=True)
+    lines = 0
+    while True:
+        token = parser.next_token(0.5)
+        if token.kind == TokenKind.BODY_END:
+            return lines
+        lines += 1
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--megabytes", type=float, default=4)
+    args = parser.parse_args()
+
+    payload = _verbose_body(int(args.megabytes * 1024 * 1024))
+    for name, fn in [("readline", _readline_per_line), ("parser", _parser)]:
+        master, slave = os.openpty()
+        tty.setraw(slave)
+        port = serial.Serial(os.ttyname(slave))
+        writer = threading.Thread(target=os.write, args=(master, payload), daemon=True)
+        start = time.perf_counter()
+        writer.start()
+        lines = fn(port)
+        elapsed = time.perf_counter() - start
+        writer.join()
+        port.close()
+        os.close(master)
+        os.close(slave)
+        print(
+            f"{name:>9}: {len(payload) / elapsed / 1e6:7.2f} MB/s "
+            f"{elapsed / lines * 1e6:6.2f} us/line ({lines} lines)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,313 @@
+"""CPU cost of the protocol hot paths: `JigClient.send_command`,
+`_parse_command_body`, `read_boot_header`, `_is_response_successful` and
+`PulseManager.check_for_header`.
+
+Each case is driven from an in-memory transport so no jig is needed, with
+synthetic payloads from a tiny ack up to a multi-megabyte verbose body, and a
+recorded session (an emulator session by default, or `--recording` files from
+`app.recording_dir`). CPU time is measured on the calling thread, so time
+spent waiting on the port, eg. the 2s `read_boot_header` window, isn't counted.
+
+Results can be saved as a baseline, which later runs are compared against.
+Baselines are per machine, as a Pi and a laptop aren't comparable.
+
+    python -m benchmarks.bench_protocol --save-baseline
+    python -m benchmarks.bench_protocol --check --tolerance 0.2
+"""
+import argparse
+import json
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Callable, Dict, List, NamedTuple
+
+from benchmarks.bench_parser import _verbose_body
+from pulse_jig.lib.emulator import EmulatorConfig, EmulatorTransport, FirmwareEmulator
+from pulse_jig.lib.jig_client import BatchCommand, JigClient
+from pulse_jig.lib.pulse_manager import PulseManager
+from pulse_jig.lib.recording import MARK, READ, WRITE, Recording, RecordingTransport, ReplayTransport, read_recording
+from pulse_jig.lib.transport import LoopbackTransport
+
+BASELINE_DIR = Path(__file__).parent / "baselines"
+BODY_SIZES = [("1 line", 1), ("64KiB", 64 * 1024), ("1MiB", 1024 * 1024)]
+
+
+class Case(NamedTuple):
+    name: str
+    # Returns the argument for `run`, not timed
+    setup: Callable[[], object]
+    run: Callable[[object], object]
+    # Lines of device output handled per run
+    lines: int
+
+
+class Result(NamedTuple):
+    ops_per_sec: float
+    cpu_us: float
+    us_per_line: float
+    peak_kib: float
+
+
+def _ack_payload(cmd: str) -> bytes:
+    return f"> {cmd}\r\n+OK\r\n> ".encode()
+
+
+def _boot_header(log_size: int) -> bytes:
+    emulator = FirmwareEmulator(EmulatorConfig())
+    log = b"".join(f"boot: init {i % 64:02d} ok\r\n".encode() for i in range(log_size // 20))
+    return log + emulator.boot_header()
+
+
+def _client(payload: bytes, respond: bool) -> JigClient:
+    # Either answer every write with the payload, or have it waiting to be read
+    port = LoopbackTransport(lambda _: payload) if respond else LoopbackTransport(lambda _: b"")
+    if not respond:
+        port.feed(payload)
+    return JigClient(port, max_attempts=1)
+
+
+def _body_client(payload: bytes) -> JigClient:
+    client = _client(payload, respond=False)
+    client._parser.expect_response(True)
+    client._parse_command_echo("test-port -v 0x0f 1")
+    client._parse_command_ack()
+    return client
+
+
+def _header_port(payload: bytes) -> LoopbackTransport:
+    port = LoopbackTransport()
+    port.feed(payload)
+    return port
+
+
+def _record_emulator_session(directory: Path) -> Path:
+    port = RecordingTransport(EmulatorTransport(FirmwareEmulator(EmulatorConfig(speed=1e6, seed=1))), directory)
+    port.close()
+    port.open()
+    client = JigClient(port)
+    client.firmware_version()
+    client.test_self()
+    client.test_port()
+    client.hwspec_set_many({"serial": "W01-2-1234", "assembly_id": "16"})
+    client.hwspec_save("pulse")
+    client.hwspec_load("pulse")
+    client.hwspec_get_many(["serial", "assembly_id"])
+    client.probe_await_connect()
+    client.hwchunk_write_probe_and_verify(2500)
+    port.close()
+    [path] = directory.glob("*.pjsr")
+    return path
+
+
+def _commands_only(recording: Recording) -> Recording:
+    # Output that follows a note (a boot header after a reset) or comes before
+    # the first write wasn't caused by a command, so isn't replayable as one
+    chunks = []
+    in_command = False
+    for chunk in recording.chunks:
+        if chunk.kind == MARK:
+            in_command = False
+        elif chunk.kind == WRITE:
+            in_command = True
+            chunks.append(chunk)
+        elif in_command:
+            chunks.append(chunk)
+    return Recording(recording.started, chunks)
+
+
+def _recorded_batches(recording: Recording) -> List[List[BatchCommand]]:
+    # The recorded commands, with those written back to back (pipelined) kept
+    # together, as the recorded output only follows the last of them. Whether
+    # a command has a body is told from its response, found by its echo.
+    batches = []
+    previous = None
+    for chunk in recording.chunks:
+        if chunk.kind == WRITE:
+            cmds = [BatchCommand(cmd) for cmd in chunk.data.decode().split("\r") if cmd]
+            if previous == WRITE:
+                batches[-1] += cmds
+            else:
+                batches.append(cmds)
+        previous = chunk.kind
+
+    output = recording.data(READ)
+    cmds = [cmd for batch in batches for cmd in batch]
+    echoes = []
+    pos = 0
+    for cmd in cmds:
+        pos = output.find(cmd.cmd.encode() + b"\r\n", pos)
+        echoes.append(pos)
+    for cmd, start, end in zip(cmds, echoes, echoes[1:] + [len(output)]):
+        cmd.has_body = b"\r\n.\r\n" in output[start:end]
+    return batches
+
+
+def _replay(client: JigClient, batches: List[List[BatchCommand]]) -> None:
+    for batch in batches:
+        try:
+            if len(batch) == 1:
+                client.send_command(batch[0].cmd, batch[0].has_body)
+            else:
+                client.send_commands(batch)
+        except JigClient.CommandFailed:
+            pass
+
+
+def _cases(max_mb: float, recordings: List[Path]) -> List[Case]:
+    sizes = list(BODY_SIZES)
+    max_size = int(max_mb * 1024 * 1024)
+    if all(size != max_size for _, size in sizes):
+        sizes.append((f"{max_mb:g}MiB", max_size))
+    cases = []
+
+    ack = _ack_payload("hwspec-save pulse")
+    cases.append(
+        Case("send_command ack", lambda: _client(ack, True), lambda c: c.send_command("hwspec-save pulse", False), 2)
+    )
+    for label, size in sizes:
+        payload = _verbose_body(size)
+        lines = payload.count(b"\n")
+        cases.append(
+            Case(
+                f"send_command {label}",
+                lambda payload=payload: _client(payload, True),
+                lambda c: c.send_command("test-port -v 0x0f 1"),
+                lines,
+            )
+        )
+        cases.append(
+            Case(
+                f"_parse_command_body {label}",
+                lambda payload=payload: _body_client(payload),
+                lambda c: c._parse_command_body(2),
+                lines - 2,
+            )
+        )
+        body = "\n".join(payload.decode().split("\r\n")[2:-2])
+        cases.append(
+            Case(
+                f"_is_response_successful {label}",
+                lambda body=body: body,
+                JigClient._is_response_successful,
+                lines - 3,
+            )
+        )
+
+    # check_for_header doesn't use any of the manager's pins
+    manager = PulseManager.__new__(PulseManager)
+    for label, log_size in [("header", 0), ("header+64KiB log", 64 * 1024)]:
+        payload = _boot_header(log_size)
+        lines = payload.count(b"\n")
+        cases.append(
+            Case(
+                f"read_boot_header {label}",
+                lambda payload=payload: JigClient(_header_port(payload)),
+                lambda c: c.read_boot_header(),
+                lines,
+            )
+        )
+        cases.append(
+            Case(
+                f"check_for_header {label}",
+                lambda payload=payload: _header_port(payload),
+                lambda port: manager.check_for_header(port, timeout=2),
+                lines,
+            )
+        )
+
+    for path in recordings:
+        recording = _commands_only(read_recording(path))
+        batches = _recorded_batches(recording)
+        lines = recording.data(READ).count(b"\n")
+        cases.append(
+            Case(
+                f"replay {path.name}",
+                lambda recording=recording: JigClient(ReplayTransport(recording, speed=float("inf")), max_attempts=1),
+                lambda c, batches=batches: _replay(c, batches),
+                lines,
+            )
+        )
+    return cases
+
+
+def _measure(case: Case, min_time: float, min_runs: int) -> Result:
+    wall = 0.0
+    cpu = []
+    while len(cpu) < min_runs or wall < min_time:
+        arg = case.setup()
+        start_wall = time.perf_counter()
+        start_cpu = time.thread_time()
+        case.run(arg)
+        cpu.append(time.thread_time() - start_cpu)
+        wall += time.perf_counter() - start_wall
+
+    # Allocation is traced separately as tracing slows everything down
+    arg = case.setup()
+    tracemalloc.start()
+    case.run(arg)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # The fastest run is the least disturbed by the rest of the machine, so compares best
+    cpu_us = min(cpu) * 1e6
+    return Result(len(cpu) / wall, cpu_us, cpu_us / max(case.lines, 1), peak / 1024)
+
+
+def _change(result: Result, baseline: Dict[str, float]) -> float:
+    return result.cpu_us / baseline["cpu_us"] - 1
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--max-megabytes", type=float, default=4, help="size of the largest verbose body")
+    parser.add_argument("--recording", type=Path, action="append", default=[], help="a .pjsr session to replay")
+    parser.add_argument("--min-time", type=float, default=0.5, help="seconds to run each case for")
+    parser.add_argument("--min-runs", type=int, default=3)
+    parser.add_argument("--filter", default="", help="only run cases whose name contains this")
+    parser.add_argument("--baseline", type=Path, default=BASELINE_DIR / f"bench_protocol-{platform.machine()}.json")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--check", action="store_true", help="exit with 1 if a case regressed beyond --tolerance")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed increase in CPU time, eg. 0.2 for 20%%")
+    args = parser.parse_args()
+
+    if args.check and not args.baseline.exists():
+        # Nothing would be compared, so a regression would pass unnoticed
+        sys.exit(f"No baseline at {args.baseline} to check against, save one first with --save-baseline")
+    baseline = json.loads(args.baseline.read_text()) if args.baseline.exists() else {}
+    with tempfile.TemporaryDirectory() as directory:
+        recordings = args.recording or [_record_emulator_session(Path(directory))]
+        cases = [case for case in _cases(args.max_megabytes, recordings) if args.filter in case.name]
+
+        results = {}
+        regressions = []
+        print(f"{'case':<40} {'ops/s':>10} {'cpu us/op':>12} {'us/line':>8} {'peak KiB':>9} {'vs base':>8}")
+        for case in cases:
+            result = _measure(case, args.min_time, args.min_runs)
+            results[case.name] = result._asdict()
+            change = ""
+            if case.name in baseline:
+                delta = _change(result, baseline[case.name])
+                change = f"{delta:+.1%}"
+                if delta > args.tolerance:
+                    regressions.append(case.name)
+                    change += " !"
+            print(
+                f"{case.name:<40} {result.ops_per_sec:>10.1f} {result.cpu_us:>12.1f} "
+                f"{result.us_per_line:>8.3f} {result.peak_kib:>9.1f} {change:>8}"
+            )
+
+    if args.save_baseline:
+        args.baseline.parent.mkdir(parents=True, exist_ok=True)
+        args.baseline.write_text(json.dumps({**baseline, **results}, indent=2, sort_keys=True) + "\n")
+        print(f"Saved baseline to {args.baseline}")
+    if regressions:
+        print(f"Slower than the baseline by more than {args.tolerance:.0%}: {', '.join(regressions)}")
+        if args.check:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""Compares per-command round-trip latency of `JigClient` over each transport.
+
+The pyserial and raw fd backends talk to a responder thread that plays the
+device on the master side of a pty and answers each command as soon as it
+arrives, so the difference between them is the host-side overhead of the
+transport. The loopback backend answers in-process and is the floor.
+
+    python -m benchmarks.bench_transport --commands 500
+"""
+import argparse
+import os
+import select
+import statistics
+import threading
+import time
+import tty
+
+import serial
+
+from pulse_jig.lib.jig_client import JigClient
+from pulse_jig.lib.transport import LoopbackTransport, RawFdTransport
+
+
+def _respond(cmd: bytes) -> bytes:
+    cmd = cmd.strip()
+    return b"> " + cmd + b"\r\n+OK\r\n1.2.3\r\n.\r\n"
+
+
+def _responder(fd: int, stop: threading.Event):
+    buf = b""
+    while not stop.is_set():
+        readable, _, _ = select.select([fd], [], [], 0.05)
+        if readable:
+            buf += os.read(fd, 4096)
+            while b"\r" in buf:
+                line, buf = buf.split(b"\r", 1)
+                os.write(fd, _respond(line))
+
+
+def _measure(client: JigClient, commands: int):
+    # Warm up so the first command's setup isn't counted
+    for _ in range(10):
+        client.firmware_version()
+    latencies = []
+    for _ in range(commands):
+        start = time.perf_counter()
+        client.firmware_version()
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return statistics.mean(latencies), latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)]
+
+
+def _with_pty(open_port, commands: int):
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    stop = threading.Event()
+    thread = threading.Thread(target=_responder, args=(master, stop), daemon=True)
+    thread.start()
+    port = open_port(os.ttyname(slave))
+    try:
+        return _measure(JigClient(port), commands)
+    finally:
+        stop.set()
+        thread.join()
+        port.close()
+        os.close(master)
+        os.close(slave)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--commands", type=int, default=500)
+    args = parser.parse_args()
+
+    results = {
+        "pyserial": _with_pty(lambda path: serial.Serial(path, baudrate=115200), args.commands),
+        "rawfd": _with_pty(lambda path: RawFdTransport(path), args.commands),
+        "loopback": _measure(JigClient(LoopbackTransport(_respond)), args.commands),
+    }
+
+    print(f"firmware-version round-trip ({args.commands} commands)")
+    print(f"  {'backend':10} {'mean':>10} {'p50':>10} {'p99':>10}")
+    for name, (mean, p50, p99) in results.items():
+        print(f"  {name:10} {mean * 1e6:8.0f}us {p50 * 1e6:8.0f}us {p99 * 1e6:8.0f}us")
+
+
+if __name__ == "__main__":
+    main()
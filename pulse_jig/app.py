@@ -9,8 +9,10 @@ sys.path.append("..")
 from pulse_jig.config import settings
 from lib.jig_client import JigClient
 from lib.ui.jig_gui import JigGUI
+from lib.provisioner.common_states import is_local_device
 from lib.provisioner.provisioner import Provisioner
 from lib.registrar import Registrar
+from lib.mount import MountManager, find_block_device
 from lib.pulse_manager import PulseManager
 
 
@@ -25,7 +27,11 @@ def _configure_logging(debug):
 
 
 @click.command()
-@click.option("--dev", default=lambda: JigClient.find_device())
+@click.option(
+    "--dev",
+    default=lambda: JigClient.find_device(),
+    help="Serial device of the jig, or a rfc2217:// or socket:// URL of one served over the network",
+)
 @click.option("--reset-pin", default=6)
 @click.option("--pcb-sense-pin", default=5)
 @click.option("--xdot-volume", default="/media/pi/XDOT")
@@ -39,7 +45,20 @@ def main(dev: Optional[str], reset_pin: int, pcb_sense_pin: int, xdot_volume: st
     registrar = Registrar()
     registrar.network_check()
 
-    pulse_manager = PulseManager(reset_pin, pcb_sense_pin, xdot_volume)
+    mount_manager = None
+    if settings.app.xdot_mount and is_local_device(dev):
+        # The volume is found from the xDot's serial port at each flash, as it may come back under another node
+        mount_manager = MountManager(settings.app.xdot_mount_point, find_block_device, settings.app.xdot_mount_options)
+    elif settings.app.xdot_mount:
+        logging.warning(f"Not mounting the xDot's volume as {dev} isn't a serial port on this machine")
+    pulse_manager = PulseManager(
+        reset_pin,
+        pcb_sense_pin,
+        xdot_volume,
+        settings.app.mount_probe_write,
+        mount_manager,
+        settings.app.flash_verify_timeout,
+    )
     provisioner_factory = Provisioner.build_factory(registrar, pulse_manager, dev)
 
     app = JigGUI()
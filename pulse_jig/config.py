@@ -1,7 +1,12 @@
+import os
+
 from dynaconf import Dynaconf, Validator
 
 from lib.target import Target
 
+# Where state kept between runs lives, `run.sh` mounts it from the host so it outlives the container
+APP_DATA_DIR = os.path.join(os.environ.get("XDG_DATA_HOME") or os.path.expanduser("~/.local/share"), "pulse_jig")
+
 settings = Dynaconf(
     envvar_prefix="JIG",
     settings_files=["settings.yaml", ".secrets.yaml"],
@@ -32,6 +37,49 @@ settings = Dynaconf(
             when=Validator("app.target", is_in=[Target.PULSE_PHASE_2, Target.PULSE_PHASE_3]),
         ),
         Validator("app.test_port_min_threshold", default=0.4),
+        # Bytes of device transcript held in memory before spilling to a temp file
+        Validator("app.transcript_memory_limit", default=1024 * 1024),
+        # How the device's serial port is driven, see lib.transport.BACKENDS
+        Validator("app.serial_backend", default="serial", is_in=["serial", "rawfd"]),
+        # Seconds added to the device's echo/ack and body timeouts when it's a rfc2217:// or socket:// URL
+        Validator("app.network_latency", default=0.25),
+        # Directory to record every serial session to for replaying later, none to not record
+        Validator("app.recording_dir", default=""),
+        Validator("app.recording_keep", default=200),
+        # Learn command timeouts from observed durations, bounded by the hard-coded ones
+        Validator("app.adaptive_timeouts", default=True),
+        Validator("app.timeout_history_path", default=os.path.join(APP_DATA_DIR, "timeout_history.json")),
+        # Fixed timeouts in seconds per command name, eg. {"test-port": 30}
+        Validator("app.command_timeouts", default={}),
+        # Answer repeated reads, eg. `hwspec-get`, from the device session's cache until they're changed.
+        # Off as the provisioners don't currently repeat any reads
+        Validator("app.cache_reads", default=False),
+        # Submit the readings parsed from verbose test output with the provisioning record, once the API accepts them.
+        # Every test is then run verbose, whatever app.test_verbosity, so passing units have readings too
+        Validator("app.submit_measurements", default=False),
+        # Watch for xDots being plugged in rather than retrying to open the port every second
+        Validator("app.device_hotplug", default=True),
+        # Baud rate to switch the test firmware to for bulk output, eg. 921600, 0 to stay at 115200
+        Validator("app.fast_baudrate", default=0),
+        # Command that switches the firmware's baud rate, `{baudrate}` is replaced by the rate
+        Validator("app.baud_command", default="baud {baudrate}"),
+        # Whether tests are run verbose, see lib.verbosity.VERBOSITIES. Either one for every target
+        # or per target, eg. {"ta3k": "verbose", "default": "on_failure"}. With "on_failure" a failed
+        # test is run again verbose for its diagnostics only, the unit is FAILED even if that run passes
+        Validator("app.test_verbosity", default="on_failure"),
+        # Check the xDot's volume accepts a small write before copying firmware to it
+        Validator("app.mount_probe_write", default=False),
+        # Skip flashing firmware a unit is already running, going by the build in its boot header.
+        # Off as the firmware doesn't print its build yet, see lib.boot_header.BUILD_PREFIX
+        Validator("app.skip_current_firmware", default=False),
+        # Where the version and build each firmware image boots as is kept, by the image's SHA-256
+        Validator("app.firmware_versions_path", default=os.path.join(APP_DATA_DIR, "firmware_versions.json")),
+        # Mount the xDot's volume to flash firmware, rather than relying on it being automounted
+        Validator("app.xdot_mount", default=False),
+        Validator("app.xdot_mount_point", default="/mnt/xdot"),
+        Validator("app.xdot_mount_options", default="sync,noatime,flush"),
+        # Maximum seconds to wait for the xDot to reattach its volume after flashing, to check it succeeded
+        Validator("app.flash_verify_timeout", default=5),
         Validator(
             "device.minter_id",
             "device.thing_type_name",
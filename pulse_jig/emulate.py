@@ -0,0 +1,225 @@
+"""Runs a provisioner end-to-end against an emulated device, or a recorded
+session played back, without the GUI, jig hardware or API, and reports how
+long each unit took.
+
+    python emulate.py --target ta3k --units 5 --speed 20 --fail test-port:0.1
+    python emulate.py --target ta3k --units 1 --speed 10 --replay 20240101-120000-000001.pjsr
+"""
+import logging
+import statistics
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import List, Optional, Tuple, Union
+
+import click
+
+sys.path.append("..")
+
+from pulse_jig.config import settings
+from lib.boot_header import BootHeader
+from lib.cancel import CancelToken
+from lib.emulator import (
+    EmulatorConfig,
+    EmulatorTransport,
+    FirmwareEmulator,
+    PROD_FIRMWARE,
+    TEST_FIRMWARE,
+    register_emulator,
+)
+from lib.firmware_store import FirmwareImage
+from lib.provisioner.provisioner import Provisioner
+from lib.pulse_manager import PulseManager, _sleep
+from lib.registrar import NetworkStatus
+from lib.target import Target
+
+
+class StandInPulseManager(PulseManager):
+    """
+    Stands in for the jig's GPIOs and the xDot's mass storage, for a device
+    whose output is replayed. Resetting, flashing and removing the PCB only
+    take time.
+    """
+
+    def __init__(self, speed: float, flash_time: float = 8, removal_time: float = 2):
+        self._speed = speed
+        self._flash_time = flash_time
+        self._removal_time = removal_time
+
+    def reset_device(self, cancel: Optional[CancelToken] = None):
+        _sleep(0.4 / self._speed, cancel)
+
+    @property
+    def is_connected(self):
+        return True
+
+    def await_connection(self, cancel: Optional[CancelToken] = None):
+        pass
+
+    def await_removal(self, cancel: Optional[CancelToken] = None):
+        _sleep(self._removal_time / self._speed, cancel)
+
+    def on_removal(self, callback):
+        pass
+
+    def load_firmware(
+        self, firmware: Union[Path, FirmwareImage], cancel: Optional[CancelToken] = None, port: Optional[str] = None
+    ):
+        _sleep(self._flash_time / self._speed, cancel)
+
+
+class EmulatedPulseManager(StandInPulseManager):
+    """
+    Resetting or flashing reboots the emulated device, and removing the PCB
+    replaces it with a new one.
+    """
+
+    def __init__(self, port: EmulatorTransport, **kwargs):
+        super().__init__(port.emulator.config.speed, **kwargs)
+        self._port = port
+
+    def reset_device(self, cancel: Optional[CancelToken] = None):
+        self._port.reboot()
+        super().reset_device(cancel)
+
+    def await_removal(self, cancel: Optional[CancelToken] = None):
+        super().await_removal(cancel)
+        self._next_unit()
+
+    def load_firmware(
+        self, firmware: Union[Path, FirmwareImage], cancel: Optional[CancelToken] = None, port: Optional[str] = None
+    ):
+        path = firmware.path if isinstance(firmware, FirmwareImage) else firmware
+        output = TEST_FIRMWARE if str(path) == str(settings.app.test_firmware_path) else PROD_FIRMWARE
+        super().load_firmware(firmware, cancel, port)
+        self._port.reboot(output)
+
+    def check_for_header(self, port, timeout=None, continue_test=None, cancel=None) -> Optional[BootHeader]:
+        # Phase 2 and 3 wait for the operator to plug in a unit that's already been flashed
+        self._next_unit()
+        return super().check_for_header(port, timeout, continue_test, cancel)
+
+    def _next_unit(self):
+        self._port.emulator.new_unit()
+        self._port.reboot(TEST_FIRMWARE)
+
+
+class EmulatedRegistrar:
+    """Accepts every registration and provisioning record without calling the API."""
+
+    network_status = NetworkStatus.CONNECTED
+
+    def __init__(self):
+        self.records = []
+
+    def network_check(self):
+        pass
+
+    def wait_for_network(self, timeout=None, cancel=None) -> bool:
+        return True
+
+    def register_serial(self, hwspec, **kwargs) -> bool:
+        return True
+
+    def submit_provisioning_record(self, **kwargs) -> bool:
+        self.records.append(kwargs)
+        return True
+
+
+_RESULTS = (Provisioner.Status.PASSED, Provisioner.Status.FAILED, Provisioner.Status.RETRY)
+
+
+def _default_mode(provisioner: Provisioner):
+    # What the operator would pick in the mode window
+    for key, value in (settings.mode_vars or {}).items():
+        if key in provisioner.mode.__dict__:
+            setattr(provisioner.mode, key, value[0] if isinstance(value, list) else value)
+
+
+@click.command()
+@click.option("--target", default=lambda: settings.app.target, type=click.Choice([t.value for t in Target]))
+@click.option("--units", default=3, help="Number of units to provision")
+@click.option("--speed", default=1.0, help="How many times faster than real time the device runs")
+@click.option("--seed", type=int, default=None)
+@click.option("--fail", multiple=True, help="Failure rate of a command, eg. test-port:0.1")
+@click.option("--garble", default=0.0, help="Probability of a corrupted command echo")
+@click.option("--build", default="", help="Build printed in the firmware's boot header, see app.skip_current_firmware")
+@click.option("--replay", type=click.Path(exists=True), help="Play back a recorded session instead of emulating")
+@click.option("--debug", is_flag=True)
+def main(
+    target: str,
+    units: int,
+    speed: float,
+    seed: Optional[int],
+    fail: Tuple[str],
+    garble: float,
+    build: str,
+    replay: Optional[str],
+    debug: bool,
+):
+    logging.basicConfig(
+        level=logging.DEBUG if debug else logging.INFO,
+        format="[%(asctime)s] [%(levelname)-5s] [%(name)s.%(funcName)s:%(lineno)d] %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+    logging.getLogger("transitions").setLevel(logging.ERROR)
+
+    if replay:
+        # The operator's waits are skipped
+        dev = f"replay://{Path(replay).absolute()}?speed={speed}&max_gap=1"
+        pulse_manager = StandInPulseManager(speed)
+    else:
+        config = EmulatorConfig(
+            speed=speed,
+            seed=seed,
+            garble_rate=garble,
+            test_firmware_build=build,
+            prod_firmware_build=build,
+            provisioned=target in (Target.PULSE_PHASE_2, Target.PULSE_PHASE_3),
+        )
+        for item in fail:
+            cmd, rate = item.rsplit(":", 1)
+            config.failure_rates[cmd] = float(rate)
+        port = EmulatorTransport(FirmwareEmulator(config))
+        register_emulator("jig", port)
+        dev = "emulator://jig"
+        pulse_manager = EmulatedPulseManager(port)
+
+    registrar = EmulatedRegistrar()
+    provisioner = Provisioner.build_factory(registrar, pulse_manager, dev)(target)
+    _default_mode(provisioner)
+
+    results: List[Tuple[float, str]] = []
+    started = time.monotonic()
+    last_status = Provisioner.Status.UNKNOWN
+    done = threading.Event()
+
+    def listener(name: str, data: Provisioner.EventData):
+        nonlocal started, last_status
+        # A unit is finished once its status is promoted to a result
+        finished = data.status in _RESULTS and last_status not in _RESULTS
+        last_status = data.status
+        if finished:
+            now = time.monotonic()
+            results.append((now - started, data.status.name))
+            print(f"unit {len(results)}: {data.status.name} in {now - started:.1f}s")
+            started = now
+            if len(results) >= units:
+                done.set()
+
+    provisioner.add_listener(listener)
+    thread = threading.Thread(target=provisioner.run, daemon=True)
+    thread.start()
+    done.wait()
+    provisioner.terminate()
+    thread.join(5)
+
+    times = [t for t, _ in results]
+    passed = sum(1 for _, status in results if status == Provisioner.Status.PASSED.name)
+    print(f"{target}: {passed}/{len(results)} passed at {speed}x")
+    print(f"  cycle time mean {statistics.mean(times):.1f}s, min {min(times):.1f}s, max {max(times):.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable, Optional
+
+from .cancel import CancelToken
+from .jig_client import JigClient
+from .transcript import Transcript
+from .transport import Transport
+
+# Called directly rather than on the client's thread, they don't talk to the device
+_LOCAL_METHODS = frozenset(("reset_logs", "add_hook", "remove_hook", "invalidate_cache"))
+
+
+class AsyncJigClient:
+    """
+    asyncio version of `JigClient`. Commands are coroutines so they can be
+    cancelled or given a deadline with the usual asyncio tools, and a single
+    event loop can drive a client per device.
+
+    Every `JigClient` method is available as a coroutine, and behaves the
+    same: it's run by a `JigClient` on a thread of its own, so retries, the
+    read cache, verbosity, timeout policies and the exceptions raised (eg.
+    `JigClient.CommandTimeout`) are all shared with the synchronous client.
+
+    Commands on one client are serialised. If a command is cancelled part way
+    through its response, the rest of that response is discarded before the
+    next command is sent.
+
+    Each client has a thread of its own while it's open, so close it once
+    it's finished with, eg. by using it as an async context manager::
+
+        async with AsyncJigClient(port) as client:
+            await client.test_self()
+    """
+
+    def __init__(self, port: Transport, transcript: Optional[Transcript] = None, **options):
+        """
+        :param port: The device to communicate over.
+        :param transcript: Where to record communication. A default one is created if not given.
+        :param options: Passed on to `JigClient`, eg. `timeout_policy` or `cache_reads`.
+        """
+        self._client = JigClient(port, transcript, **options)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="async-jig-client")
+        # The token of the command that's running, if any
+        self._token: Optional[CancelToken] = None
+
+    @property
+    def client(self) -> JigClient:
+        """The synchronous client that runs the commands. Only use it while no command is running."""
+        return self._client
+
+    async def __aenter__(self) -> "AsyncJigClient":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.aclose()
+
+    async def aclose(self) -> None:
+        """Cancels any command in progress and waits for the client's thread to stop."""
+        self.close()
+        await asyncio.get_running_loop().run_in_executor(None, self._executor.shutdown)
+
+    def close(self) -> None:
+        """Cancels any command in progress and stops the client's thread once it's finished, without waiting."""
+        token = self._token
+        if token is not None:
+            token.cancel()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._client, name)
+        if name.startswith("_") or name in _LOCAL_METHODS or not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        async def command(*args, **kwargs):
+            return await self._run(functools.partial(attr, *args, **kwargs))
+
+        return command
+
+    @asynccontextmanager
+    async def external_port(self, port_number: int) -> AsyncIterator[None]:
+        """Async version of `JigClient.external_port`."""
+        context = self._client.external_port(port_number)
+        await self._run(context.__enter__)
+        try:
+            yield
+        except BaseException as e:
+            if not await self._run(functools.partial(context.__exit__, type(e), e, e.__traceback__)):
+                raise
+        else:
+            await self._run(functools.partial(context.__exit__, None, None, None))
+
+    async def _run(self, call: Callable):
+        # Each call gets its own token, so cancelling the coroutine cancels just that call
+        token = CancelToken()
+
+        def run():
+            self._client.cancel_token = self._token = token
+            try:
+                return call()
+            finally:
+                self._token = None
+
+        future = asyncio.get_running_loop().run_in_executor(self._executor, run)
+        try:
+            return await future
+        except asyncio.CancelledError:
+            token.cancel()
+            raise
@@ -0,0 +1,132 @@
+import enum
+from dataclasses import dataclass
+from typing import Callable, List, Optional
+
+from .protocol import PROMPT_TEXT, Token, TokenKind
+from .timeout import Timeout, TimeoutNever
+
+TEST_FIRMWARE_TITLE = "Starting Functional Tests Firmware"
+PROD_FIRMWARE_TITLE = "Starting Production Firmware"
+VERSION_PREFIX = "Firmware Version:"
+BUILD_PREFIX = "Firmware Build:"
+
+
+class FirmwareKind(enum.Enum):
+    TEST = enum.auto()
+    PRODUCTION = enum.auto()
+    UNKNOWN = enum.auto()
+
+
+@dataclass
+class BootHeader:
+    """The header the firmware prints when it boots, eg.
+
+    ==============================================================
+    Starting Functional Tests Firmware
+    Firmware Version: 1.2.3
+    Firmware Build: 5f2c1e9
+    ==============================================================
+    >
+
+    The build line is optional.
+    """
+
+    kind: FirmwareKind
+    version: str
+    # The header's lines, separators included, and the prompt if it followed
+    text: str
+    # Whether the test shell's prompt followed the header
+    prompt: bool = False
+    # Identifies the exact build, eg. its commit, unlike the version. Empty if the firmware doesn't print it
+    build: str = ""
+
+    def __str__(self) -> str:
+        return self.text
+
+
+class BootHeaderRecognizer:
+    """
+    Builds a `BootHeader` from protocol tokens as they're parsed, so the
+    caller can stop reading as soon as it's complete rather than waiting out
+    a fixed time. Anything before the opening separator is ignored.
+
+    :param with_prompt: Whether the test firmware's header is only complete once
+                        its prompt has followed. The production firmware has no prompt.
+    """
+
+    def __init__(self, with_prompt: bool = True):
+        self._with_prompt = with_prompt
+        self._lines: List[str] = []
+        self._separators = 0
+        self._kind = FirmwareKind.UNKNOWN
+        self._version = ""
+        self._build = ""
+        self._prompt = False
+
+    @property
+    def closed(self) -> bool:
+        """Whether the closing separator has been seen, even if the prompt hasn't followed yet."""
+        return self._separators >= 2
+
+    @property
+    def complete(self) -> bool:
+        if not self.closed:
+            return False
+        return self._prompt or not self._with_prompt or self._kind != FirmwareKind.TEST
+
+    def feed(self, token: Token) -> bool:
+        """Adds the next token, returning whether the header is now complete."""
+        if self.complete:
+            return True
+        if token.kind == TokenKind.HEADER_SEPARATOR:
+            if self.closed:
+                # Another boot started before the prompt, eg. a second reset
+                self.__init__(self._with_prompt)
+            self._separators += 1
+            self._lines.append(token.text)
+        elif token.kind == TokenKind.HEADER and self._separators == 1:
+            self._lines.append(token.text)
+            if token.text.startswith(TEST_FIRMWARE_TITLE):
+                self._kind = FirmwareKind.TEST
+            elif token.text.startswith(PROD_FIRMWARE_TITLE):
+                self._kind = FirmwareKind.PRODUCTION
+            elif token.text.startswith(VERSION_PREFIX):
+                self._version = token.text[len(VERSION_PREFIX) :].strip()
+            elif token.text.startswith(BUILD_PREFIX):
+                self._build = token.text[len(BUILD_PREFIX) :].strip()
+        elif token.kind == TokenKind.PROMPT and self.closed:
+            self._prompt = True
+            self._lines.append(PROMPT_TEXT)
+        return self.complete
+
+    @property
+    def header(self) -> Optional[BootHeader]:
+        """The header so far, once its closing separator has been seen."""
+        if not self.closed:
+            return None
+        return BootHeader(self._kind, self._version, "\n".join(self._lines).strip(), self._prompt, self._build)
+
+
+def await_boot_header(
+    next_token: Callable[[Optional[float]], Optional[Token]],
+    timeout: Optional[float],
+    with_prompt: bool = True,
+    keep_waiting: Optional[Callable[[], bool]] = None,
+    poll_interval: float = 0.2,
+) -> Optional[BootHeader]:
+    """Reads tokens until a boot header is complete, see `BootHeaderRecognizer`.
+
+    :param next_token: Returns the next token within the given seconds, or None, eg. `ProtocolParser.next_token`.
+    :param timeout: Maximum seconds to wait. None to wait indefinitely.
+    :param keep_waiting: Checked at least every `poll_interval` seconds, stop waiting once it returns False.
+    :return: The header, which may be missing its prompt if it didn't arrive in time. None if there wasn't one.
+    """
+    recognizer = BootHeaderRecognizer(with_prompt)
+    timer = Timeout(timeout) if timeout is not None else TimeoutNever()
+    while not timer.expired and (keep_waiting is None or keep_waiting()):
+        remaining = timer.remaining
+        wait = poll_interval if remaining is None else min(poll_interval, remaining)
+        token = next_token(wait if keep_waiting is not None else remaining)
+        if token is not None and recognizer.feed(token):
+            break
+    return recognizer.header
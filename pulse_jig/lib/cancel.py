@@ -0,0 +1,65 @@
+import threading
+import weakref
+from typing import Optional
+
+
+class Cancelled(Exception):
+    """Raised by a blocking operation when its cancel token has been cancelled."""
+
+    def __init__(self, msg: str = "Operation cancelled"):
+        super().__init__(msg)
+        self.msg = msg
+
+
+class CancelToken:
+    """
+    Thread safe cancellation flag that blocking reads, sleeps and waits check
+    so they can be aborted from another thread (eg. the GUI or a gpiozero
+    callback).
+
+    Tokens form a tree: cancelling a token also cancels all of its children,
+    but a child can be cancelled on its own. A provisioner holds one token for
+    its lifetime and a child per device session.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._children: "weakref.WeakSet[CancelToken]" = weakref.WeakSet()
+        self._lock = threading.Lock()
+
+    def child(self) -> "CancelToken":
+        """Creates a token that is cancelled along with this one."""
+        token = CancelToken()
+        with self._lock:
+            self._children.add(token)
+            if self._event.is_set():
+                token.cancel()
+        return token
+
+    def cancel(self) -> None:
+        with self._lock:
+            self._event.set()
+            children = list(self._children)
+        for child in children:
+            child.cancel()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def raise_if_cancelled(self) -> None:
+        if self._event.is_set():
+            raise Cancelled()
+
+    def wait(self, timeout: Optional[float]) -> bool:
+        """Sleeps for up to `timeout` seconds, returning early if cancelled.
+
+        :param timeout: Seconds to sleep for. None to sleep until cancelled.
+        :return: True if the token was cancelled.
+        """
+        return self._event.wait(timeout)
+
+    def sleep(self, seconds: float) -> None:
+        """Sleeps for the given seconds, raising `Cancelled` as soon as the token is cancelled."""
+        if self._event.wait(seconds):
+            raise Cancelled()
@@ -0,0 +1,160 @@
+import bisect
+import threading
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from .timeout_policy import command_key
+
+OUTCOME_OK = "ok"
+OUTCOME_ERROR = "error"
+OUTCOME_ABORTED = "aborted"
+OUTCOME_TIMEOUT = "timeout"
+OUTCOME_PROTOCOL_ERROR = "protocol_error"
+OUTCOME_CANCELLED = "cancelled"
+OUTCOMES = (OUTCOME_OK, OUTCOME_ERROR, OUTCOME_ABORTED, OUTCOME_TIMEOUT, OUTCOME_PROTOCOL_ERROR, OUTCOME_CANCELLED)
+
+
+@dataclass
+class CommandEvent:
+    """
+    Passed to `CommandHook`s for each command sent by a `JigClient`. Only
+    `command`, `params`, `start` and `bytes_out` are set for `before`.
+    """
+
+    # Command name, eg. `hwspec-get`, and the rest of the command line
+    command: str
+    params: str
+    start: float
+    bytes_out: int
+    bytes_in: Optional[int] = None
+    # Seconds from the command being written to its ack
+    ack_latency: Optional[float] = None
+    # Seconds from the ack to the end of the body
+    body_latency: Optional[float] = None
+    # One of the OUTCOME_* constants
+    outcome: Optional[str] = None
+
+    @property
+    def duration(self) -> Optional[float]:
+        if self.ack_latency is None:
+            return None
+        return self.ack_latency + (self.body_latency or 0)
+
+
+class CommandHook:
+    """
+    Base class for instrumentation registered with `JigClient.add_hook`. The
+    callbacks run on the thread talking to the device, so should be quick.
+    """
+
+    def before(self, event: CommandEvent) -> None:
+        """Called just before a command is written to the device."""
+
+    def after(self, event: CommandEvent) -> None:
+        """Called once a command has finished, however it finished."""
+
+
+class LatencyHistogram:
+    """Counts of latencies in fixed, roughly logarithmic, buckets."""
+
+    # Upper bounds of each bucket in seconds. Anything above the last goes in an overflow bucket.
+    BOUNDS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, latency: float) -> None:
+        self.counts[bisect.bisect_left(self.BOUNDS, latency)] += 1
+        self.count += 1
+        self.total += latency
+        self.max = max(self.max, latency)
+
+    def percentile(self, p: float) -> Optional[float]:
+        """Returns the upper bound of the bucket the given percentile (0-1) falls in."""
+        if not self.count:
+            return None
+        target = p * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= target and count:
+                return self.BOUNDS[i] if i < len(self.BOUNDS) else self.max
+        return self.max
+
+    def summary(self) -> Dict[str, float]:
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "p50": self.percentile(0.5) or 0.0,
+            "p95": self.percentile(0.95) or 0.0,
+            "max": self.max,
+        }
+
+
+class LatencyHistogramHook(CommandHook):
+    """Aggregates the total, ack and body latency of each command by name."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.total: Dict[str, LatencyHistogram] = {}
+            self.ack: Dict[str, LatencyHistogram] = {}
+            self.body: Dict[str, LatencyHistogram] = {}
+            self.outcomes: Dict[str, Dict[str, int]] = {}
+            self.bytes_in = 0
+            self.bytes_out = 0
+
+    def after(self, event: CommandEvent) -> None:
+        with self._lock:
+            outcomes = self.outcomes.setdefault(event.command, {})
+            outcomes[event.outcome] = outcomes.get(event.outcome, 0) + 1
+            self.bytes_out += event.bytes_out
+            self.bytes_in += event.bytes_in or 0
+            if event.ack_latency is not None:
+                self.ack.setdefault(event.command, LatencyHistogram()).add(event.ack_latency)
+            if event.body_latency is not None:
+                self.body.setdefault(event.command, LatencyHistogram()).add(event.body_latency)
+            if event.outcome == OUTCOME_OK:
+                self.total.setdefault(event.command, LatencyHistogram()).add(event.duration)
+
+    def commands(self) -> List[str]:
+        with self._lock:
+            return sorted(self.outcomes)
+
+    def percentile(self, cmd: str, p: float) -> Optional[float]:
+        """Returns the given percentile (0-1) of the total latency of successful runs of a command."""
+        with self._lock:
+            histogram = self.total.get(command_key(cmd))
+            return histogram.percentile(p) if histogram is not None else None
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """Total latency statistics of successful runs and a count of each outcome, per command."""
+        with self._lock:
+            summary = {}
+            for cmd, outcomes in self.outcomes.items():
+                histogram = self.total.get(cmd)
+                stats = histogram.summary() if histogram is not None else {"count": 0}
+                summary[cmd] = {**stats, **outcomes}
+            return summary
+
+    def format(self) -> str:
+        """One line per command, for logging."""
+        summary = self.summary()
+        lines = []
+        for cmd in sorted(summary):
+            stats = summary[cmd]
+            line = f"{cmd}: n={stats['count']}"
+            if stats["count"]:
+                line += (
+                    f" mean={stats['mean'] * 1000:.0f}ms p50<={stats['p50'] * 1000:.0f}ms"
+                    f" p95<={stats['p95'] * 1000:.0f}ms max={stats['max'] * 1000:.0f}ms"
+                )
+            line += "".join(f" {outcome}={stats[outcome]}" for outcome in OUTCOMES[1:] if outcome in stats)
+            lines.append(line)
+        return "\n".join(lines)
@@ -0,0 +1,267 @@
+import ctypes
+import ctypes.util
+import enum
+import logging
+import os
+import select
+import struct
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional
+
+from .cancel import CancelToken
+
+logger = logging.getLogger("device_registry")
+
+# USB IDs of the xDot developer board
+XDOT_VID = 0x0D28
+XDOT_PID = 0x0204
+
+# From linux/inotify.h
+_IN_ATTRIB = 0x00000004
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_Q_OVERFLOW = 0x00004000
+_IN_MASK = _IN_ATTRIB | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE
+_EVENT = struct.Struct("iIII")
+
+# Device nodes in /dev that can be a USB serial port
+_TTY_PREFIX = "tty"
+
+
+class Device(NamedTuple):
+    # Device node, eg. /dev/ttyACM0
+    path: str
+    # The USB serial number, which survives the device being re-enumerated under a different node
+    serial_number: Optional[str]
+    # The USB device's directory in sysfs, eg. /sys/devices/platform/.../usb1/1-1/1-1.2
+    sysfs_path: Optional[str]
+    # The USB port it's plugged into, eg. 1-1.2
+    location: Optional[str]
+
+    def matches(self, identity: str) -> bool:
+        """Whether the identity is the device's serial number, node, sysfs path or USB location."""
+        return identity in (self.serial_number, self.path, self.sysfs_path, self.location)
+
+
+class DeviceEvent(enum.Enum):
+    ADDED = enum.auto()
+    REMOVED = enum.auto()
+
+
+def list_devices(vid: int = XDOT_VID, pid: int = XDOT_PID) -> List[Device]:
+    """Every attached USB serial device with the given IDs, sorted by node."""
+    from serial.tools.list_ports_posix import comports
+
+    return _to_devices(comports(), vid, pid)
+
+
+def _to_devices(ports: Iterable, vid: int, pid: int) -> List[Device]:
+    devices = [
+        Device(p.device, p.serial_number, getattr(p, "usb_device_path", None), p.location)
+        for p in ports
+        if p.vid == vid and p.pid == pid
+    ]
+    return sorted(devices, key=lambda device: device.path)
+
+
+class _Inotify:
+    """Watches a directory for entries being created, removed or changed, eg. udev setting a node's permissions."""
+
+    def __init__(self, path: str):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(fd, os.fsencode(path), _IN_MASK) < 0:
+            errno = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(errno, f"could not watch {path}")
+        self._fd = fd
+
+    def fileno(self) -> int:
+        return self._fd
+
+    def read_names(self) -> Optional[List[str]]:
+        """Names of the entries changed since the last read, or None if events were dropped."""
+        names: List[str] = []
+        while True:
+            try:
+                data = os.read(self._fd, 4096)
+            except BlockingIOError:
+                return names
+            offset = 0
+            while offset < len(data):
+                _, mask, _, length = _EVENT.unpack_from(data, offset)
+                offset += _EVENT.size
+                if mask & _IN_Q_OVERFLOW:
+                    return None
+                names.append(os.fsdecode(data[offset : offset + length].rstrip(b"\0")))
+                offset += length
+
+    def close(self) -> None:
+        os.close(self._fd)
+
+
+class DeviceRegistry:
+    """
+    Keeps track of every attached xDot from a background thread, so a
+    provisioner can wait for a particular one to (re)appear rather than
+    retrying to open its port on a timer.
+
+    The attached devices are rescanned whenever a tty node in `watch_dir` is
+    created, removed or changed, which is watched with inotify. Where inotify
+    isn't available they're rescanned every `poll_interval` seconds instead.
+
+    :param scan: Returns the attached devices, defaults to `list_devices`.
+    """
+
+    def __init__(
+        self,
+        scan: Optional[Callable[[], List[Device]]] = None,
+        watch_dir: str = "/dev",
+        poll_interval: float = 1.0,
+    ):
+        self._scan = scan or list_devices
+        self._watch_dir = watch_dir
+        self._poll_interval = poll_interval
+        self._devices: Dict[str, Device] = {}
+        # Bumped by every change to the devices, including a node's permissions being changed
+        self._generation = 0
+        self._condition = threading.Condition()
+        self._listeners: List[Callable[[DeviceEvent, Device], None]] = []
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._watcher: Optional[_Inotify] = None
+        # Written to on stop, to wake the thread
+        self._wake_r = self._wake_w = -1
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        # Watch before the first scan, so nothing plugged in meanwhile is missed
+        try:
+            self._watcher = _Inotify(self._watch_dir)
+        except (OSError, AttributeError) as e:
+            logger.warning(f"Can't watch {self._watch_dir} for devices, polling instead: {e}")
+            self._watcher = None
+        self._wake_r, self._wake_w = os.pipe()
+        self.rescan()
+        self._thread = threading.Thread(target=self._run, name="device-registry", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is None:
+            return
+        self._stopped.set()
+        os.write(self._wake_w, b"\0")
+        self._thread.join()
+        self._thread = None
+        for fd in (self._wake_r, self._wake_w):
+            os.close(fd)
+        if self._watcher is not None:
+            self._watcher.close()
+            self._watcher = None
+
+    @property
+    def watching(self) -> bool:
+        """Whether devices are watched with inotify rather than polled for."""
+        return self._watcher is not None
+
+    def add_listener(self, listener: Callable[[DeviceEvent, Device], None]) -> None:
+        """Calls the listener from the registry's thread whenever a device is added or removed."""
+        self._listeners.append(listener)
+
+    @property
+    def generation(self) -> int:
+        """Changes whenever the devices do, see `wait_for`."""
+        with self._condition:
+            return self._generation
+
+    @property
+    def devices(self) -> List[Device]:
+        with self._condition:
+            return sorted(self._devices.values(), key=lambda device: device.path)
+
+    def find(self, identity: str) -> Optional[Device]:
+        """The attached device with the identity, see `Device.matches`."""
+        with self._condition:
+            return self._find(identity)
+
+    def wait_for(
+        self,
+        identity: str,
+        timeout: Optional[float] = None,
+        cancel: Optional[CancelToken] = None,
+        since: Optional[int] = None,
+    ) -> Optional[Device]:
+        """Blocks until a device with the identity is attached.
+
+        :param timeout: Maximum seconds to wait. None to wait indefinitely.
+        :param since: A `generation` the devices must have changed since, eg. to wait
+                      for a device that's attached but can't be opened yet to change.
+        :return: The device, or None if it wasn't attached in time.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while True:
+                device = self._find(identity)
+                if device is not None and (since is None or self._generation != since):
+                    return device
+                if cancel is not None:
+                    cancel.raise_if_cancelled()
+                wait = None if deadline is None else deadline - time.monotonic()
+                if wait is not None and wait <= 0:
+                    return None
+                # Wake up now and then to check for being cancelled
+                self._condition.wait(0.1 if cancel is not None and (wait is None or wait > 0.1) else wait)
+
+    def rescan(self, changed: bool = False) -> None:
+        """Rescans the attached devices, notifying listeners and waiters of any change.
+
+        :param changed: Whether to wake waiters even if the same devices are attached.
+        """
+        try:
+            scanned = {device.path: device for device in self._scan()}
+        except OSError as e:
+            logger.warning(f"Failed to list devices: {e}")
+            return
+        with self._condition:
+            added = [device for path, device in scanned.items() if self._devices.get(path) != device]
+            removed = [device for path, device in self._devices.items() if scanned.get(path) != device]
+            self._devices = scanned
+            if added or removed or changed:
+                self._generation += 1
+                self._condition.notify_all()
+        for device in removed:
+            logger.info(f"Device removed: {device.path} ({device.serial_number})")
+            self._notify(DeviceEvent.REMOVED, device)
+        for device in added:
+            logger.info(f"Device added: {device.path} ({device.serial_number})")
+            self._notify(DeviceEvent.ADDED, device)
+
+    def _find(self, identity: str) -> Optional[Device]:
+        return next((device for device in self._devices.values() if device.matches(identity)), None)
+
+    def _notify(self, event: DeviceEvent, device: Device) -> None:
+        for listener in self._listeners:
+            try:
+                listener(event, device)
+            except Exception:
+                logger.exception("Device listener failed")
+
+    def _run(self) -> None:
+        watched = [self._wake_r] + ([self._watcher] if self._watcher is not None else [])
+        while not self._stopped.is_set():
+            select.select(watched, [], [], None if self._watcher is not None else self._poll_interval)
+            if self._stopped.is_set():
+                break
+            if self._watcher is None:
+                self.rescan()
+                continue
+            names = self._watcher.read_names()
+            if names is None or any(name.startswith(_TTY_PREFIX) for name in names):
+                self.rescan(changed=True)
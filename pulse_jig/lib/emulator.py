@@ -0,0 +1,439 @@
+import random
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+from .protocol import BOOT_HEADER_SEPARATOR
+from .timeout_policy import command_key
+from .transport import DEFAULT_BAUDRATE, ScheduledTransport
+
+# hwspec fields that the firmware stores as integers and reports in hex
+HWSPEC_HEX_KEYS = ("thing_type_id", "assembly_id", "assembly_version", "manufacturer_id")
+
+TEST_FIRMWARE = "test"
+PROD_FIRMWARE = "prod"
+
+# Rates the test firmware's `baud` command accepts
+BAUDRATES = (115200, 230400, 460800, 921600)
+# Start, data and stop bits on the line for each byte (8N1)
+BITS_PER_BYTE = 10
+
+# Mean and standard deviation, in seconds, of how long each command takes on
+# real hardware. Commands not listed take `DEFAULT_LATENCY`.
+DEFAULT_LATENCY = (0.003, 0.001)
+COMMAND_LATENCY: Dict[str, Tuple[float, float]] = {
+    "hwspec-save": (0.06, 0.01),
+    "hwspec-destroy": (0.03, 0.005),
+    "hwchunk": (0.04, 0.01),
+    "pulse-cfg": (0.02, 0.005),
+    "test-self": (3.0, 0.3),
+    "test-port": (20.0, 2.0),
+    "test-ta3k": (8.0, 1.0),
+    "test-ta6k": (5.0, 0.5),
+    "test-ta11k": (5.0, 0.5),
+    "test-lora-connect": (30.0, 10.0),
+}
+
+
+@dataclass
+class EmulatorConfig:
+    """How the emulated device behaves. Times are in device seconds, see `speed`."""
+
+    # How many times faster than real time the device runs
+    speed: float = 1.0
+    seed: Optional[int] = None
+    firmware: str = TEST_FIRMWARE
+    test_firmware_version: str = "1.2.3"
+    prod_firmware_version: str = "2.0.0"
+    # Printed in the boot header as `Firmware Build:` if set
+    test_firmware_build: str = ""
+    prod_firmware_build: str = ""
+    latency: Dict[str, Tuple[float, float]] = field(default_factory=lambda: dict(COMMAND_LATENCY))
+    # Probability of each command (by name) failing, ie. `-ERR` or a test `FAIL`
+    failure_rates: Dict[str, float] = field(default_factory=dict)
+    # Probability of any echo being corrupted, to exercise resync and retry
+    garble_rate: float = 0.0
+    boot_time: float = 0.5
+    # Time taken by the operator to connect a probe, or remove it, after being prompted
+    probe_connect_time: float = 2.0
+    probe_removal_time: float = 2.0
+    probe_port: int = 1
+    # An EEPROM that rejects writes, eg. a write-protected probe
+    write_protected: bool = False
+    # Whether new pulses already have a hwspec, as they do from phase 2 onwards
+    provisioned: bool = False
+    # Whether output takes as long to arrive as it would over the UART at the device's baud rate
+    line_rate: bool = False
+    # The fastest rate the link carries cleanly, anything faster is garbled, eg. by a long cable
+    baud_limit: int = BAUDRATES[-1]
+    # Time after `baud` switches rate that the device goes back to the default, unless a command arrives
+    baud_revert_time: float = 0.5
+    # Readings per port and channel in the verbose output of `test-port` and `test-ta*`
+    samples: int = 1
+
+    @classmethod
+    def from_url(cls, url: str) -> "EmulatorConfig":
+        """Parses the options of an `emulator://` URL, eg.
+        `emulator://?speed=20&seed=1&fail=test-port:0.1,hwspec-save:0.01&garble=0.01&line_rate=1`"""
+        query = parse_qs(urlparse(url).query)
+        config = cls()
+        for name, values in query.items():
+            value = values[-1]
+            if name == "speed":
+                config.speed = float(value)
+            elif name == "seed":
+                config.seed = int(value)
+            elif name == "firmware":
+                config.firmware = value
+            elif name == "garble":
+                config.garble_rate = float(value)
+            elif name == "build":
+                config.test_firmware_build = config.prod_firmware_build = value
+            elif name in ("baud_limit", "samples"):
+                setattr(config, name, int(value))
+            elif name == "fail":
+                for item in value.split(","):
+                    cmd, rate = item.rsplit(":", 1)
+                    config.failure_rates[cmd] = float(rate)
+            elif name in ("write_protected", "provisioned", "line_rate"):
+                setattr(config, name, value.lower() in ("1", "true", "yes"))
+            else:
+                raise ValueError(f"Unknown emulator option: {name}")
+        return config
+
+
+class FirmwareEmulator:
+    """
+    Emulates the xDot firmware's side of the Function Test Protocol: the boot
+    header, prompt, echo and ack, and the commands the provisioners use. The
+    hwspec and hwchunk EEPROMs of the pulse and probe are kept in `eeprom` and
+    `chunks`, which survive a reboot but are replaced by `new_unit`, and the
+    probe's are also replaced once it's removed (`probe-await recovery`).
+
+    Responses are produced by `respond` as (delay, data) pairs, where the
+    delay is in device seconds from when the command was received.
+    """
+
+    def __init__(self, config: Optional[EmulatorConfig] = None):
+        self.config = config if config is not None else EmulatorConfig()
+        self.firmware = self.config.firmware
+        self._rng = random.Random(self.config.seed)
+        self.eeprom: Dict[str, Dict[str, str]] = {}
+        self.chunks: Dict[str, Dict[str, str]] = {}
+        self.dev_eui = ""
+        self.commands: List[str] = []
+        # The UART's rate, changed by `baud` and back to the default on a reboot
+        self.baudrate = DEFAULT_BAUDRATE
+        self._hwspec: Dict[str, str] = {}
+        self.new_unit()
+
+    def new_unit(self) -> None:
+        """Replaces the pulse and probe with blank ones."""
+        self.eeprom = {}
+        self.chunks = {}
+        self._hwspec = {}
+        self.dev_eui = ":".join(f"{self._rng.randrange(256):02x}" for _ in range(8))
+        if self.config.provisioned:
+            timestamp = int(time.time())
+            self.eeprom["pulse"] = {
+                "serial": f"W01-2-{timestamp}",
+                "thing_type_name": "pulse-r1",
+                "thing_type_id": "0x2",
+                "hw_revision": "r1b",
+                "assembly_id": "0x1",
+                "assembly_version": "0x1",
+                "assembly_timestamp": str(timestamp),
+                "manufacturer_name": "emulated",
+                "manufacturer_id": "0x1",
+                "iecex_cert": "N/A",
+            }
+
+    def boot_header(self) -> bytes:
+        if self.firmware == TEST_FIRMWARE:
+            title, version = "Starting Functional Tests Firmware", self.config.test_firmware_version
+            build = self.config.test_firmware_build
+        else:
+            title, version = "Starting Production Firmware", self.config.prod_firmware_version
+            build = self.config.prod_firmware_build
+        lines = [BOOT_HEADER_SEPARATOR, title, f"Firmware Version: {version}"]
+        if build:
+            lines.append(f"Firmware Build: {build}")
+        lines += [BOOT_HEADER_SEPARATOR, ""]
+        header = "\r\n".join(lines).encode()
+        # The production firmware doesn't run the test shell
+        return header + b"> " if self.firmware == TEST_FIRMWARE else header
+
+    def respond(self, line: str) -> List[Tuple[float, bytes]]:
+        """Returns the device's output in response to the given command line."""
+        if self.firmware != TEST_FIRMWARE:
+            return []
+        self.commands.append(line)
+        echo = line
+        if self.config.garble_rate and self._rng.random() < self.config.garble_rate and line:
+            i = self._rng.randrange(len(line))
+            echo = line[:i] + "\x00" + line[i + 1 :]
+
+        name = command_key(line)
+        args = line.split()[1:]
+        mean, stddev = self.config.latency.get(name, DEFAULT_LATENCY)
+        duration = max(self._rng.gauss(mean, stddev), 0.0)
+        fail = self._rng.random() < self.config.failure_rates.get(name, 0.0)
+
+        try:
+            if fail and not _reports_failure_in_body(line):
+                raise _CommandError("failed")
+            body = self._execute(name, args, fail)
+        except _CommandError as e:
+            return [(DEFAULT_LATENCY[0], f"{echo}\r\n-ERR {e}\r\n> ".encode())]
+
+        ack = DEFAULT_LATENCY[0]
+        out = [(ack, f"{echo}\r\n+OK\r\n".encode())]
+        if body is None:
+            out[-1] = (ack + duration, out[-1][1] + b"> ")
+            return out
+        # Spread the body's lines over the time the command takes
+        for i, text in enumerate(body):
+            out.append((ack + duration * (i + 1) / len(body), f"{text}\r\n".encode()))
+        out.append((ack + duration, b".\r\n> "))
+        return out
+
+    def _execute(self, name: str, args: List[str], fail: bool) -> Optional[List[str]]:
+        """Runs a command, returning its body (None if it has none)."""
+        if name == "firmware-version":
+            return [self.config.test_firmware_version]
+        if name in ("platform", "port-enable"):
+            return None
+        if name.startswith("hwspec-"):
+            return self._hwspec_command(name, args)
+        if name == "hwchunk":
+            return self._hwchunk_command(args, fail)
+        if name == "probe-await":
+            return self._probe_await(args)
+        if name.startswith("test-"):
+            return self._test_command(name, args, fail)
+        if name == "baud":
+            return self._baud_command(args)
+        if name == "lora-deveui":
+            return [self.dev_eui]
+        if name in ("lora-config", "pulse-cfg"):
+            return ["OK"]
+        raise _CommandError("unknown command")
+
+    def _hwspec_command(self, name: str, args: List[str]) -> Optional[List[str]]:
+        if name == "hwspec-get":
+            if args[0] not in self._hwspec:
+                raise _CommandError("unknown key")
+            return [self._hwspec[args[0]]]
+        if name == "hwspec-set":
+            key, value = args[0], " ".join(args[1:])
+            self._hwspec[key] = hex(int(value, 0)) if key in HWSPEC_HEX_KEYS else value
+            return None
+        target = args[0]
+        if name == "hwspec-load":
+            if target not in self.eeprom:
+                raise _CommandError("no hwspec")
+            self._hwspec = dict(self.eeprom[target])
+        elif name == "hwspec-save":
+            if self.config.write_protected:
+                raise _CommandError("write failed")
+            self.eeprom[target] = dict(self._hwspec)
+        elif name == "hwspec-destroy":
+            self.eeprom.pop(target, None)
+        else:
+            raise _CommandError("unknown command")
+        return None
+
+    def _hwchunk_command(self, args: List[str], fail: bool) -> List[str]:
+        action, target = args[0], args[1]
+        chunks = self.chunks.setdefault(target, {})
+        if action == "dump":
+            if args[2] not in chunks:
+                raise _CommandError("no chunk")
+            return [f"cable length: {chunks[args[2]]}mm"]
+        if action == "write":
+            if self.config.write_protected:
+                raise _CommandError("write failed")
+            chunks[args[2]] = args[3]
+            return ["OK"]
+        if action == "verify":
+            return ["FAIL"] if fail or not chunks else ["PASS"]
+        if action == "clear":
+            chunks.clear()
+            return ["OK"]
+        raise _CommandError("unknown command")
+
+    def _baud_command(self, args: List[str]) -> None:
+        # Switches once the response has gone out at the old rate, see `EmulatorTransport`
+        baudrate = int(args[0]) if args and args[0].isdigit() else 0
+        if baudrate not in BAUDRATES:
+            raise _CommandError("unsupported baud rate")
+        self.baudrate = baudrate
+        return None
+
+    def _probe_await(self, args: List[str]) -> List[str]:
+        # The transport adds the operator's time to connect or remove the probe
+        if args[0] == "connect":
+            return [f"Found on port: {self.config.probe_port}"]
+        # A different probe is connected next time
+        self.eeprom.pop("probe", None)
+        self.chunks.pop("probe", None)
+        return ["Probe removed"]
+
+    def _test_command(self, name: str, args: List[str], fail: bool) -> List[str]:
+        lines = self._test_output(name, args, fail)
+        # Only the verdict without `-v`
+        return lines if "-v" in args else lines[-1:]
+
+    def _test_output(self, name: str, args: List[str], fail: bool) -> List[str]:
+        if name == "test-port" or name.startswith("test-ta"):
+            return self._reading_test(name, args, fail)
+        steps = {
+            "test-self": ["testing watchdog", "testing EEPROM", "testing flash", "testing RTC"],
+            "test-lora-connect": ["joining"],
+        }.get(name, ["checking probe", "checking cable", "checking sensor"])
+        failed_step = self._rng.randrange(len(steps)) if fail else None
+        lines = []
+        for i, step in enumerate(steps):
+            if i == failed_step:
+                lines.append(f"{step}...FAIL")
+                break
+            lines.append(f"{step}...OK")
+        lines.append("FAIL" if fail else "PASS")
+        return lines
+
+    def _reading_test(self, name: str, args: List[str], fail: bool) -> List[str]:
+        # An analog reading per port and channel, checked against the threshold given with `-a`,
+        # in the format `lib.measurements` expects rather than one taken from the test firmware
+        threshold = float(args[args.index("-a") + 1]) if "-a" in args else 0.4
+        if name == "test-port":
+            channels = [(port, 0) for port in range(1, 5)]
+        else:
+            channels = [(self.config.probe_port, channel) for channel in range(3)]
+        failed = self._rng.randrange(len(channels)) if fail else None
+        lines = []
+        for i, (port, channel) in enumerate(channels):
+            for _ in range(self.config.samples):
+                if i == failed:
+                    value = self._rng.uniform(0, threshold * 0.9)
+                    lines.append(f"port {port} ch {channel}: adc={value:.3f} min={threshold:.3f} FAIL")
+                    break
+                value = self._rng.uniform(threshold * 1.1, threshold * 2)
+                lines.append(f"port {port} ch {channel}: adc={value:.3f} min={threshold:.3f} OK")
+            if i == failed:
+                break
+        lines.append("FAIL" if fail else "PASS")
+        return lines
+
+
+class _CommandError(Exception):
+    pass
+
+
+def _reports_failure_in_body(line: str) -> bool:
+    # Tests and verification fail with a FAIL body rather than an -ERR
+    return line.startswith(("test-", "hwchunk verify"))
+
+
+class EmulatorTransport(ScheduledTransport):
+    """
+    Transport connected to a `FirmwareEmulator`. Output is released to the
+    reader when it's due, scaled by the emulator's `speed`, and the device
+    handles one command at a time like the real firmware.
+
+    The port's `baudrate` has to match the device's, otherwise nothing
+    written reaches the device and its output arrives garbled, as it does
+    at rates above the config's `baud_limit`.
+    """
+
+    def __init__(self, emulator: Optional[FirmwareEmulator] = None):
+        super().__init__("emulator://")
+        self.emulator = emulator if emulator is not None else FirmwareEmulator()
+        self._line = bytearray()
+        self._busy_until = 0.0
+        # When the device's output has all been sent, with `line_rate`
+        self._line_free_at = 0.0
+        # When the device goes back to the default rate after `baud`, unless a command arrives first
+        self._revert_at: Optional[float] = None
+
+    def reboot(self, firmware: Optional[str] = None) -> None:
+        """Restarts the device, optionally with different firmware, discarding anything in flight."""
+        with self._cond:
+            if firmware is not None:
+                self.emulator.firmware = firmware
+            self._pending.clear()
+            self._line.clear()
+            self.emulator.baudrate = DEFAULT_BAUDRATE
+            self._revert_at = None
+            self._line_free_at = 0.0
+            self._busy_until = time.monotonic() + self.emulator.config.boot_time / self.emulator.config.speed
+            self._send(self._busy_until, self.emulator.boot_header())
+
+    def _received(self, data: bytes) -> None:
+        if not self._in_step():
+            # Framing errors, the device doesn't see a thing
+            return
+        self._line += data
+        while b"\r" in self._line:
+            line, _, rest = bytes(self._line).partition(b"\r")
+            self._line = bytearray(rest)
+            self._handle(line.decode("utf-8", "replace").strip())
+
+    def _handle(self, line: str) -> None:
+        config = self.emulator.config
+        start = max(time.monotonic(), self._busy_until)
+        # A command arriving confirms the device's rate
+        self._revert_at = None
+        baudrate = self.emulator.baudrate
+        responses = self.emulator.respond(line)
+        if command_key(line) == "probe-await":
+            # The operator's time to connect or remove the probe
+            wait = config.probe_connect_time if line.endswith("connect") else config.probe_removal_time
+            responses = [(delay + wait, data) for delay, data in responses]
+        # The response to `baud` still goes out at the old rate
+        switched, self.emulator.baudrate = self.emulator.baudrate, baudrate
+        for delay, data in responses:
+            self._send(start + delay / config.speed, data)
+        if responses:
+            self._busy_until = start + max(delay for delay, _ in responses) / config.speed
+        if switched != baudrate:
+            self.emulator.baudrate = switched
+            self._revert_at = max(self._busy_until, self._line_free_at) + config.baud_revert_time / config.speed
+
+    def _in_step(self) -> bool:
+        # Whether the port and device are at the same rate, and one the link carries
+        if self._revert_at is not None and time.monotonic() >= self._revert_at:
+            self.emulator.baudrate = DEFAULT_BAUDRATE
+            self._revert_at = None
+        baudrate = self.emulator.baudrate
+        return self.baudrate == baudrate and baudrate <= self.emulator.config.baud_limit
+
+    def _send(self, due: float, data: bytes) -> None:
+        config = self.emulator.config
+        if config.line_rate:
+            due = max(due, self._line_free_at) + len(data) * BITS_PER_BYTE / self.emulator.baudrate / config.speed
+            self._line_free_at = due
+        if not self._in_step():
+            data = b"\x00" * len(data)
+        self._schedule(due, data)
+
+
+_emulators: Dict[str, EmulatorTransport] = {}
+
+
+def register_emulator(name: str, port: EmulatorTransport) -> None:
+    """Makes `emulator://<name>` connect to the given port, so it can be shared with eg. a fake `PulseManager`."""
+    port.port = f"emulator://{name}"
+    _emulators[name] = port
+
+
+def open_emulator(url: str) -> EmulatorTransport:
+    """Returns a transport for an `emulator://` URL. A registered name gets
+    the registered port, otherwise a new emulator is created with the URL's
+    options, see `EmulatorConfig.from_url`."""
+    name = urlparse(url).netloc
+    if name:
+        if name not in _emulators:
+            raise ValueError(f"Unknown emulator: {name}")
+        return _emulators[name]
+    return EmulatorTransport(FirmwareEmulator(EmulatorConfig.from_url(url)))
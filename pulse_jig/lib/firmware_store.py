@@ -0,0 +1,154 @@
+import hashlib
+import json
+import logging
+import os
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Tuple, Union
+
+from .boot_header import BootHeader, FirmwareKind
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class FirmwareImage:
+    path: Path
+    data: bytes
+    # SHA-256 of the data, which identifies the build whatever the file's called
+    digest: str
+
+    @property
+    def name(self) -> str:
+        return self.path.name
+
+    @classmethod
+    def read(cls, path: Union[str, Path]) -> "FirmwareImage":
+        path = Path(path)
+        data = path.read_bytes()
+        return cls(path, data, hashlib.sha256(data).hexdigest())
+
+
+@dataclass
+class FlashSkipStats:
+    loads: int = 0
+    skipped: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        return self.skipped / self.loads if self.loads else 0.0
+
+
+class FirmwareStore:
+    """
+    Holds firmware images in memory, read and hashed once rather than on
+    every unit, and the firmware kind, version and build each image boots
+    as, learnt from the boot header after it's been flashed. A device whose
+    boot header matches what an image boots as is already running it, so
+    flashing it again can be skipped, see `is_flashed`.
+
+    The version alone doesn't identify a build, eg. an image rebuilt without
+    bumping it, so only firmware that prints its build in the boot header
+    (see `BootHeader.build`) is ever skipped. The versions are keyed by the
+    image's digest, so a rebuilt image is flashed (and learnt) again even if
+    the file name is unchanged.
+    """
+
+    def __init__(self, paths: Iterable[Union[str, Path]] = (), versions_path: Optional[Union[str, Path]] = None):
+        """
+        :param paths: Images to read up front, eg. the test and production firmware.
+        :param versions_path: JSON file to load and save the learnt versions from. None to keep them in memory only.
+        """
+        self._versions_path = Path(versions_path) if versions_path is not None else None
+        self._images: Dict[Path, Tuple[Tuple[int, int], FirmwareImage]] = {}
+        self._versions: Dict[str, Tuple[FirmwareKind, str, str]] = {}
+        self.stats: Dict[str, FlashSkipStats] = {}
+        self._load()
+        for path in paths:
+            self.get(path)
+
+    def get(self, path: Union[str, Path]) -> Optional[FirmwareImage]:
+        """The image at the path, read again only if the file has changed. None if it can't be read."""
+        path = Path(path)
+        try:
+            stat = os.stat(path)
+            key = (stat.st_mtime_ns, stat.st_size)
+            cached = self._images.get(path)
+            if cached is not None and cached[0] == key:
+                return cached[1]
+            image = FirmwareImage.read(path)
+        except OSError as e:
+            logger.error(f"Could not read firmware {path}: {e}")
+            return None
+        self._images[path] = (key, image)
+        logger.info(f"Firmware {path}: {len(image.data)} bytes, sha256 {image.digest[:12]}")
+        return image
+
+    def version_of(self, image: FirmwareImage) -> Optional[Tuple[FirmwareKind, str, str]]:
+        """The firmware kind, version and build the image boots as, None if it hasn't been learnt."""
+        return self._versions.get(image.digest)
+
+    def learn(self, image: FirmwareImage, header: BootHeader) -> None:
+        """Records what the image boots as, from the boot header after it's been flashed.
+        Nothing is recorded if the header doesn't identify the build."""
+        version = (header.kind, header.version, header.build)
+        if header.kind == FirmwareKind.UNKNOWN or not header.build or self._versions.get(image.digest) == version:
+            return
+        self._versions[image.digest] = version
+        self._save()
+
+    def is_flashed(self, image: FirmwareImage, running: Optional[BootHeader]) -> bool:
+        """Whether the device is already running the image, going by its boot
+        header, and records the load in `stats`.
+
+        :param running: The boot header of the firmware the device is running, None if it's unknown.
+        """
+        stats = self.stats.setdefault(image.name, FlashSkipStats())
+        stats.loads += 1
+        version = self.version_of(image)
+        flashed = (
+            running is not None
+            and version is not None
+            and bool(running.build)
+            and version == (running.kind, running.version, running.build)
+        )
+        if flashed:
+            stats.skipped += 1
+        logger.info(f"{image.name}: flash skipped for {stats.skipped} of {stats.loads} loads ({stats.hit_rate:.0%})")
+        return flashed
+
+    def _save(self) -> None:
+        if self._versions_path is None:
+            return
+        data = {
+            digest: {"kind": kind.name, "version": version, "build": build}
+            for digest, (kind, version, build) in self._versions.items()
+        }
+        # Write to a temp file first so a power cut can't leave a truncated file behind
+        tmp = self._versions_path.with_name(self._versions_path.name + ".tmp")
+        try:
+            self._versions_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(tmp, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp, self._versions_path)
+        except OSError as e:
+            logger.error(f"Could not save firmware versions to {self._versions_path}: {e}")
+
+    def _load(self) -> None:
+        if self._versions_path is None or not self._versions_path.exists():
+            return
+        try:
+            with open(self._versions_path) as f:
+                data = json.load(f)
+            for digest, version in data.items():
+                # Entries without a build never match a device, so are dropped
+                if version.get("build"):
+                    self._versions[digest] = (
+                        FirmwareKind[version["kind"]],
+                        str(version["version"]),
+                        str(version["build"]),
+                    )
+        except (OSError, ValueError, TypeError, KeyError, AttributeError) as e:
+            # Losing the versions only means flashing each image once more
+            logger.error(f"Could not load firmware versions from {self._versions_path}: {e}")
+            self._versions.clear()
@@ -25,16 +25,31 @@ class HWSpec:
     iecex_cert: str = ""
 
     def get(self, ftf: JigClient):
-        self.serial = ftf.hwspec_get("serial")
-        self.thing_type_name = ftf.hwspec_get("thing_type_name")
-        self.thing_type_id = int(ftf.hwspec_get("thing_type_id"), 16)
-        self.hw_revision = str(ftf.hwspec_get("hw_revision"))
-        self.assembly_id = int(ftf.hwspec_get("assembly_id"), 16)
-        self.assembly_version = int(ftf.hwspec_get("assembly_version"), 16)
-        self.assembly_timestamp = int(ftf.hwspec_get("assembly_timestamp"))
-        self.manufacturer_name = ftf.hwspec_get("manufacturer_name")
-        self.manufacturer_id = int(ftf.hwspec_get("manufacturer_id"), 16)
-        self.iecex_cert = ftf.hwspec_get("iecex_cert")
+        # All keys are read in a single pipelined batch
+        values = ftf.hwspec_get_many(
+            [
+                "serial",
+                "thing_type_name",
+                "thing_type_id",
+                "hw_revision",
+                "assembly_id",
+                "assembly_version",
+                "assembly_timestamp",
+                "manufacturer_name",
+                "manufacturer_id",
+                "iecex_cert",
+            ]
+        )
+        self.serial = values["serial"]
+        self.thing_type_name = values["thing_type_name"]
+        self.thing_type_id = int(values["thing_type_id"], 16)
+        self.hw_revision = str(values["hw_revision"])
+        self.assembly_id = int(values["assembly_id"], 16)
+        self.assembly_version = int(values["assembly_version"], 16)
+        self.assembly_timestamp = int(values["assembly_timestamp"])
+        self.manufacturer_name = values["manufacturer_name"]
+        self.manufacturer_id = int(values["manufacturer_id"], 16)
+        self.iecex_cert = values["iecex_cert"]
 
     def set(self, iecex_cert):
         # the serial and properties that it's composed of should never be overwritten
@@ -53,16 +68,21 @@ class HWSpec:
         self.iecex_cert = iecex_cert
 
     def save(self, ftf: JigClient):
-        ftf.hwspec_set("serial", self.serial)
-        ftf.hwspec_set("thing_type_name", self.thing_type_name)
-        ftf.hwspec_set("thing_type_id", str(self.thing_type_id))
-        ftf.hwspec_set("hw_revision", self.hw_revision)
-        ftf.hwspec_set("assembly_id", str(self.assembly_id))
-        ftf.hwspec_set("assembly_version", str(self.assembly_version))
-        ftf.hwspec_set("assembly_timestamp", str(self.assembly_timestamp))
-        ftf.hwspec_set("manufacturer_name", self.manufacturer_name)
-        ftf.hwspec_set("manufacturer_id", str(self.manufacturer_id))
-        ftf.hwspec_set("iecex_cert", self.iecex_cert)
+        # All keys are written in a single pipelined batch
+        ftf.hwspec_set_many(
+            {
+                "serial": self.serial,
+                "thing_type_name": self.thing_type_name,
+                "thing_type_id": str(self.thing_type_id),
+                "hw_revision": self.hw_revision,
+                "assembly_id": str(self.assembly_id),
+                "assembly_version": str(self.assembly_version),
+                "assembly_timestamp": str(self.assembly_timestamp),
+                "manufacturer_name": self.manufacturer_name,
+                "manufacturer_id": str(self.manufacturer_id),
+                "iecex_cert": self.iecex_cert,
+            }
+        )
 
     @staticmethod
     def _generate_serial(timestamp: int) -> str:
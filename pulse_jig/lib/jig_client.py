@@ -1,24 +1,78 @@
 import logging
-import os
 import time
-from typing import Optional
-
-import serial
-
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Callable, Deque, Dict, Iterator, List, Optional, Sequence, Tuple, TypeVar, Union
+
+from .boot_header import BootHeader, BootHeaderRecognizer, await_boot_header
+from .cancel import Cancelled, CancelToken
+from .command_hooks import (
+    OUTCOME_ABORTED,
+    OUTCOME_CANCELLED,
+    OUTCOME_ERROR,
+    OUTCOME_OK,
+    OUTCOME_PROTOCOL_ERROR,
+    OUTCOME_TIMEOUT,
+    CommandEvent,
+    CommandHook,
+)
+from .device_registry import list_devices
+from .measurements import Measurements
+from .protocol import BOOT_HEADER_MARK, ProtocolParser, Token, TokenKind
 from .timeout import Timeout, TimeoutNever
+from .timeout_policy import AdaptiveTimeoutPolicy
+from .transcript import CommandRecord, Transcript
+from .transport import DEFAULT_BAUDRATE, Transport, mark
+from .verbosity import VERBOSE_FLAG, VerbosityPolicy, with_verbose
 
 logger = logging.getLogger("jig_client")
 
-# Import the correct platform specific comports implementation.
-# There doesn't seem to be a better way of doing this at the moment.
-if os.name == "nt":  # sys.platform == 'win32':
-    # Commented out to avoid mypy errors and we don't use windows - reenable and fix if you use windows :)
-    # from serial.tools.list_ports_windows import comports
-    pass
-elif os.name == "posix":
-    from serial.tools.list_ports_posix import comports
-else:
-    raise ImportError("Sorry: no implementation for your platform ('{}') available".format(os.name))
+T = TypeVar("T")
+
+# Commands that only read state from the device, so are safe to send again if
+# their response was garbled
+IDEMPOTENT_COMMANDS = (
+    "hwspec-get ",
+    "firmware-version",
+    "lora-deveui get",
+    "hwchunk dump ",
+    "hwchunk verify ",
+)
+
+# Reads whose response can't change until one of the commands in
+# `CACHE_INVALIDATED_BY` is sent or the device resets, see `cache_reads`
+CACHED_COMMANDS = (
+    "hwspec-get ",
+    "firmware-version",
+    "lora-deveui get",
+    "hwchunk dump ",
+)
+# Commands, by prefix, and the cached commands they change the response of
+CACHE_INVALIDATED_BY = {
+    "hwspec-set ": ("hwspec-get ",),
+    "hwspec-save ": ("hwspec-get ",),
+    "hwspec-destroy ": ("hwspec-get ",),
+    "hwspec-load ": ("hwspec-get ",),
+    "hwchunk write ": ("hwchunk dump ",),
+    "hwchunk clear ": ("hwchunk dump ",),
+    # A different probe may be connected afterwards
+    "probe-await ": ("hwspec-get ", "hwchunk dump "),
+}
+# Cached commands that read from whichever external port is enabled
+PORT_SCOPED_COMMANDS = ("hwspec-get ", "hwchunk dump ")
+
+# Commands that don't depend on whether an external port is enabled, so
+# don't need a port left enabled by `JigClient.external_port` to be disabled first.
+# `hwspec-*` aren't, they go to the probe while its port is enabled (see `PORT_SCOPED_COMMANDS`)
+PORT_INDEPENDENT_COMMANDS = ("firmware-version",)
+# Number of commands `enable_external_port` and `disable_external_port` each send
+EXTERNAL_PORT_COMMANDS = 3
+
+# Switches the device's baud rate, see `JigClient.negotiate_baudrate`
+BAUD_COMMAND = "baud {baudrate}"
+# Sent to check the link at a new baud rate, its echo and body have to come back intact
+BAUD_CHECK_COMMAND = "firmware-version"
 
 
 def _to_port_flags(port_number: int):
@@ -26,6 +80,21 @@ def _to_port_flags(port_number: int):
     return hex(pow(2, port_number - 1))
 
 
+def is_idempotent(cmd: str) -> bool:
+    """Whether the command can safely be sent again, see `IDEMPOTENT_COMMANDS`"""
+    return cmd.startswith(IDEMPOTENT_COMMANDS)
+
+
+def _bytes_out(cmd: str) -> int:
+    # As written by `JigClient._writeline`
+    return len(cmd.encode("utf-8")) + 1
+
+
+def abort_on_failure(line: str) -> bool:
+    """Early-abort predicate for test commands that stops at the first `FAIL` sub-result"""
+    return line.rstrip().endswith("FAIL")
+
+
 class JigClientException(Exception):
     """JigClient exception. Raised if the device doesn't respond to the Jig
     Function Test Protocol correctly."""
@@ -35,166 +104,679 @@ class JigClientException(Exception):
         self.msg = msg
 
 
+@dataclass
+class BatchCommand:
+    """A single command in a pipelined batch sent via `JigClient.send_commands`."""
+
+    cmd: str
+    has_body: bool = True
+    timeout: Optional[float] = 2
+
+
+@dataclass
+class RetryStats:
+    """Counts of idempotent commands that were retried after a protocol error."""
+
+    # Number of times a command (or batch) was sent again
+    retries: int = 0
+    # Commands that succeeded after being retried, ie. a fail and re-seat cycle was saved
+    recovered: int = 0
+    # Commands that were retried but still failed
+    exhausted: int = 0
+
+
+@dataclass
+class CacheStats:
+    """Counts of reads answered from the session's cache rather than the device, see `cache_reads`."""
+
+    hits: int = 0
+    misses: int = 0
+    # Cached responses thrown away because a command changed them
+    invalidations: int = 0
+
+
+@dataclass
+class ExternalPortStats:
+    """How often `JigClient.external_port` had to switch the external port, and the commands it saved by not."""
+
+    enables: int = 0
+    disables: int = 0
+    commands_saved: int = 0
+
+
+@dataclass
+class VerbosityStats:
+    """Test commands run without their verbose output, see `JigClient.run_test_cmd`, and what it saved."""
+
+    quiet_runs: int = 0
+    # Quiet runs that failed and were run again verbose
+    reruns: int = 0
+    # Compared with the mean of the test's verbose runs, less the quiet runs that failed and their verbose reruns
+    seconds_saved: float = 0.0
+    bytes_saved: int = 0
+
+
 class JigClient:
     class CommandFailed(Exception):
         """JigClient exception. Raised if the device doesn't respond to the Jig
         Function Test Protocol correctly."""
 
-        def __init__(self, msg):
+        def __init__(self, msg, cmd: Optional[str] = None, index: Optional[int] = None):
             super().__init__(msg)
             self.msg = msg
-
-    def __init__(self, port: serial.Serial):
+            # Set when raised from a batch so the failure can be attributed to the command
+            self.cmd = cmd
+            self.index = index
+
+    class CommandTimeout(JigClientException):
+        """Raised when a command's body doesn't finish before its timeout."""
+
+    class CommandAborted(JigClientException):
+        """Raised when a command's `abort_when` predicate matched a line of
+        its body. The device is still running the command, so the client
+        resyncs on the prompt before sending the next one."""
+
+        def __init__(self, line: str, body: str):
+            super().__init__(f"Command aborted at: {line}")
+            self.line = line
+            self.body = body
+
+    def __init__(
+        self,
+        port: Transport,
+        transcript: Optional[Transcript] = None,
+        cancel_token: Optional[CancelToken] = None,
+        max_attempts: int = 3,
+        retry_deadline: float = 5,
+        timeout_policy: Optional[AdaptiveTimeoutPolicy] = None,
+        link_latency: float = 0,
+        cache_reads: bool = False,
+        verbosity: Optional[VerbosityPolicy] = None,
+    ):
         """Creates a JigClient for communicating over the given port with the
         Function Test Protocol. Methods will raise a JigClientException if a
         device does not respond to the protocol as expected.
 
+        Idempotent commands (see `is_idempotent`) that get a garbled or missing
+        echo, ack or body are retried after flushing the input and resyncing on
+        the prompt. How often this happens is counted in `retry_stats`.
+
         All communication with the device is recorded and can be retrieved via
-        `jig_client.log`.
+        `jig_client.log`, or per command via `jig_client.transcript`.
 
         :param port: The device to communicate over.
+        :param transcript: Where to record communication. A default one is created if not given.
+        :param cancel_token: If given, cancelling it makes any blocking call raise `Cancelled`
+                             within the parser's poll interval.
+        :param max_attempts: Maximum number of times to send an idempotent command.
+        :param retry_deadline: Seconds after the first attempt after which no more retries are made.
+        :param timeout_policy: If given, the timeout passed to `send_command` is treated as a ceiling and the
+                               policy picks the actual timeout from the durations it has seen before.
+        :param link_latency: Seconds added to every echo, ack and body timeout to allow for the
+                             round-trip to a device on the other end of a network connection.
+        :param cache_reads: Answer a read in `CACHED_COMMANDS` that's already been made from its previous
+                            response, until a command that changes it is sent (see `CACHE_INVALIDATED_BY`)
+                            or the device resets. How often this happens is counted in `cache_stats`.
+        :param verbosity: Whether test commands are run with their verbose output, see `run_test_cmd`.
+                          Always if not given.
         """
         self._port = port
-        self._write_timeout = 1
-        self._ack_timeout = 0.5
+        self._write_timeout = 1 + link_latency
+        self._ack_timeout = 0.5 + link_latency
+        self._link_latency = link_latency
         self._last_error = None
-        self._log = ""
-        self._terminator = "\r\n"
+        self._transcript = transcript if transcript is not None else Transcript()
+        # Set while the device is still running a command we stopped waiting for
+        self._resync_timer: Optional[Timeout] = None
+        self._resync_timeout = 2 + link_latency
         self._prompt = "> "
-        self._boot_header_separator = "=" * 62
-
-    @staticmethod
-    def _is_end_of_body(line: str) -> bool:
-        return line == "."
-
-    def skip_boot_header(self) -> None:
-        self._read_until_prompt(5)
-        time.sleep(0.1)
-
-    def _read_until_prompt(self, timeout: float) -> None:
-        # Read until the "prompt ("> ") is found.
-        # But if the prompt is in the first line read, will ignore that.
-        # The reason being, that's not the prompt we're after.
-        # That prompt is from the last command - not the one from the boot header
-        self._port.timeout = 0.1
+        self._cancel_token = cancel_token
+        self._parser = ProtocolParser(port, on_read=self._on_read, cancel_token=cancel_token)
+        self._max_attempts = max_attempts
+        self._retry_deadline = retry_deadline
+        self.retry_stats = RetryStats()
+        self._timeout_policy = timeout_policy
+        self._hooks: List[CommandHook] = []
+        self._cache_reads = cache_reads
+        # Keyed on the enabled external port (for `PORT_SCOPED_COMMANDS`) and the command
+        self._cache: Dict[Tuple[Optional[str], str], str] = {}
+        self._external_port: Optional[str] = None
+        self.cache_stats = CacheStats()
+        # The port enabled by `external_port`, and how many of its contexts are open
+        self._enabled_port: Optional[int] = None
+        self._port_users = 0
+        self.external_port_stats = ExternalPortStats()
+        self._verbosity = verbosity
+        self.verbosity_stats = VerbosityStats()
+
+    def skip_boot_header(self, timeout: float = 5) -> Optional[BootHeader]:
+        """Reads past the boot header of a device that's just been plugged in
+        or reset, returning as soon as it's complete. If there's no header,
+        eg. the device booted before the port was opened, stops at the next
+        prompt instead. A prompt in the first read is ignored as it's from
+        the last command rather than the boot.
+
+        :return: The header, None if there wasn't one.
+        """
+        self._reset_session_state()
+        mark(self._port, BOOT_HEADER_MARK)
+        recognizer = BootHeaderRecognizer(with_prompt=True)
         timer = Timeout(timeout)
-        lines_read = 0
-        while timer.active:
-            lines_read += 1
-            if self._readline() == self._prompt and lines_read > 1:
-                break
-
-    def read_boot_header(self, with_prompt: bool = True) -> str:
-        reading_header = False
-        header = ""
-
-        self._port.timeout = 0.1
-        timer = Timeout(2)
-
+        reads = 0
         while timer.active:
-            line = self._readline()
-
-            # Boot header separator is in the beginning and the end of the boot header.
-            # So we'll toggle-on the `reading_header` when we found the beginning separator
-            # and toggle-off it when we have end separator
-            if line == self._boot_header_separator:
-                reading_header = not reading_header
-                header += line + "\n"
+            reads += 1
+            token = self._next_token(min(0.1, timer.remaining))
+            if token is None:
                 continue
+            if recognizer.feed(token) or (token.kind == TokenKind.PROMPT and reads > 1):
+                break
+        return recognizer.header
 
-            if reading_header:
-                header += line + "\n"
+    def read_boot_header(self, with_prompt: bool = True, timeout: float = 2) -> Optional[BootHeader]:
+        """Waits for the boot header after the device is reset, returning as soon as it's complete.
 
-            if with_prompt and header and line == self._prompt:
-                header += line + "\n"
+        :param with_prompt: Whether the test firmware's header is only complete once its prompt follows.
+        :param timeout: Maximum seconds to wait for the header.
+        :return: The header, None if there wasn't one. It's missing the prompt if that didn't arrive in time.
+        """
+        self._reset_session_state()
+        mark(self._port, BOOT_HEADER_MARK)
+        return await_boot_header(self._next_token, timeout, with_prompt)
+
+    def _reset_session_state(self) -> None:
+        # The device is starting afresh
+        self._resync_timer = None
+        self.invalidate_cache()
+        # Its external ports start disabled
+        self._enabled_port = None
+        # At the default baud rate
+        self.restore_baudrate()
+
+    def negotiate_baudrate(self, baudrate: int, command: str = BAUD_COMMAND, revert_time: float = 1) -> bool:
+        """Switches the device, then the port, to a faster baud rate for bulk
+        output, eg. verbose test bodies and hwchunk dumps. The link is checked
+        with an echo round-trip at the new rate, and if that fails the port
+        goes back to the default rate, which the firmware returns to by itself
+        when no command arrives within `revert_time` of switching. The device
+        restarts at the default rate, see `restore_baudrate`.
+
+        :param command: Switches the device's rate, with `{baudrate}` replaced by the rate.
+        :param revert_time: Seconds after switching that the firmware goes back to the default rate
+                            unless a command has arrived.
+        :return: Whether the link is now at `baudrate`.
+        :raises JigClientException: If the device doesn't answer at either rate.
+        """
+        if self._port.baudrate == baudrate:
+            return True
+        try:
+            self.send_command(command.format(baudrate=baudrate), has_body=False)
+        except JigClient.CommandFailed as e:
+            logger.warning(f"Device can't switch to {baudrate} baud: {e.msg}")
+            return False
+        except JigClientException as e:
+            # It may or may not have switched, either way it'll be at the default rate after `revert_time`
+            logger.warning(f"Switching to {baudrate} baud failed: {e.msg}")
+        else:
+            self._port.baudrate = baudrate
+            if self._check_link():
+                logger.info(f"Switched to {baudrate} baud")
+                return True
+            logger.warning(f"Link failed at {baudrate} baud, falling back to {DEFAULT_BAUDRATE}")
+
+        self._port.baudrate = DEFAULT_BAUDRATE
+        if self._cancel_token is not None:
+            self._cancel_token.sleep(revert_time)
+        else:
+            time.sleep(revert_time)
+        self._flush_and_resync()
+        if not self._check_link():
+            raise JigClientException(f"Lost the device after trying {baudrate} baud")
+        return False
+
+    def restore_baudrate(self) -> None:
+        """Returns the port to the default baud rate the device restarts at.
+        It's done whenever a boot header is read, but call it before the
+        device is reset or flashed too so the header isn't garbled."""
+        if self._port.baudrate != DEFAULT_BAUDRATE:
+            logger.debug(f"Restoring {DEFAULT_BAUDRATE} baud")
+            self._port.baudrate = DEFAULT_BAUDRATE
+
+    def _check_link(self) -> bool:
+        try:
+            self._send_command(BAUD_CHECK_COMMAND, True, 2, None, None)
+        except JigClientException as e:
+            logger.debug(f"Link check failed: {e.msg}")
+            self._port.reset_input_buffer()
+            self._parser.reset()
+            return False
+        return True
 
-        return header.strip()
+    def _on_read(self, text: str) -> None:
+        self._transcript.append(text)
 
-    def _readline(self) -> str:
-        line = self._port.readline().decode("utf-8")
-        self._log += line
-        line = line.rstrip(self._terminator)
-        if line != "":
-            logger.debug("DEV: " + line)
-        return line
+    def _next_token(self, timeout: Optional[float]) -> Optional[Token]:
+        token = self._parser.next_token(timeout)
+        if token is not None and token.kind != TokenKind.PROMPT:
+            logger.debug("DEV: " + token.text)
+        return token
 
     def _writeline(self, line: str) -> None:
         logger.debug("JIG: " + line)
         line += "\r"
         self._port.write(f"{line}".encode("utf-8"))
-        self._log += line
+        self._transcript.append(line)
 
-    def _is_response_successful(self, body: str) -> bool:
+    @staticmethod
+    def _is_response_successful(body: str) -> bool:
         return body.strip().split("\n")[-1] == "PASS"
 
+    @staticmethod
+    def _parse_probe_port(resp: str) -> Optional[int]:
+        if "Found on port" not in resp:
+            return None
+        return int((resp.split(":", 1)[1]).strip())
+
     @property
-    def log(self):
-        return self._log
+    def cancel_token(self) -> Optional[CancelToken]:
+        """Cancelling it makes any blocking call raise `Cancelled`. It can be
+        replaced between commands, eg. to carry on using the client after a
+        cancelled command, which is resynced before the next one is sent."""
+        return self._cancel_token
 
-    def reset_logs(self):
-        self._log = ""
+    @cancel_token.setter
+    def cancel_token(self, cancel_token: Optional[CancelToken]) -> None:
+        self._cancel_token = cancel_token
+        self._parser.cancel_token = cancel_token
+
+    @property
+    def log(self) -> str:
+        return self._transcript.render()
 
-    def send_command(self, cmd: str, has_body: bool = True, timeout: Optional[float] = 2) -> str:
+    @property
+    def transcript(self) -> Transcript:
+        return self._transcript
+
+    def reset_logs(self):
+        self._transcript.clear()
+
+    def add_hook(self, hook: CommandHook) -> None:
+        """Registers a hook that's called before and after every command, eg. `LatencyHistogramHook`."""
+        self._hooks.append(hook)
+
+    def remove_hook(self, hook: CommandHook) -> None:
+        self._hooks.remove(hook)
+
+    def _begin_command(self, cmd: str) -> CommandRecord:
+        record = self._transcript.begin_command(cmd)
+        if self._hooks:
+            name, _, params = cmd.partition(" ")
+            event = CommandEvent(command=name, params=params, start=record.start, bytes_out=_bytes_out(cmd))
+            for hook in self._hooks:
+                hook.before(event)
+        return record
+
+    def _end_command(self, record: CommandRecord, outcome: str) -> None:
+        name, _, params = record.command.partition(" ")
+        event = CommandEvent(
+            command=name,
+            params=params,
+            start=record.start,
+            bytes_out=_bytes_out(record.command),
+            bytes_in=record.bytes_in,
+            ack_latency=record.ack_latency,
+            body_latency=record.body_latency,
+            outcome=outcome,
+        )
+        for hook in self._hooks:
+            hook.after(event)
+
+    def send_command(
+        self,
+        cmd: str,
+        has_body: bool = True,
+        timeout: Optional[float] = 2,
+        on_line: Optional[Callable[[str], None]] = None,
+        abort_when: Optional[Callable[[str], bool]] = None,
+    ) -> str:
         """Sends the given command to the device and returns
         the body from the response.
         :param cmd: the command to send, including any parameters.
         :param has_body: True if the command is expected to return a body.
         :param timeout: Timeout for reading from device
                         No timeout == (timeout <= 0)
+        :param on_line: Called with each line of the body as it arrives.
+        :param abort_when: Called with each line of the body as it arrives. If it
+                           returns True stop waiting and raise `CommandAborted`.
 
         :return: The body of the command's response, None if has_body
         was False.
         """
+        self._release_external_port([cmd])
+        key = self._cache_key(cmd) if on_line is None and abort_when is None else None
+        if key is not None:
+            if key in self._cache:
+                self.cache_stats.hits += 1
+                return self._cache[key]
+            self.cache_stats.misses += 1
+        self._update_cache(cmd, {})
+
+        body = self._with_retry([cmd], lambda: self._send_command(cmd, has_body, timeout, on_line, abort_when))
+        if key is not None:
+            self._cache[key] = body
+        return body
+
+    def _send_command(
+        self,
+        cmd: str,
+        has_body: bool,
+        timeout: Optional[float],
+        on_line: Optional[Callable[[str], None]],
+        abort_when: Optional[Callable[[str], bool]],
+    ) -> str:
+        if self._resync_timer is not None:
+            self._resync()
+        policy = self._timeout_policy
+        deadline = policy.timeout(cmd, timeout) if policy is not None else timeout
         self._port.write_timeout = self._write_timeout
-        self._port.timeout = self._ack_timeout
+        record = self._begin_command(cmd)
         self._writeline(cmd)
+        self._parser.expect_response(has_body)
+        try:
+            body = self._parse_response(record, has_body, self._with_latency(deadline), on_line, abort_when)
+        except JigClient.CommandTimeout:
+            if policy is not None:
+                policy.record_timeout(cmd, deadline, timeout)
+            raise
+        if policy is not None and has_body:
+            policy.record(cmd, record.duration)
+        return body
 
-        self._parse_command_echo(cmd)
-        self._parse_command_ack()
+    def send_commands(self, cmds: Sequence[Union[str, BatchCommand]], window: int = 4) -> List[str]:
+        """Sends the given commands to the device pipelined, writing up to
+        `window` commands ahead of the response being parsed rather than
+        waiting for each round-trip in turn. The device still executes the
+        commands in order.
+
+        If any command is rejected with `-ERR` the remaining responses are
+        still consumed, so the stream stays in sync, and then a
+        `CommandFailed` is raised for the first failing command with its
+        `cmd` and `index` set. A protocol error aborts the batch immediately,
+        although if every command in the batch is idempotent the whole batch is
+        retried first. Each command's timeout is picked by the timeout policy,
+        as with `send_command`.
+
+        :param cmds: the commands to send. Plain strings are expected to have a body.
+        :param window: the maximum number of commands in flight at once.
+        :return: The body of each command's response, in order.
+        """
+        commands = [c if isinstance(c, BatchCommand) else BatchCommand(c) for c in cmds]
+        self._release_external_port([c.cmd for c in commands])
+        results: List[Optional[str]] = [None] * len(commands)
+        # Indexes of the commands to send, and the cache key of those whose response is to be kept
+        sent: List[int] = []
+        keys: Dict[Tuple[Optional[str], str], int] = {}
+        for i, command in enumerate(commands):
+            key = self._cache_key(command.cmd)
+            if key is not None:
+                if key in self._cache:
+                    self.cache_stats.hits += 1
+                    results[i] = self._cache[key]
+                    continue
+                self.cache_stats.misses += 1
+            # A response is only kept if nothing later in the batch changes it
+            self._update_cache(command.cmd, keys)
+            if key is not None:
+                keys[key] = i
+            sent.append(i)
+        if not sent:
+            return results
+
+        batch = [commands[i] for i in sent]
+        try:
+            bodies = self._with_retry([c.cmd for c in batch], lambda: self._send_batch(batch, window))
+        except JigClient.CommandFailed as e:
+            if e.index is not None:
+                e.index = sent[e.index]
+            raise
+        for i, body in zip(sent, bodies):
+            results[i] = body
+        for key, i in keys.items():
+            self._cache[key] = results[i]
+        return results
+
+    def _send_batch(self, commands: List[BatchCommand], window: int) -> List[str]:
+        batch: Deque[BatchCommand] = deque(commands)
+        in_flight: Deque[Tuple[BatchCommand, CommandRecord]] = deque()
+        results: List[str] = []
+        failure: Optional[JigClient.CommandFailed] = None
+
+        if self._resync_timer is not None:
+            self._resync()
+        policy = self._timeout_policy
+        self._port.write_timeout = self._write_timeout
+        while batch or in_flight:
+            while batch and len(in_flight) < max(window, 1):
+                command = batch.popleft()
+                record = self._begin_command(command.cmd)
+                self._writeline(command.cmd)
+                self._parser.expect_response(command.has_body)
+                in_flight.append((command, record))
+
+            command, record = in_flight.popleft()
+            index = len(results)
+            deadline = policy.timeout(command.cmd, command.timeout) if policy is not None else command.timeout
+            try:
+                results.append(self._parse_response(record, command.has_body, self._with_latency(deadline)))
+            except JigClient.CommandFailed as e:
+                results.append("")
+                if failure is None:
+                    failure = JigClient.CommandFailed(e.msg, cmd=command.cmd, index=index)
+                continue
+            except JigClient.CommandTimeout as e:
+                if policy is not None:
+                    policy.record_timeout(command.cmd, deadline, command.timeout)
+                raise JigClient.CommandTimeout(f"{e.msg} (in batch at `{command.cmd}`)")
+            except JigClientException as e:
+                raise JigClientException(f"{e.msg} (in batch at `{command.cmd}`)")
+            if policy is not None and command.has_body:
+                # Includes any time spent queued behind the commands ahead of it, so errs long
+                policy.record(command.cmd, record.duration)
+
+        if failure is not None:
+            raise failure
+        return results
+
+    def invalidate_cache(self) -> None:
+        """Forgets every cached response, eg. because the device was reset or reflashed."""
+        self.cache_stats.invalidations += len(self._cache)
+        self._cache.clear()
+        self._external_port = None
+
+    def _cache_key(self, cmd: str) -> Optional[Tuple[Optional[str], str]]:
+        if not self._cache_reads or not cmd.startswith(CACHED_COMMANDS):
+            return None
+        return (self._external_port if cmd.startswith(PORT_SCOPED_COMMANDS) else None, cmd)
+
+    def _update_cache(self, cmd: str, pending: Dict[Tuple[Optional[str], str], int]) -> None:
+        # Called before a command is sent. `pending` are reads that haven't been cached yet.
+        if cmd.startswith("port-enable "):
+            self._external_port = cmd.split(" ", 1)[1]
+            return
+        for prefix, invalidated in CACHE_INVALIDATED_BY.items():
+            if cmd.startswith(prefix):
+                for key in [key for key in self._cache if key[1].startswith(invalidated)]:
+                    del self._cache[key]
+                    self.cache_stats.invalidations += 1
+                for key in [key for key in pending if key[1].startswith(invalidated)]:
+                    del pending[key]
+
+    def _with_latency(self, timeout: Optional[float]) -> Optional[float]:
+        # No timeout stays no timeout
+        return timeout + self._link_latency if timeout else timeout
+
+    def _with_retry(self, cmds: List[str], send: Callable[[], T]) -> T:
+        # Only protocol errors are retried. `-ERR` responses, aborts and
+        # cancellation are all the device (or us) answering properly.
+        if not all(is_idempotent(cmd) for cmd in cmds):
+            return send()
+
+        timer = Timeout(self._retry_deadline)
+        attempt = 1
+        while True:
+            try:
+                result = send()
+            except JigClient.CommandAborted:
+                raise
+            except JigClientException as e:
+                if attempt >= self._max_attempts or timer.expired:
+                    if attempt > 1:
+                        self.retry_stats.exhausted += 1
+                    raise
+                logger.warning(f"{e.msg}, retrying `{cmds[0]}` (attempt {attempt + 1} of {self._max_attempts})")
+                self.retry_stats.retries += 1
+                attempt += 1
+                self._flush_and_resync()
+                continue
 
+            if attempt > 1:
+                self.retry_stats.recovered += 1
+                logger.info(f"`{cmds[0]}` succeeded after {attempt} attempts, {self.retry_stats}")
+            return result
+
+    def _flush_and_resync(self) -> None:
+        # Throw away whatever garbled data we have, then let the device finish
+        # sending whatever is left of the response, up to its next prompt. If
+        # the prompt was already flushed we stop once the line goes quiet.
+        self._resync_timer = None
+        self._port.reset_input_buffer()
+        self._parser.reset()
+        timer = Timeout(self._resync_timeout)
+        while timer.active:
+            token = self._next_token(min(self._ack_timeout, timer.remaining))
+            if token is None or token.kind == TokenKind.PROMPT:
+                return
+
+    def _resync(self) -> None:
+        # Discard the rest of an aborted command's response, up to the next prompt
+        timer = self._resync_timer
+        self._resync_timer = None
+        while not timer.expired:
+            try:
+                token = self._next_token(timer.remaining)
+            except Cancelled:
+                self._resync_timer = Timeout(self._resync_timeout)
+                raise
+            if token is not None and token.kind == TokenKind.PROMPT:
+                return
+        raise JigClientException("Could not resync with device after an aborted command")
+
+    def _parse_response(
+        self,
+        record: CommandRecord,
+        has_body: bool,
+        timeout: Optional[float],
+        on_line: Optional[Callable[[str], None]] = None,
+        abort_when: Optional[Callable[[str], bool]] = None,
+    ) -> str:
+        ack = None
         body = None
-        if has_body:
-            body = self._parse_command_body(timeout)
+        outcome = OUTCOME_OK
+        echo_offset = None
+        try:
+            echo_offset = self._parse_command_echo(record.command)
+            ack = self._parse_command_ack()
+            record.acked = time.monotonic()
+
+            if has_body:
+                body = self._parse_command_body(timeout, on_line, abort_when)
+        except JigClient.CommandFailed as e:
+            ack = f"-ERR{e.msg}"
+            outcome = OUTCOME_ERROR
+            raise
+        except JigClientException as e:
+            # The stream is out of sync with what we've sent
+            self._parser.clear_expected()
+            if isinstance(e, JigClient.CommandAborted):
+                outcome = OUTCOME_ABORTED
+            elif isinstance(e, JigClient.CommandTimeout):
+                outcome = OUTCOME_TIMEOUT
+            else:
+                outcome = OUTCOME_PROTOCOL_ERROR
+            raise
+        except Cancelled:
+            # The device is still running the command, resync before the next one
+            # if the client is used again with another token
+            self._parser.clear_expected()
+            self._resync_timer = Timeout(self._resync_timeout)
+            outcome = OUTCOME_CANCELLED
+            raise
+        finally:
+            self._transcript.end_command(record, ack, body.count("\n") + 1 if body else 0)
+            if echo_offset is not None:
+                # Counted from the parser rather than the transcript, which also holds any commands
+                # written while this one was in flight, see `send_commands`
+                record.bytes_in = self._parser.consumed - echo_offset
+            if self._hooks:
+                self._end_command(record, outcome)
 
         return body or ""
 
-    def _parse_command_echo(self, cmd):
+    def _parse_command_echo(self, cmd) -> int:
         # Parse command echo. Ignore any prompt at the start of the
-        # response if present
-        line = self._readline()
-        if line.lstrip(self._prompt) != cmd:
+        # response if present. Returns the parser's offset at the start of the echo.
+        token = self._next_token(self._ack_timeout)
+        while token is not None and token.kind == TokenKind.PROMPT:
+            token = self._next_token(self._ack_timeout)
+        line = token.text if token is not None else ""
+        if token is None or token.kind != TokenKind.ECHO or line.lstrip(self._prompt) != cmd:
             raise JigClientException(f"Line not echoed back: {line}")
+        return self._parser.token_offset
 
     def _parse_command_ack(self):
         # Parse command acknowledgement
-        ack = self._readline()
-        if ack.startswith("-ERR"):
+        token = self._next_token(self._ack_timeout)
+        ack = token.text if token is not None else ""
+        if token is not None and token.kind == TokenKind.ERROR:
             raise JigClient.CommandFailed(ack[4:])  # Strip -ERR prefix
-        elif ack != "+OK":
+        elif token is None or token.kind != TokenKind.ACK:
             raise JigClientException(f"Command not acknowledged: {ack}")
-
-    def _parse_command_body(self, timeout: Optional[float]):
+        return ack
+
+    def _parse_command_body(
+        self,
+        timeout: Optional[float],
+        on_line: Optional[Callable[[str], None]] = None,
+        abort_when: Optional[Callable[[str], bool]] = None,
+    ):
         # Parse command body
-        line = ""
+        token = None
         lines = []
 
         timer = Timeout(timeout) if timeout else TimeoutNever()
 
         while not timer.expired:
-            self._port.timeout = timer.remaining
-            line = self._readline()
+            token = self._next_token(timer.remaining)
+            if token is None:
+                continue
 
-            if self._is_end_of_body(line):
+            if token.kind == TokenKind.BODY_END:
                 break
 
-            if len(line) != 0:
-                lines.append(line)
+            if token.kind == TokenKind.BODY:
+                lines.append(token.text)
+                if on_line is not None:
+                    on_line(token.text)
+                if abort_when is not None and abort_when(token.text):
+                    # The device won't stop, so wait for its prompt (within the
+                    # command's own deadline) before the next command
+                    self._resync_timer = timer if timeout else Timeout(self._resync_timeout)
+                    raise JigClient.CommandAborted(token.text, "\n".join(lines))
 
         body = "\n".join(lines)
 
         # We didn't receive the end of body marker before timeout
-        if not self._is_end_of_body(line):
-            raise JigClientException("Did not receive end of body marker")
+        if token is None or token.kind != TokenKind.BODY_END:
+            raise JigClient.CommandTimeout("Did not receive end of body marker")
 
         return body
 
@@ -209,16 +791,91 @@ class JigClient:
     def enable_external_port(self, port_number: int):
         """Need to run these commands in-order to enable
         external ports to read hw-spec"""
-        self.platform("prp-enable")
-        self.platform("extern-ports-enable")
-        self.send_command(f"port-enable {port_number}", False)
+        # Directly enabled ports are the caller's to disable
+        self._enabled_port = None
+        self.send_commands(
+            [
+                BatchCommand("platform prp-enable", has_body=False),
+                BatchCommand("platform extern-ports-enable", has_body=False),
+                BatchCommand(f"port-enable {port_number}", has_body=False),
+            ]
+        )
 
     def disable_external_port(self):
         """After doing what we want, we need to disable
         previously enabled external ports"""
-        self.send_command("port-enable none", False)
-        self.platform("extern-ports-disable")
-        self.platform("prp-disable")
+        self._enabled_port = None
+        self.send_commands(
+            [
+                BatchCommand("port-enable none", has_body=False),
+                BatchCommand("platform extern-ports-disable", has_body=False),
+                BatchCommand("platform prp-disable", has_body=False),
+            ]
+        )
+
+    @contextmanager
+    def external_port(self, port_number: int) -> Iterator[None]:
+        """Enables the given external port for the commands in the context.
+
+        The port is left enabled when the context exits, so consecutive
+        contexts for the same port (eg. one per state of a unit) don't switch
+        it off and on again. It's disabled before the next command that isn't
+        in `PORT_INDEPENDENT_COMMANDS`, when a different port is requested, or
+        straight away if the context exits with an exception. Contexts for the
+        same port can be nested. How many commands were saved is counted in
+        `external_port_stats`.
+        """
+        if self._port_users and self._enabled_port != port_number:
+            raise ValueError(f"External port {self._enabled_port} is in use, can't enable port {port_number}")
+        if self._enabled_port == port_number:
+            # Neither the disable after the last context nor the enable for this one is needed
+            if not self._port_users:
+                self.external_port_stats.commands_saved += 2 * EXTERNAL_PORT_COMMANDS
+        else:
+            if self._enabled_port is not None:
+                self._disable_left_port()
+            self.enable_external_port(port_number)
+            self._enabled_port = port_number
+            self.external_port_stats.enables += 1
+
+        self._port_users += 1
+        try:
+            yield
+        except BaseException as e:
+            self._port_users -= 1
+            if not self._port_users:
+                try:
+                    self._disable_left_port()
+                except Cancelled:
+                    # The session is over, the device disables the port itself when it's reset
+                    logger.warning(f"Unable to disable external port {port_number}")
+                except JigClientException as disable_error:
+                    # The port may still be enabled, so whatever failed, the caller can't carry on as if it isn't
+                    raise JigClientException(f"Unable to disable external port {port_number}") from disable_error
+            raise
+        self._port_users -= 1
+
+    def release_external_port(self) -> None:
+        """Disables the port left enabled by `external_port` now, rather than
+        before the next command that depends on it, eg. once a unit has failed.
+
+        :raises JigClientException: If the port couldn't be disabled.
+        """
+        if self._enabled_port is not None and not self._port_users:
+            self._disable_left_port()
+
+    def _release_external_port(self, cmds: List[str]) -> None:
+        # Called before any command is sent, to disable a port left enabled
+        # by `external_port` unless the commands don't care
+        if self._enabled_port is None or self._port_users:
+            return
+        if all(cmd.startswith(PORT_INDEPENDENT_COMMANDS) for cmd in cmds):
+            return
+        self._disable_left_port()
+
+    def _disable_left_port(self) -> None:
+        self.external_port_stats.disables += 1
+        self.disable_external_port()
 
     def hwspec_load(self, target: str) -> bool:
         """Sends a `hwspec-load` command to the device.
@@ -238,6 +895,13 @@ class JigClient:
         """
         return self.send_command(f"hwspec-get {key}")
 
+    def hwspec_get_many(self, keys: Sequence[str]) -> Dict[str, str]:
+        """Sends a pipelined batch of `hwspec-get` commands to the device.
+        :param keys: the keys to read
+        :return: The response body for each key.
+        """
+        return dict(zip(keys, self.send_commands([f"hwspec-get {key}" for key in keys])))
+
     def hwspec_set(self, key: str, value: str) -> str:
         """Sends a `hwspec-set` command to the device.
         :param key: the key to write
@@ -246,6 +910,12 @@ class JigClient:
         """
         return self.send_command(f"hwspec-set {key} {value}", has_body=False)
 
+    def hwspec_set_many(self, values: Dict[str, str]) -> None:
+        """Sends a pipelined batch of `hwspec-set` commands to the device.
+        :param values: the values to write against each key
+        """
+        self.send_commands([BatchCommand(f"hwspec-set {key} {value}", has_body=False) for key, value in values.items()])
+
     def hwspec_save(self, target: str) -> str:
         """Sends a `hwspec-set` command to the device.
         :param target: the target to save the hwspec to
@@ -260,44 +930,50 @@ class JigClient:
         """
         return self.send_command(f"hwspec-destroy {target}", has_body=False)
 
-    def test_ta3k(self, port: int, min_threshold: float) -> bool:
+    def test_ta3k(self, port: int, min_threshold: float, **kwargs) -> bool:
         """Run `test-ta3k` command on the given port
         :param port: Port number as an int
+        :param kwargs: `on_line`, `abort_when` and `measurements`, see `run_test_cmd`
         :return bool: If test command is a pass or fail
         """
-        return self.run_test_cmd(f"test-ta3k -v -a {min_threshold} {_to_port_flags(port)} 1", timeout=20)
+        return self.run_test_cmd(f"test-ta3k -v -a {min_threshold} {_to_port_flags(port)} 1", timeout=20, **kwargs)
 
-    def test_ta6k(self, port: int, min_threshold: float) -> bool:
+    def test_ta6k(self, port: int, min_threshold: float, **kwargs) -> bool:
         """Run `test-ta6k` command on the given port
         :param port: Port number as an int
+        :param kwargs: `on_line`, `abort_when` and `measurements`, see `run_test_cmd`
         :return bool: If test command is a pass or fail
         """
-        return self.run_test_cmd(f"test-ta6k -v -a {min_threshold} {_to_port_flags(port)} 1", timeout=10)
+        return self.run_test_cmd(f"test-ta6k -v -a {min_threshold} {_to_port_flags(port)} 1", timeout=10, **kwargs)
 
-    def test_ta11k(self, port: int, min_threshold: float) -> bool:
+    def test_ta11k(self, port: int, min_threshold: float, **kwargs) -> bool:
         """Run `test-ta11k` command on the given port
         :param port: Port number as an int
+        :param kwargs: `on_line`, `abort_when` and `measurements`, see `run_test_cmd`
         :return bool: If test command is a pass or fail
         """
-        return self.run_test_cmd(f"test-ta11k -v -a {min_threshold} {_to_port_flags(port)} 1", timeout=10)
+        return self.run_test_cmd(f"test-ta11k -v -a {min_threshold} {_to_port_flags(port)} 1", timeout=10, **kwargs)
 
-    def test_self(self) -> bool:
+    def test_self(self, **kwargs) -> bool:
         """Run `test-self` command on the device
+        :param kwargs: `on_line`, `abort_when` and `measurements`, see `run_test_cmd`
         :return bool: If test command is a pass or fail
         """
-        return self.run_test_cmd("test-self -v", timeout=10)
+        return self.run_test_cmd("test-self -v", timeout=10, **kwargs)
 
-    def test_port(self) -> bool:
+    def test_port(self, **kwargs) -> bool:
         """Run `test-port` command on all ports of the device
+        :param kwargs: `on_line`, `abort_when` and `measurements`, see `run_test_cmd`
         :return bool: If test command is a pass or fail
         """
-        return self.run_test_cmd("test-port -v 0x0f 1", timeout=60)
+        return self.run_test_cmd("test-port -v 0x0f 1", timeout=60, **kwargs)
 
-    def test_lora_connect(self, sub_band: str, join_eui: str, app_key: str) -> bool:
+    def test_lora_connect(self, sub_band: str, join_eui: str, app_key: str, **kwargs) -> bool:
         """Run `test-lora-connect` command on the device
+        :param kwargs: `on_line`, `abort_when` and `measurements`, see `run_test_cmd`
         :return bool: If test command is a pass or fail
         """
-        return self.run_test_cmd(f"test-lora-connect {sub_band} {join_eui} {app_key}", timeout=90)
+        return self.run_test_cmd(f"test-lora-connect {sub_band} {join_eui} {app_key}", timeout=90, **kwargs)
 
     def probe_await_connect(self) -> Optional[int]:
         """Sends `probe-await connect` command to the device.
@@ -305,9 +981,7 @@ class JigClient:
         :return: Optional connected port number.
         """
         resp = self.send_command("probe-await connect", timeout=None)
-        if "Found on port" not in resp:
-            return None
-        return int((resp.split(":", 1)[1]).strip())
+        return self._parse_probe_port(resp)
 
     def probe_await_recovery(self):
         """Sends `probe-await recovery` command to the device.
@@ -316,7 +990,14 @@ class JigClient:
         """
         return self.send_command("probe-await recovery", timeout=None)
 
-    def run_test_cmd(self, cmd: str, timeout: int = 2) -> bool:
+    def run_test_cmd(
+        self,
+        cmd: str,
+        timeout: int = 2,
+        on_line: Optional[Callable[[str], None]] = None,
+        abort_when: Optional[Callable[[str], bool]] = None,
+        measurements: Optional[Measurements] = None,
+    ) -> bool:
         """Runs the given test command and whether it passed or
         not. The test command is expected to conform to the standard
         test output - the last line of the body should be either
@@ -324,10 +1005,85 @@ class JigClient:
 
         :param cmd: the command str to send, including parameters.
         :param timeout: The timeout for each command
+        :param on_line: Called with each line of output as it arrives.
+        :param abort_when: Called with each line of output as it arrives. If it
+                           returns True the test is failed without waiting for it
+                           to finish, eg. `abort_on_failure`.
+        :param measurements: If given, the readings in the verbose output are added to it,
+                             including those before an abort.
         :return: True if the test passed, false otherwise.
+
+        The verbosity policy decides whether a command with `-v` is run with it.
+        When it's run quiet and fails it may be run again verbose, for the
+        diagnostics, but it's failed whatever the second run's result. The
+        second run isn't aborted by `abort_when`, so all of them are collected.
+
+        A test that times out has failed, rather than raising `CommandTimeout`.
         """
-        resp = self.send_command(cmd, timeout=timeout)
-        return self._is_response_successful(resp)
+        policy = self._verbosity
+        if policy is None or VERBOSE_FLAG not in cmd.split(" ") or policy.verbose_first(cmd):
+            return self._run_test_cmd(cmd, True, timeout, on_line, abort_when, measurements)
+
+        quiet = with_verbose(cmd, False)
+        passed = self._run_test_cmd(quiet, False, timeout, on_line, abort_when, measurements)
+        self.verbosity_stats.quiet_runs += 1
+        if passed or not policy.rerun_on_failure:
+            return passed
+
+        logger.info(f"`{quiet}` failed, running it again verbose")
+        self.verbosity_stats.reruns += 1
+        # Not aborted early, as the rerun is there to collect all of the test's diagnostics
+        start, size = time.monotonic(), len(self._transcript)
+        if self._run_test_cmd(cmd, True, timeout, on_line, None, measurements):
+            logger.warning(f"`{cmd}` passed when run again verbose")
+        # Run verbose to begin with it could have been aborted at the first failure, so all of the rerun is extra
+        self.verbosity_stats.seconds_saved -= time.monotonic() - start
+        self.verbosity_stats.bytes_saved -= len(self._transcript) - size
+        return False
+
+    def _run_test_cmd(
+        self,
+        cmd: str,
+        verbose: bool,
+        timeout: int,
+        on_line: Optional[Callable[[str], None]],
+        abort_when: Optional[Callable[[str], bool]],
+        measurements: Optional[Measurements],
+    ) -> bool:
+        start, size = time.monotonic(), len(self._transcript)
+        try:
+            resp = self.send_command(cmd, timeout=timeout, on_line=on_line, abort_when=abort_when)
+        except JigClient.CommandAborted as e:
+            logger.info(f"Aborted `{cmd}` early at: {e.line}")
+            resp = e.body
+            passed = False
+        except JigClient.CommandTimeout as e:
+            # A test that doesn't finish in time has failed, the device hasn't been lost.
+            # It may still be running, so its output is discarded before the next command.
+            logger.error(f"`{cmd}` timed out: {e.msg}")
+            self._resync_timer = Timeout(self._resync_timeout)
+            resp = ""
+            passed = False
+        else:
+            passed = self._is_response_successful(resp)
+        if measurements is not None:
+            measurements.parse(cmd.split(" ", 1)[0], resp)
+        if self._verbosity is not None:
+            self._record_verbosity(cmd, verbose, passed, time.monotonic() - start, len(self._transcript) - size)
+        return passed
+
+    def _record_verbosity(self, cmd: str, verbose: bool, passed: bool, seconds: float, size: int) -> None:
+        self._verbosity.record(cmd, verbose, seconds, size)
+        cost = self._verbosity.verbose_cost(cmd)
+        if verbose or cost is None:
+            return
+        if passed or not self._verbosity.rerun_on_failure:
+            self.verbosity_stats.seconds_saved += cost[0] - seconds
+            self.verbosity_stats.bytes_saved += cost[1] - size
+        else:
+            # It'll be run again verbose, so the quiet run was extra
+            self.verbosity_stats.seconds_saved -= seconds
+            self.verbosity_stats.bytes_saved -= size
 
     def lora_deveui(self) -> str:
         """Sends a `lora-deveui` command to the device.
@@ -373,6 +1129,17 @@ class JigClient:
         """
         return self.send_command(f"pulse-cfg set pulse {key} {value}")
 
+    def pulse_cfg_apply(self, pulse_values: Dict[str, int]) -> None:
+        """Pipelines the full pulse configuration sequence to the device:
+        `pulse-cfg init`, `pulse-cfg load`, a `pulse-cfg set pulse` for each
+        value and finally `pulse-cfg save`.
+        :param pulse_values: the values to write against each pulse key
+        """
+        cmds = ["pulse-cfg init", "pulse-cfg load"]
+        cmds += [f"pulse-cfg set pulse {key} {value}" for key, value in pulse_values.items()]
+        cmds.append("pulse-cfg save")
+        self.send_commands(cmds)
+
     def firmware_version(self) -> str:
         """Sends a `firmware_version` command to the device.
         :return: The command's response body.
@@ -392,6 +1159,13 @@ class JigClient:
         """
         return self.send_command(f"hwchunk write probe probe {cable_length}")
 
+    def hwchunk_write_probe_and_verify(self, cable_length: int) -> bool:
+        """Pipelines a write to the "probe" chunk of a probe with the
+        `hwchunk verify probe` that follows it.
+        :return bool: If the chunk list is correct and all CRCs match."""
+        _, resp = self.send_commands([f"hwchunk write probe probe {cable_length}", "hwchunk verify probe"])
+        return self._is_response_successful(resp)
+
     def hwchunk_verify(self, target: str) -> bool:
         """Sends hwchunk verify command to the device
         :target: Target device pulse or probe
@@ -413,7 +1187,5 @@ class JigClient:
         :return: if found, the path to the device (eg. /dev/ttyACM1), otherwise
         None if not found.
         """
-        for p in comports():
-            if p.vid == 0x0D28 and p.pid == 0x0204:
-                return p.device
-        return None
+        devices = list_devices()
+        return devices[0].path if devices else None
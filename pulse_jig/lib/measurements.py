@@ -0,0 +1,149 @@
+import math
+import re
+from array import array
+from typing import Dict, Iterator, List, NamedTuple, Optional
+
+# Verbose test output is expected to report a reading per line as `name=value` pairs, eg.
+#   port 1 ch 0: adc=0.512 min=0.400 PASS
+# This hasn't been checked against the test firmware yet, lines without a `=`, eg. `port 1...OK`, give no readings
+# Keys that name a limit rather than a reading
+LIMIT_KEYS = ("min", "max", "limit", "threshold")
+
+_PORT = re.compile(r"\bport\s*(\d+)")
+_CHANNEL = re.compile(r"\bch(?:annel)?\s*(\d+)")
+_READING = re.compile(r"([A-Za-z_]\w*)\s*=\s*(-?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?)")
+_VERDICTS = {"PASS": 1, "OK": 1, "FAIL": 0}
+
+# `passed` of a reading without a verdict on its line
+UNKNOWN = -1
+# Largest port or channel number that can be stored, lines with a larger one are skipped
+MAX_INDEX = 2**15 - 1
+
+
+class Measurement(NamedTuple):
+    test: str
+    name: str
+    port: Optional[int]
+    channel: Optional[int]
+    value: float
+    limit: Optional[float]
+    passed: Optional[bool]
+
+
+class Measurements:
+    """
+    Numeric readings extracted from the verbose output of test commands,
+    eg. `test-port -v`. Readings are stored column-wise in typed arrays, so a
+    unit's worth stays small however many lines the firmware prints. Missing
+    ports and channels are stored as -1 and missing limits as NaN.
+    """
+
+    def __init__(self):
+        self._names: List[str] = []
+        self._name_index: Dict[str, int] = {}
+        self._tests = array("H")
+        self._keys = array("H")
+        self.ports = array("h")
+        self.channels = array("h")
+        self.values = array("d")
+        self.limits = array("d")
+        self.passed = array("b")
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def __iter__(self) -> Iterator[Measurement]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, i: int) -> Measurement:
+        port, channel, limit, passed = self.ports[i], self.channels[i], self.limits[i], self.passed[i]
+        return Measurement(
+            self._names[self._tests[i]],
+            self._names[self._keys[i]],
+            None if port < 0 else port,
+            None if channel < 0 else channel,
+            self.values[i],
+            None if math.isnan(limit) else limit,
+            None if passed == UNKNOWN else bool(passed),
+        )
+
+    def clear(self) -> None:
+        self.__init__()
+
+    def append(self, measurement: Measurement) -> None:
+        self._tests.append(self._intern(measurement.test))
+        self._keys.append(self._intern(measurement.name))
+        self.ports.append(-1 if measurement.port is None else measurement.port)
+        self.channels.append(-1 if measurement.channel is None else measurement.channel)
+        self.values.append(measurement.value)
+        self.limits.append(math.nan if measurement.limit is None else measurement.limit)
+        self.passed.append(UNKNOWN if measurement.passed is None else int(measurement.passed))
+
+    def parse(self, test: str, body: str) -> int:
+        """Adds the readings in the body of a test command's response.
+
+        :param test: The test command, eg. `test-port`, the readings are recorded against.
+        :return: The number of readings added.
+        """
+        count = len(self)
+        for line in body.split("\n"):
+            # Only lines with a reading are worth running the expressions over
+            if "=" in line:
+                self._parse_line(test, line)
+        return len(self) - count
+
+    def failed(self) -> List[Measurement]:
+        return [self[i] for i in range(len(self)) if self.passed[i] == 0]
+
+    def to_dict(self) -> Dict[str, list]:
+        """Column-wise plain lists, eg. for submitting as JSON. Missing values are None."""
+        return {
+            "test": [self._names[i] for i in self._tests],
+            "name": [self._names[i] for i in self._keys],
+            "port": [None if port < 0 else port for port in self.ports],
+            "channel": [None if channel < 0 else channel for channel in self.channels],
+            "value": self.values.tolist(),
+            "limit": [None if math.isnan(limit) else limit for limit in self.limits],
+            "passed": [None if passed == UNKNOWN else bool(passed) for passed in self.passed],
+        }
+
+    def _intern(self, name: str) -> int:
+        index = self._name_index.get(name)
+        if index is None:
+            index = self._name_index[name] = len(self._names)
+            self._names.append(name)
+        return index
+
+    def _parse_line(self, test: str, line: str) -> None:
+        readings = _READING.findall(line)
+        limit = None
+        values = []
+        for key, value in readings:
+            if key.lower() in LIMIT_KEYS:
+                limit = float(value)
+            else:
+                values.append((key, float(value)))
+        if not values:
+            return
+
+        port = _PORT.search(line)
+        channel = _CHANNEL.search(line)
+        port = int(port.group(1)) if port else None
+        channel = int(channel.group(1)) if channel else None
+        if (port or 0) > MAX_INDEX or (channel or 0) > MAX_INDEX:
+            return
+        words = line.replace(".", " ").split()
+        passed = _VERDICTS.get(words[-1]) if words else None
+        for key, value in values:
+            self.append(
+                Measurement(
+                    test,
+                    key,
+                    port,
+                    channel,
+                    value,
+                    limit,
+                    None if passed is None else bool(passed),
+                )
+            )
@@ -0,0 +1,335 @@
+import logging
+import os
+import re
+import select
+import subprocess
+import time
+from typing import Callable, List, Optional, Set
+
+from .cancel import CancelToken
+from .firmware_store import FirmwareImage
+from .timeout import Timeout, TimeoutNever
+
+logger = logging.getLogger(__name__)
+
+# The kernel's mount table for this process, which polls as POLLPRI whenever it changes
+MOUNTINFO = "/proc/self/mountinfo"
+
+# How often readiness is rechecked, the mount table changing wakes the wait sooner
+_CHECK_INTERVAL = 0.05
+
+# Written and removed to check that the volume accepts writes
+_PROBE_NAME = ".jig-probe"
+
+
+def _unescape(field: str) -> str:
+    # mountinfo escapes space, tab, newline and backslash as \ooo
+    return re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), field)
+
+
+def mount_points(mountinfo: str = MOUNTINFO) -> Optional[Set[str]]:
+    """The mount points in the mount table, None if it can't be read, eg. on macOS."""
+    try:
+        with open(mountinfo) as f:
+            return {_unescape(line.split(" ")[4]) for line in f if line.strip()}
+    except OSError:
+        return None
+
+
+def free_bytes(path: str) -> int:
+    """Space available to write to the filesystem at the path, 0 if it can't be determined."""
+    try:
+        stat = os.statvfs(path)
+    except OSError:
+        return 0
+    return stat.f_bavail * stat.f_frsize
+
+
+def probe_write(path: str) -> bool:
+    """Whether a small file can be written to, and removed from, the directory."""
+    probe = os.path.join(path, _PROBE_NAME)
+    try:
+        with open(probe, "wb") as f:
+            f.write(b"\0")
+            f.flush()
+            os.fsync(f.fileno())
+        os.remove(probe)
+        return True
+    except OSError as e:
+        logger.debug(f"probe write to {path} failed: {e}")
+        return False
+
+
+class _MountTableWatcher:
+    """Waits for the mount table to change, or just sleeps if it can't be watched."""
+
+    def __init__(self, mountinfo: str):
+        self._file = None
+        self._poll = None
+        try:
+            self._file = open(mountinfo)
+            self._poll = select.poll()
+            self._poll.register(self._file, select.POLLPRI | select.POLLERR)
+        except (OSError, AttributeError):
+            self.close()
+
+    def wait(self, timeout: float, cancel: Optional[CancelToken]) -> None:
+        if self._poll is None:
+            if cancel is not None:
+                cancel.sleep(timeout)
+            else:
+                time.sleep(timeout)
+            return
+        # Returns early once something is mounted or unmounted
+        self._poll.poll(timeout * 1000)
+        if cancel is not None:
+            cancel.raise_if_cancelled()
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+        self._file = None
+        self._poll = None
+
+
+def await_mount_ready(
+    path: str,
+    timeout: Optional[float],
+    cancel: Optional[CancelToken] = None,
+    min_free: int = 1,
+    probe: bool = False,
+    mountinfo: str = MOUNTINFO,
+    free_space: Callable[[str], int] = free_bytes,
+) -> Optional[float]:
+    """Blocks until the volume at the path can be written to.
+
+    That's once it's in the mount table, reports at least `min_free` bytes
+    available (a freshly automounted xDot reports none for a while) and,
+    if `probe`, a small file can be written to it. Where the mount table
+    can't be read the volume only has to exist and be writable.
+
+    :param timeout: Maximum seconds to wait. None to wait indefinitely.
+    :param cancel: If cancelled, raise `Cancelled` promptly
+    :return: Seconds it took to become ready, None if it wasn't in time.
+    """
+    start = time.monotonic()
+    timer = Timeout(timeout) if timeout is not None else TimeoutNever()
+    mount_point = os.path.realpath(path)
+    watcher = _MountTableWatcher(mountinfo)
+    try:
+        while True:
+            if cancel is not None:
+                cancel.raise_if_cancelled()
+            if _is_ready(path, mount_point, min_free, probe, mountinfo, free_space):
+                return time.monotonic() - start
+            if timer.expired:
+                return None
+            remaining = timer.remaining
+            watcher.wait(_CHECK_INTERVAL if remaining is None else max(0, min(_CHECK_INTERVAL, remaining)), cancel)
+    finally:
+        watcher.close()
+
+
+def _is_ready(
+    path: str, mount_point: str, min_free: int, probe: bool, mountinfo: str, free_space: Callable[[str], int]
+) -> bool:
+    if not (os.path.exists(path) and os.access(path, os.W_OK)):
+        return False
+    mounted = mount_points(mountinfo)
+    if mounted is not None and mount_point not in mounted:
+        return False
+    if free_space(path) < min_free:
+        return False
+    return not probe or probe_write(path)
+
+
+class FlashError(Exception):
+    """The firmware couldn't be written to the xDot's volume, or the xDot reported that flashing it failed."""
+
+
+# Written to the volume by the xDot's interface firmware (DAPLink) when flashing fails
+FAIL_FILE = "FAIL.TXT"
+
+# Mount options for the volume: written straight through, so a copy has reached the device once it returns
+MOUNT_OPTIONS = "sync,noatime,flush"
+
+# Size of each write of an image to the volume
+_WRITE_SIZE = 64 * 1024
+
+
+def find_block_device(port: str, sysfs: str = "/sys") -> Optional[str]:
+    """The mass storage block device, eg. /dev/sda, of the USB device whose
+    serial port is `port`, eg. /dev/ttyACM0. A partition is preferred to the
+    whole disk. None if there isn't one (yet)."""
+    tty = os.path.basename(os.path.realpath(port))
+    try:
+        # The tty's device is one of the USB device's interfaces, eg. .../1-1.2/1-1.2:1.1
+        usb_device = os.path.dirname(os.path.realpath(os.path.join(sysfs, "class", "tty", tty, "device")))
+        blocks = os.listdir(os.path.join(sysfs, "class", "block"))
+    except OSError:
+        return None
+    disks, partitions = [], []
+    for name in sorted(blocks):
+        path = os.path.realpath(os.path.join(sysfs, "class", "block", name))
+        if path.startswith(usb_device + os.sep):
+            is_partition = os.path.exists(os.path.join(path, "partition"))
+            (partitions if is_partition else disks).append(name)
+    names = partitions or disks
+    return f"/dev/{names[0]}" if names else None
+
+
+class MountManager:
+    """
+    Mounts the xDot's volume itself, rather than relying on the desktop's
+    automount, writes firmware images to it and unmounts it again, so each
+    step is done (or fails) deterministically.
+
+    Without `find_device` the mount point is taken to be the volume itself
+    and is never mounted or unmounted, eg. a plain directory in tests or a
+    volume that's still automounted.
+
+    :param mount_point: Directory to mount the volume on, created if need be.
+    :param find_device: Returns the block device of the volume of the xDot with the given serial port,
+                        None if it's not attached (yet), see `find_block_device`.
+    :param options: Options to mount the volume with.
+    :param run: Runs the mount and umount commands, raising `subprocess.CalledProcessError` if they fail.
+    """
+
+    def __init__(
+        self,
+        mount_point: str,
+        find_device: Optional[Callable[[str], Optional[str]]] = None,
+        options: str = MOUNT_OPTIONS,
+        run: Optional[Callable[[List[str]], None]] = None,
+    ):
+        self.mount_point = mount_point
+        self._find_device = find_device
+        self._options = options
+        self._run = run or (lambda args: subprocess.run(args, check=True, capture_output=True, text=True))
+        self._mounted: Optional[str] = None
+        # The xDot's serial port when it was last mounted, which can change when it's plugged in again
+        self._port: Optional[str] = None
+
+    @property
+    def managed(self) -> bool:
+        """Whether the volume is mounted and unmounted by this, rather than being a directory."""
+        return self._find_device is not None
+
+    def mount(self, timeout: Optional[float], cancel: Optional[CancelToken] = None, port: Optional[str] = None) -> None:
+        """Waits for the xDot's block device to appear and mounts it, unless it's already mounted here.
+
+        :param port: The xDot's serial port, eg. /dev/ttyACM0, its volume is found from. The last one if not given.
+        :raises FlashError: If it doesn't appear in time or can't be mounted.
+        """
+        if not self.managed:
+            if not os.path.isdir(self.mount_point):
+                raise FlashError(f"{self.mount_point} doesn't exist")
+            return
+        if self._mounted is not None:
+            return
+        if port is not None:
+            self._port = port
+        if self._port is None:
+            raise FlashError("The xDot's serial port isn't known, so neither is its volume")
+        timer = Timeout(timeout) if timeout is not None else TimeoutNever()
+        device = self._find_device(self._port)
+        while device is None:
+            if timer.expired:
+                raise FlashError(f"The xDot's volume didn't appear within {timeout}s")
+            if cancel is not None:
+                cancel.sleep(_CHECK_INTERVAL)
+            else:
+                time.sleep(_CHECK_INTERVAL)
+            device = self._find_device(self._port)
+        os.makedirs(self.mount_point, exist_ok=True)
+        # Left mounted, eg. by a crash mid-flash
+        if os.path.realpath(self.mount_point) in (mount_points() or ()):
+            self._unmount()
+        self._command(["mount", "-t", "vfat", "-o", self._options, device, self.mount_point])
+        self._mounted = device
+        logger.debug(f"mounted {device} on {self.mount_point}")
+
+    def write(self, image: FirmwareImage) -> None:
+        """Writes the image to the volume, returning once it's reached the device.
+
+        :raises FlashError: If the write is short or fails.
+        """
+        target = os.path.join(self.mount_point, image.name)
+        written = 0
+        try:
+            with open(target, "wb", buffering=_WRITE_SIZE) as f:
+                view = memoryview(image.data)
+                while written < len(view):
+                    count = f.write(view[written : written + _WRITE_SIZE])
+                    if not count:
+                        break
+                    written += count
+                f.flush()
+                os.fsync(f.fileno())
+        except OSError as e:
+            raise FlashError(f"Failed to write {image.name} to {self.mount_point}: {e}") from e
+        if written != len(image.data):
+            raise FlashError(f"Short write of {image.name}: {written} of {len(image.data)} bytes")
+
+    def verify(self, timeout: float, cancel: Optional[CancelToken] = None) -> None:
+        """Checks the xDot flashed the image it was sent. Once unmounted, the
+        xDot detaches its volume while flashing and attaches it again after,
+        with `FAIL_FILE` on it if flashing failed. If it doesn't detach and
+        reattach within the timeout this returns without checking, leaving
+        the boot header to show whether the firmware loaded.
+
+        :raises FlashError: If the xDot reports that flashing failed.
+        """
+        if not self.managed:
+            self.check_failure()
+            return
+        timer = Timeout(timeout)
+        while self._port is not None and self._find_device(self._port) is not None:
+            if timer.expired:
+                logger.warning(f"The xDot's volume didn't detach within {timeout}s, not checking the flash")
+                return
+            if cancel is not None:
+                cancel.sleep(_CHECK_INTERVAL)
+            else:
+                time.sleep(_CHECK_INTERVAL)
+        try:
+            self.mount(max(0, timer.remaining), cancel)
+        except FlashError as e:
+            logger.warning(f"{e}, not checking the flash")
+            return
+        try:
+            self.check_failure()
+        finally:
+            self.unmount()
+
+    def check_failure(self) -> None:
+        """Raises `FlashError` with the xDot's reason if its last flash failed."""
+        fail = os.path.join(self.mount_point, FAIL_FILE)
+        try:
+            with open(fail, errors="replace") as f:
+                reason = f.read().strip()
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            reason = str(e)
+        raise FlashError(f"The xDot failed to flash the firmware: {reason or FAIL_FILE}")
+
+    def unmount(self) -> None:
+        """Unmounts the volume if it's mounted here, so the xDot can take over its storage."""
+        if self._mounted is None:
+            return
+        self._mounted = None
+        self._unmount()
+
+    def _unmount(self) -> None:
+        try:
+            self._command(["umount", self.mount_point])
+        except FlashError as e:
+            logger.warning(str(e))
+
+    def _command(self, args: List[str]) -> None:
+        try:
+            self._run(args)
+        except (OSError, subprocess.CalledProcessError) as e:
+            stderr = getattr(e, "stderr", None)
+            raise FlashError(f"`{' '.join(args)}` failed: {(stderr or str(e)).strip()}") from e
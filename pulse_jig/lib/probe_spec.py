@@ -17,8 +17,10 @@ class ProbeSpec:
     def set(self, cable_length: str):
         self.cable_length = int(float(cable_length) * 1000)
 
-    def save(self, ftf: JigClient):
-        ftf.hwchunk_write_probe(self.cable_length)
+    def save(self, ftf: JigClient) -> bool:
+        """Writes the probe chunk and verifies it in the same pipelined batch.
+        :return bool: If the chunk list is correct and all CRCs match."""
+        return ftf.hwchunk_write_probe_and_verify(self.cable_length)
 
     @staticmethod
     def _parse_cable_length(data: str):
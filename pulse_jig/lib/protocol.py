@@ -0,0 +1,245 @@
+import codecs
+import enum
+from collections import deque
+from typing import Callable, Deque, NamedTuple, Optional, Tuple
+
+from .cancel import CancelToken
+from .timeout import Timeout, TimeoutNever
+
+TERMINATOR = b"\n"
+PROMPT = b"> "
+PROMPT_TEXT = PROMPT.decode()
+BOOT_HEADER_SEPARATOR = "=" * 62
+# Noted in recorded sessions when the jig starts waiting for a boot header, see `transport.mark`
+BOOT_HEADER_MARK = "boot-header"
+
+
+class TokenKind(enum.Enum):
+    PROMPT = enum.auto()
+    ECHO = enum.auto()
+    ACK = enum.auto()
+    ERROR = enum.auto()
+    BODY = enum.auto()
+    BODY_END = enum.auto()
+    HEADER_SEPARATOR = enum.auto()
+    HEADER = enum.auto()
+    # Any other line that arrives when no response is expected
+    LINE = enum.auto()
+
+
+class Token(NamedTuple):
+    kind: TokenKind
+    text: str
+
+
+class _State(enum.Enum):
+    IDLE = enum.auto()
+    AWAIT_ACK = enum.auto()
+    BODY = enum.auto()
+    HEADER = enum.auto()
+
+
+class ProtocolParser:
+    """Incremental tokenizer for the Function Test Protocol.
+
+    Bytes are read from the port as they become available into a single
+    reusable buffer and frames are split on the terminator in place, so a
+    line is only ever copied once - when it is decoded. Invalid UTF-8 is
+    replaced rather than raised.
+
+    Whether a line is an echo or part of a body depends on what was sent,
+    so callers register each command they write with `expect_response`.
+    Responses to several commands may be expected at once (pipelining).
+    Lines are only classified as they are taken with `next_token`, so data
+    that was read ahead is still attributed to commands registered later.
+    """
+
+    def __init__(
+        self,
+        port=None,
+        on_read: Optional[Callable[[str], None]] = None,
+        poll_interval: float = 0.05,
+        cancel_token: Optional[CancelToken] = None,
+        read_ahead: bool = True,
+    ):
+        """
+        :param port: pyserial compatible port to read from. May be None if data is only ever `feed`.
+        :param on_read: Called with the decoded text of everything read from the port.
+        :param poll_interval: Upper bound on how long a single read from the port blocks.
+        :param cancel_token: Checked between reads. Once cancelled reads raise `Cancelled`.
+        :param read_ahead: Read everything that's available at once. Without it bytes are read one at a
+                           time, so nothing after a line that's been taken is read from the port, eg. to
+                           leave the rest for another parser.
+        """
+        self._port = port
+        self._read_ahead = read_ahead
+        self.cancel_token = cancel_token
+        self._on_read = on_read
+        self._poll_interval = poll_interval
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self._buf = bytearray()
+        self._pos = 0
+        self._state = _State.IDLE
+        self._expected: Deque[bool] = deque()
+        # Each complete line, and how many bytes of input it was including its terminator
+        self._lines: Deque[Tuple[str, int]] = deque()
+        self._consumed = 0
+        self._token_offset = 0
+
+    def expect_response(self, has_body: bool) -> None:
+        """Registers a command that has been written to the device."""
+        self._expected.append(has_body)
+
+    def clear_expected(self) -> None:
+        """Forgets about any outstanding responses, eg. after a protocol error."""
+        self._expected.clear()
+        if self._state in (_State.AWAIT_ACK, _State.BODY):
+            self._state = _State.IDLE
+
+    def reset(self) -> None:
+        """Discards all buffered data and state."""
+        self.clear_expected()
+        self._buf.clear()
+        self._pos = 0
+        self._lines.clear()
+        self._state = _State.IDLE
+
+    @property
+    def consumed(self) -> int:
+        """Number of bytes of input taken as tokens so far, including blank lines and terminators."""
+        return self._consumed
+
+    @property
+    def token_offset(self) -> int:
+        """Value of `consumed` where the last token taken began, so a response's size on the wire
+        is `consumed` after its last token less this after its first."""
+        return self._token_offset
+
+    @property
+    def pending(self) -> int:
+        """Number of buffered bytes of an incomplete line."""
+        return len(self._buf) - self._pos
+
+    def feed(self, data: bytes) -> None:
+        """Adds data to the buffer as if it had been read from the port."""
+        if self._on_read is not None:
+            self._on_read(self._decoder.decode(data))
+        self._buf += data
+        self._split_lines()
+
+    def next_token(self, timeout: Optional[float]) -> Optional[Token]:
+        """Returns the next token, reading from the port as needed.
+
+        :param timeout: Maximum seconds to wait. None to wait indefinitely.
+        :return: The token, or None if the timeout expired first.
+        """
+        timer = Timeout(timeout) if timeout is not None else TimeoutNever()
+        while True:
+            token = self._take_token()
+            if token is not None:
+                return token
+            remaining = timer.remaining
+            if remaining is not None and remaining <= 0:
+                return None
+            if self.cancel_token is not None:
+                self.cancel_token.raise_if_cancelled()
+            self._fill(remaining)
+
+    def _take_token(self) -> Optional[Token]:
+        while self._lines:
+            line, size = self._lines.popleft()
+            if self._state in (_State.IDLE, _State.AWAIT_ACK) and line.startswith(PROMPT_TEXT):
+                # The rest of the line, usually the echo, follows the prompt
+                self._lines.appendleft((line[len(PROMPT_TEXT) :], size - len(PROMPT)))
+                self._token_offset = self._consumed
+                self._consumed += len(PROMPT)
+                return Token(TokenKind.PROMPT, PROMPT_TEXT)
+            start = self._consumed
+            self._consumed += size
+            token = self._classify(line)
+            if token is not None:
+                self._token_offset = start
+                return token
+
+        # The prompt isn't terminated, so look for it at the start of the incomplete line
+        if self._state in (_State.IDLE, _State.AWAIT_ACK) and self._buf.startswith(PROMPT, self._pos):
+            self._pos += len(PROMPT)
+            self._token_offset = self._consumed
+            self._consumed += len(PROMPT)
+            return Token(TokenKind.PROMPT, PROMPT_TEXT)
+        return None
+
+    def _fill(self, remaining: Optional[float]) -> None:
+        wait = self._poll_interval if remaining is None else min(remaining, self._poll_interval)
+        # Changing the timeout reconfigures the tty, so only do it when needed
+        if self._port.timeout != wait:
+            self._port.timeout = wait
+        if not self._read_ahead:
+            data = self._port.read(1)
+            if data:
+                self.feed(data)
+            return
+        waiting = self._port.in_waiting
+        data = self._port.read(waiting if waiting else 1)
+        if data and not waiting:
+            waiting = self._port.in_waiting
+            if waiting:
+                data += self._port.read(waiting)
+        if data:
+            self.feed(data)
+
+    def _split_lines(self) -> None:
+        buf = self._buf
+        view = memoryview(buf)
+        try:
+            start = self._pos
+            end = buf.find(TERMINATOR, start)
+            while end >= 0:
+                line_end = end - 1 if end > start and buf[end - 1] == 0x0D else end
+                self._lines.append((str(view[start:line_end], "utf-8", "replace"), end + 1 - start))
+                start = end + 1
+                end = buf.find(TERMINATOR, start)
+            self._pos = start
+        finally:
+            view.release()
+
+        # Compact once per fill rather than once per line
+        if self._pos == len(buf):
+            buf.clear()
+            self._pos = 0
+        elif self._pos > 4096:
+            del buf[: self._pos]
+            self._pos = 0
+
+    def _classify(self, line: str) -> Optional[Token]:
+        state = self._state
+        if state == _State.BODY:
+            if line == ".":
+                self._expected.popleft()
+                self._state = _State.IDLE
+                return Token(TokenKind.BODY_END, line)
+            return Token(TokenKind.BODY, line) if line else None
+        if line == BOOT_HEADER_SEPARATOR:
+            self._state = _State.IDLE if state == _State.HEADER else _State.HEADER
+            return Token(TokenKind.HEADER_SEPARATOR, line)
+        if state == _State.HEADER:
+            return Token(TokenKind.HEADER, line)
+        if state == _State.AWAIT_ACK:
+            if line == "+OK":
+                if self._expected[0]:
+                    self._state = _State.BODY
+                else:
+                    self._expected.popleft()
+                    self._state = _State.IDLE
+                return Token(TokenKind.ACK, line)
+            if line.startswith("-ERR"):
+                self._expected.popleft()
+                self._state = _State.IDLE
+                return Token(TokenKind.ERROR, line)
+            return Token(TokenKind.LINE, line) if line else None
+        if not line:
+            return None
+        if self._expected:
+            self._state = _State.AWAIT_ACK
+            return Token(TokenKind.ECHO, line)
+        return Token(TokenKind.LINE, line)
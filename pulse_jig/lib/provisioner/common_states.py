@@ -1,60 +1,178 @@
+import functools
 import logging
-import time
+from typing import Optional
 
 import serial
 
 from pulse_jig.config import settings
+from ..boot_header import BootHeader, FirmwareKind
+from ..device_registry import DeviceRegistry
+from ..firmware_store import FirmwareImage, FirmwareStore
 from ..jig_client import JigClient
+from ..mount import FlashError
+from ..recording import RecordingTransport
+from ..timeout_policy import AdaptiveTimeoutPolicy
+from ..transcript import Transcript
+from ..transport import DEFAULT_BAUDRATE, Transport, create_transport, is_network_url
+from ..verbosity import VERBOSITY_ALWAYS, VERBOSITY_ON_FAILURE, VerbosityPolicy
 
 logger = logging.getLogger("provisioner")
 
 
 class CommonStates:
     def loading_test_firmware(self):
-        self._ftf = JigClient(self._port)
+        self._ftf = JigClient(
+            self._port,
+            Transcript(max_memory=settings.app.transcript_memory_limit),
+            cancel_token=self._session,
+            timeout_policy=timeout_policy(),
+            link_latency=link_latency(self._port.port),
+            cache_reads=settings.app.cache_reads,
+            verbosity=verbosity_policy(self.mode.target.value),
+        )
+        self._ftf.add_hook(self.command_latency)
 
-        # Skip the boot header from the device plugging in
+        # Skip the boot header from the device plugging in, unless it's already been read
         # Then we need to clear logs, so we don't have junk in cloud logs
-        self._ftf.skip_boot_header()
+        running = self._boot_header or self._ftf.skip_boot_header()
+        self._boot_header = None
         self._ftf.reset_logs()
 
-        if not settings.app.skip_firmware_load:
-            self._pulse_manager.load_firmware(self._test_firmware_path)
+        image = firmware_store().get(self._test_firmware_path)
+        # A unit already running the test firmware needs neither flashing nor resetting to check it loaded
+        if settings.app.skip_firmware_load or not self._is_flashed(image, running):
+            if not settings.app.skip_firmware_load:
+                try:
+                    self._pulse_manager.load_firmware(
+                        image or self._test_firmware_path, cancel=self._session, port=self._port.port
+                    )
+                except FlashError as e:
+                    logger.error(f"Failed to load the Test firmware: {e}")
+                    self.fail()
+                    return
 
-        # Now we reset the device manually
-        # and read the header from that.
-        self._pulse_manager.reset_device()
-        header = self._ftf.read_boot_header(with_prompt=True)
+            # Now we reset the device manually
+            # and read the header from that.
+            self._pulse_manager.reset_device(cancel=self._session)
+            header = self._ftf.read_boot_header(with_prompt=True)
 
-        if not settings.app.skip_firmware_load and not validate_test_firmware_load(header):
-            logger.error("Failed to load the Test firmware")
-            self.fail()
-            return
+            if not settings.app.skip_firmware_load and not validate_test_firmware_load(header):
+                logger.error("Failed to load the Test firmware")
+                self.fail()
+                return
+            if not settings.app.skip_firmware_load and image is not None:
+                firmware_store().learn(image, header)
+
+        if settings.app.fast_baudrate and not self._port.port.startswith("socket://"):
+            # Bulk output, eg. verbose test bodies, is bound by the serial line at the default rate
+            self._ftf.negotiate_baudrate(settings.app.fast_baudrate, settings.app.baud_command)
 
         self.test_firmware_version = self._ftf.firmware_version()
 
         self.proceed()
 
+    def _is_flashed(self, image: Optional[FirmwareImage], running: Optional[BootHeader]) -> bool:
+        """Whether the device is already running the image, so flashing it can be skipped"""
+        if image is None or not settings.app.skip_current_firmware:
+            return False
+        if firmware_store().is_flashed(image, running):
+            logger.info(f"Already running {image.name} v{running.version} build {running.build}, skipping the flash")
+            return True
+        return False
+
     def waiting_for_network(self):
         """Blocks until internet is connected & API endpoints are reachable"""
-        while True:
-            if self.has_network():
-                self.proceed()
-                break
+        if self._registrar.wait_for_network(cancel=self._session):
+            self.proceed()
 
     def waiting_for_serial(self):
         """Blocks until the serial port is detected."""
+        self.start_session()
         self._port.close()
+        # A device that's (re)connected starts at the default baud rate, see `JigClient.negotiate_baudrate`
+        self._port.baudrate = DEFAULT_BAUDRATE
+        registry = device_registry() if is_local_device(self._port.port) else None
+        if registry is not None and self._device_identity is None:
+            # Remember which xDot it is, so it's found again if it comes back under another node
+            device = registry.find(self._port.port)
+            self._device_identity = device.serial_number if device and device.serial_number else self._port.port
         while True:
+            generation = registry.generation if registry is not None else None
             try:
                 self._port.open()
                 break
             except serial.serialutil.SerialException as e:
                 logger.error(str(e))
-                logger.info("Retrying...")
-                time.sleep(1)
+                if registry is None:
+                    logger.info("Retrying...")
+                    self._session.sleep(1)
+                    continue
+                # Woken as soon as the device appears or changes, eg. udev making it accessible.
+                # The timeout is a fallback in case the change is missed.
+                logger.info(f"Waiting for device {self._device_identity}...")
+                device = registry.wait_for(self._device_identity, timeout=1, cancel=self._session, since=generation)
+                if device is not None and device.path != self._port.port:
+                    logger.info(f"Device {self._device_identity} is now {device.path}")
+                    self._port.port = device.path
         self.proceed()
 
 
-def validate_test_firmware_load(header: str) -> bool:
-    return "Starting Functional Tests Firmware" in header and ">" in header
+@functools.lru_cache(maxsize=None)
+def timeout_policy() -> Optional[AdaptiveTimeoutPolicy]:
+    """The timeout policy shared by every provisioner, so history isn't reloaded on a target change"""
+    if not settings.app.adaptive_timeouts:
+        return None
+    return AdaptiveTimeoutPolicy(settings.app.timeout_history_path, overrides=settings.app.command_timeouts)
+
+
+@functools.lru_cache(maxsize=None)
+def firmware_store() -> FirmwareStore:
+    """The firmware images shared by every provisioner, read and hashed once at startup"""
+    paths = [settings.app.test_firmware_path]
+    paths += [settings.app.get(key) for key in ("prod_firmware_au915_path", "prod_firmware_as923_path")]
+    return FirmwareStore([path for path in paths if path], settings.app.firmware_versions_path)
+
+
+@functools.lru_cache(maxsize=None)
+def device_registry() -> Optional[DeviceRegistry]:
+    """The registry of attached xDots shared by every provisioner, None if `app.device_hotplug` is off"""
+    if not settings.app.device_hotplug:
+        return None
+    registry = DeviceRegistry()
+    registry.start()
+    return registry
+
+
+def is_local_device(dev: Optional[str]) -> bool:
+    """Whether the device is a serial port on this machine, rather than a URL"""
+    return dev is not None and "://" not in dev
+
+
+@functools.lru_cache(maxsize=None)
+def verbosity_policy(target: str) -> VerbosityPolicy:
+    """The target's test verbosity policy, kept across units so the cost of verbose runs is remembered"""
+    if settings.app.submit_measurements:
+        # Quiet runs print no readings, so only failing units would have any
+        return VerbosityPolicy(VERBOSITY_ALWAYS)
+    mode = settings.app.test_verbosity
+    if not isinstance(mode, str):
+        # Per target, eg. {"ta3k": "verbose", "default": "on_failure"}
+        mode = mode.get(target, mode.get("default", VERBOSITY_ON_FAILURE))
+    return VerbosityPolicy(mode)
+
+
+def device_transport(dev: Optional[str]) -> Transport:
+    """The transport for the device, recording each session if `app.recording_dir` is set"""
+    port = create_transport(dev, settings.app.serial_backend)
+    if settings.app.recording_dir:
+        port = RecordingTransport(port, settings.app.recording_dir, keep=settings.app.recording_keep)
+    return port
+
+
+def link_latency(dev: Optional[str]) -> float:
+    """Extra time to allow for each response from the device, if it's on the other end of a network connection"""
+    return settings.app.network_latency if is_network_url(dev) else 0
+
+
+def validate_test_firmware_load(header: Optional[BootHeader]) -> bool:
+    return header is not None and header.kind == FirmwareKind.TEST and header.prompt
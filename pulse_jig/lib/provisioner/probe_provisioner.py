@@ -4,14 +4,13 @@ from dataclasses import dataclass
 from datetime import datetime
 from typing import Optional
 
-import serial
 from transitions import Machine
 
 from pulse_jig.config import settings
-from .common_states import CommonStates
+from .common_states import CommonStates, device_transport
 from .provisioner import Provisioner
 from ..hwspec import HWSpec
-from ..jig_client import JigClientException, JigClient
+from ..jig_client import ExternalPortStats, JigClientException, JigClient
 from ..probe_spec import ProbeSpec
 
 logger = logging.getLogger("provisioner")
@@ -71,8 +70,11 @@ class ProbeProvisioner(Provisioner, CommonStates):
         super().__init__(registrar)
         self._init_state_machine()
         self._pulse_manager = pulse_manager
-        self._port = serial.Serial(baudrate=115200)
-        self._port.port = dev
+        self._port = device_transport(dev)
+        # Serial number of the xDot, see `waiting_for_serial`
+        self._device_identity = None
+        # Boot header read while waiting for the PCB, see `loading_test_firmware`
+        self._boot_header = None
         self._test_firmware_path = settings.app.test_firmware_path
         self.mode = self.Mode()
 
@@ -135,20 +137,15 @@ class ProbeProvisioner(Provisioner, CommonStates):
         logger.info("probe_provisioner provisioning thread terminated")
 
     def waiting_for_pcb(self):
-        while not self._pulse_manager.is_connected:
-            pass
+        self._pulse_manager.await_connection(cancel=self._session)
 
-        # Now if the pulse board is removed we will close
-        # the port. This way pretty much any action will
-        # fail with a serial error which will get caught
-        # by the main loop.
+        # Now if the pulse board is removed we will cancel
+        # the session. Any blocking I/O will then raise
+        # `Cancelled` which will get caught by the main loop.
         #
         # We can't just raise an exception here because
         # it won't get caught due to threading issues
-        def handler():
-            self._port.close()
-
-        self._pulse_manager.on_removal(handler)
+        self._pulse_manager.on_removal(self.end_session)
         self.proceed()
 
     def waiting_for_target(self):
@@ -162,20 +159,18 @@ class ProbeProvisioner(Provisioner, CommonStates):
 
     def loading_device_rego(self):
         try:
-            self._ftf.enable_external_port(self._port_no)
-
-            # If repair_mode is set we'll clear the hwspec on probe
-            # before attempting to read. This will ensure to re-write
-            # the hwspec to the device
-            if settings.app.hwspec_repair_mode:
-                self._ftf.hwspec_destroy("probe")
-
-            if self._ftf.hwspec_load("probe"):
-                self.hwspec = HWSpec()
-                self.hwspec.get(self._ftf)
-            else:
-                self.hwspec = None
-            self._ftf.disable_external_port()
+            with self._ftf.external_port(self._port_no):
+                # If repair_mode is set we'll clear the hwspec on probe
+                # before attempting to read. This will ensure to re-write
+                # the hwspec to the device
+                if settings.app.hwspec_repair_mode:
+                    self._ftf.hwspec_destroy("probe")
+
+                if self._ftf.hwspec_load("probe"):
+                    self.hwspec = HWSpec()
+                    self.hwspec.get(self._ftf)
+                else:
+                    self.hwspec = None
             self.proceed()
         except JigClientException:
             # If an JigClientException occurred then it could be a problem
@@ -199,23 +194,24 @@ class ProbeProvisioner(Provisioner, CommonStates):
         self.proceed()
 
     def save_hwspec(self):
-        self.hwspec.save(self._ftf)
-        self._ftf.enable_external_port(self._port_no)
-
-        # If saving to hwspec failed, it's fair to assume
-        # the probe is write-protected
         try:
-            self._ftf.hwspec_save("probe")
-        except JigClient.CommandFailed:
-            self.fail()
-            return
-
-        # Need to write probe spec only after `hwspec-save`
-        # and attempt to verify the written probe spec
-        self.probe_spec.save(self._ftf)
-        success = self._ftf.hwchunk_verify("probe")
-
-        self._ftf.disable_external_port()
+            # Set with the probe's port disabled, a port left enabled is disabled first
+            self.hwspec.save(self._ftf)
+            with self._ftf.external_port(self._port_no):
+                # If saving to hwspec failed, it's fair to assume
+                # the probe is write-protected. The port is disabled
+                # as the failure leaves the context.
+                self._ftf.hwspec_save("probe")
+
+                # Need to write probe spec only after `hwspec-save`
+                # and attempt to verify the written probe spec
+                success = self.probe_spec.save(self._ftf)
+
+            if not success:
+                self._ftf.release_external_port()
+        except JigClientException:
+            # Including the port failing to disable, which fails the unit rather than carrying on
+            success = False
 
         if not success:
             self.fail()
@@ -225,7 +221,6 @@ class ProbeProvisioner(Provisioner, CommonStates):
 
     def update_qrcode(self):
         if self.has_passed():
-            self.probe_spec = ProbeSpec()
             self.qrcode = self.QRCode(
                 sn=self.hwspec.serial,
                 rev=self.hwspec.hw_revision,
@@ -245,8 +240,9 @@ class ProbeProvisioner(Provisioner, CommonStates):
         success = self._registrar.submit_provisioning_record(
             hwspec=self.hwspec,
             status=self.provisional_status.name,
-            logs=self._ftf.log,
+            logs=self._ftf.transcript,
             test_firmware_version=self.test_firmware_version,
+            measurements=self.measurements,
         )
         if success:
             self.proceed()
@@ -256,23 +252,30 @@ class ProbeProvisioner(Provisioner, CommonStates):
     def reset(self):
         super().reset()
         self.probe_spec: Optional[ProbeSpec] = None
+        if hasattr(self, "_ftf"):
+            logger.info(f"External port for this unit: {self._ftf.external_port_stats}")
+            self._ftf.external_port_stats = ExternalPortStats()
 
     @property
     def probe_spec_cable_length_m(self) -> float:
         """Reads cable length from hwspec & returns in meters
         If the cable length was not found Fail with ValueError
         """
-        try:
-            self._ftf.enable_external_port(self._port_no)
-            self.probe_spec.get(self._ftf)
-            self._ftf.disable_external_port()
-            return self.probe_spec.cable_length / 1000
-        except IndexError:
-            raise ValueError("Cable length not found!")
+        # A probe spec written to this unit has already been verified by `save_hwspec`, so isn't read back
+        if self.probe_spec is None:
+            probe_spec = ProbeSpec()
+            try:
+                with self._ftf.external_port(self._port_no):
+                    probe_spec.get(self._ftf)
+            except IndexError:
+                raise ValueError("Cable length not found!")
+            self.probe_spec = probe_spec
+        return self.probe_spec.cable_length / 1000
 
     def start_iteration(self):
         # Before starting an iteration we need to power cycle the Pulse.
         # This will ensure the Pulse is fresh & have no tasks
         # running / locked by the last iteration.
-        self._pulse_manager.reset_device()
+        self._ftf.restore_baudrate()
+        self._pulse_manager.reset_device(cancel=self._session)
         self._ftf.skip_boot_header()
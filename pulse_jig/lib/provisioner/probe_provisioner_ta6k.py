@@ -1,6 +1,7 @@
 import logging
 
 from .probe_provisioner import ProbeProvisioner
+from ..jig_client import abort_on_failure
 from lib.target import Target
 
 from pulse_jig.config import settings
@@ -14,7 +15,13 @@ class ProbeProvisionerTa6k(ProbeProvisioner):
         self.mode.target = Target.TA6K
 
     def running_tests(self):
-        passed = self._ftf.test_ta6k(self._port_no, settings.app.test_port_min_threshold)
+        passed = self._ftf.test_ta6k(
+            self._port_no,
+            settings.app.test_port_min_threshold,
+            on_line=self.log_test_output,
+            abort_when=abort_on_failure,
+            measurements=self.measurements,
+        )
 
         if passed:
             logger.info("Tests Passed!")
@@ -6,7 +6,11 @@ import logging
 from dataclasses import dataclass
 from typing import Callable, Dict, List, Optional
 
+from ..cancel import CancelToken
+from ..command_hooks import LatencyHistogramHook
 from ..hwspec import HWSpec
+from ..jig_client import VerbosityStats
+from ..measurements import Measurements
 from ..registrar import Registrar, NetworkStatus
 from lib.pulse_manager import PulseManager
 from lib.target import Target
@@ -109,6 +113,12 @@ class Provisioner:
     def __init__(self, registrar: Registrar):
         logger.info(f"Starting provisioner: {self.__class__.__name__}")
         self._running = True
+        # Cancelled on terminate. Each device session gets a child token which
+        # is also cancelled when the device is removed.
+        self._cancel = CancelToken()
+        self._session = self._cancel.child()
+        # Latency of every command sent to the device, cleared at the end of each unit
+        self.command_latency = LatencyHistogramHook()
         self.reset()
         self._registrar = registrar
         self._listeners: List[Callable] = []
@@ -189,13 +199,37 @@ class Provisioner:
     def promote_provision_status(self):
         self.status = self.provisional_status
 
+    def start_session(self):
+        """Starts a new device session, cancelling any blocking I/O left over from the last one."""
+        self._session.cancel()
+        self._session = self._cancel.child()
+
+    def end_session(self):
+        """Aborts any blocking I/O in the current device session, eg. because the device was removed."""
+        self._session.cancel()
+
     def pcb_reset_button_enable(self):
         self.pcb_reset_enabled = True
 
     def pcb_reset_button_disable(self):
         self.pcb_reset_enabled = False
 
+    def log_test_output(self, line: str):
+        """Shows the sub-results of a test command as they arrive"""
+        if line.endswith(("OK", "PASS", "FAIL")):
+            logger.info(line)
+
     def reset(self):
+        summary = self.command_latency.format()
+        if summary:
+            logger.info("Command latency for this unit:\n" + summary)
+        if hasattr(self, "_ftf"):
+            logger.info(f"Read cache so far: {self._ftf.cache_stats}")
+            logger.info(f"Quiet tests for this unit: {self._ftf.verbosity_stats}")
+            self._ftf.verbosity_stats = VerbosityStats()
+        self.command_latency.reset()
+        # Readings from the verbose output of this unit's tests
+        self.measurements = Measurements()
         self.hwspec: Optional[HWSpec] = None
         self.status: Provisioner.Status = Provisioner.Status.UNKNOWN
         self.qrcode: Optional[Provisioner.QRCode] = None
@@ -222,11 +256,12 @@ class Provisioner:
 
     def terminate(self):
         """
-        Sets this provsioning thread to end. This can only happen the next time that we transition to a new state,
-        so any blocking processes in a provisioner needs to also test that we are still running via `is_running`.
+        Sets this provsioning thread to end. Any blocking I/O that checks the session's cancel token is aborted
+        straight away, otherwise this only happens the next time that we transition to a new state.
         """
         logger.info("setting terminate on provisioner")
         self._running = False
+        self._cancel.cancel()
 
     def is_running(self) -> bool:
         return self._running
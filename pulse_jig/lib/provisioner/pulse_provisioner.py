@@ -1,13 +1,17 @@
 import logging
 from dataclasses import dataclass
 from datetime import datetime
+from typing import Optional
 
 import json
-import serial
 
 from pulse_jig.config import settings
+from .common_states import device_transport, firmware_store, link_latency
 from .provisioner import Provisioner
+from ..boot_header import BootHeader, FirmwareKind
 from ..jig_client import JigClient
+from ..mount import FlashError
+from ..transport import DEFAULT_BAUDRATE
 
 logger = logging.getLogger("provisioner")
 
@@ -55,8 +59,11 @@ class PulseProvisioner(Provisioner):
         super().__init__(registrar)
         self._init_state_machine()
         self._pulse_manager = pulse_manager
-        self._port = serial.Serial(baudrate=115200)
-        self._port.port = dev
+        self._port = device_transport(dev)
+        # Serial number of the xDot, see `waiting_for_serial`
+        self._device_identity = None
+        # Boot header read while waiting for the PCB, see `loading_test_firmware`
+        self._boot_header = None
         self._test_firmware_path = settings.app.test_firmware_path
         self._prod_firmware_au915_path = settings.app.prod_firmware_au915_path
         self._prod_firmware_as923_path = settings.app.prod_firmware_as923_path
@@ -73,7 +80,7 @@ class PulseProvisioner(Provisioner):
         logger.info("pulse_provisioner provisioning thread terminated")
 
     def reset_device(self):
-        self._pulse_manager.reset_device()
+        self._pulse_manager.reset_device(cancel=self._session)
 
     def loading_prod_firmware(self):
         prod_firmware_path = None
@@ -86,11 +93,24 @@ class PulseProvisioner(Provisioner):
             self.retry()
             return
 
-        if not settings.app.skip_firmware_load:
-            self._pulse_manager.load_firmware(prod_firmware_path)
+        self._pf = JigClient(self._port, cancel_token=self._session, link_latency=link_latency(self._port.port))
+        self._pf.add_hook(self.command_latency)
+        # The device restarts at the default baud rate
+        self._pf.restore_baudrate()
 
-        self._pf = JigClient(self._port)
-        self._pulse_manager.reset_device()  # this has no effect for Phase 2 tests
+        # The device is running the test firmware, so this is always flashed
+        image = firmware_store().get(prod_firmware_path)
+        if not settings.app.skip_firmware_load:
+            try:
+                self._pulse_manager.load_firmware(
+                    image or prod_firmware_path, cancel=self._session, port=self._port.port
+                )
+            except FlashError as e:
+                logger.error(f"Failed to load the Production firmware: {e}")
+                self.retry()
+                return
+
+        self._pulse_manager.reset_device(cancel=self._session)  # this has no effect for Phase 2 tests
         header = self._pf.read_boot_header()
 
         if not settings.app.skip_firmware_load and not validate_prod_firmware_load(header):
@@ -98,11 +118,15 @@ class PulseProvisioner(Provisioner):
             self.retry()
             return
 
+        if not settings.app.skip_firmware_load and image is not None:
+            firmware_store().learn(image, header)
         self.prod_firmware_version = get_prod_firmware_version(header)
         self.proceed()
 
     def waiting_for_pcb_removal(self):
-        self._pulse_manager.await_removal()
+        # The next PCB boots at the default baud rate
+        self._port.baudrate = DEFAULT_BAUDRATE
+        self._pulse_manager.await_removal(cancel=self._session)
         self.proceed()
 
     def update_qrcode(self):
@@ -121,9 +145,10 @@ class PulseProvisioner(Provisioner):
         success = self._registrar.submit_provisioning_record(
             hwspec=self.hwspec,
             status=self.provisional_status.name,
-            logs=self._ftf.log,
+            logs=self._ftf.transcript,
             test_firmware_version=self.test_firmware_version,
             prod_firmware_version=self.prod_firmware_version,
+            measurements=self.measurements,
         )
         if success:
             self.proceed()
@@ -131,13 +156,9 @@ class PulseProvisioner(Provisioner):
             self.retry()
 
 
-def validate_prod_firmware_load(header: str) -> bool:
-    return "Starting Production Firmware" in header
+def validate_prod_firmware_load(header: Optional[BootHeader]) -> bool:
+    return header is not None and header.kind == FirmwareKind.PRODUCTION
 
 
-def get_prod_firmware_version(header: str) -> str:
-    version = ""
-    for ln in header.splitlines(True):
-        if ln.startswith("Firmware Version:"):
-            version = ln[17:].strip()  # Strip - "Firmware Version:"
-    return version
+def get_prod_firmware_version(header: Optional[BootHeader]) -> str:
+    return header.version if header is not None else ""
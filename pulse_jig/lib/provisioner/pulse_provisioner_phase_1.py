@@ -10,7 +10,7 @@ from pulse_jig.config import settings
 from .common_states import CommonStates
 from .pulse_provisioner import PulseProvisioner
 from ..hwspec import HWSpec
-from ..jig_client import JigClientException
+from ..jig_client import JigClientException, abort_on_failure
 
 logger = logging.getLogger("provisioner")
 
@@ -85,20 +85,15 @@ class PulseProvisionerPhase1(PulseProvisioner, CommonStates):
         m.on_exit_WAITING_FOR_PCB_REMOVAL("reset_logs")
 
     def waiting_for_pcb(self):
-        while self.is_running() and not self._pulse_manager.is_connected:
-            pass
+        self._pulse_manager.await_connection(cancel=self._session)
 
-        # Now if the pulse board is removed we will close
-        # the port. This way pretty much any action will
-        # fail with a serial error which will get caught
-        # by the main loop.
+        # Now if the pulse board is removed we will cancel
+        # the session. Any blocking I/O will then raise
+        # `Cancelled` which will get caught by the main loop.
         #
         # We can't just raise an exception here because
         # it won't get caught due to threading issues
-        def handler():
-            self._port.close()
-
-        self._pulse_manager.on_removal(handler)
+        self._pulse_manager.on_removal(self.end_session)
         self.proceed()
 
     def loading_device_rego(self):
@@ -130,10 +125,14 @@ class PulseProvisionerPhase1(PulseProvisioner, CommonStates):
             self.retry()
 
     def running_tests(self):
-        passed = self._ftf.test_self()
+        passed = self._ftf.test_self(
+            on_line=self.log_test_output, abort_when=abort_on_failure, measurements=self.measurements
+        )
 
         if passed:
-            passed = self._ftf.test_port()
+            passed = self._ftf.test_port(
+                on_line=self.log_test_output, abort_when=abort_on_failure, measurements=self.measurements
+            )
 
         if passed:
             logger.info("Tests Passed!")
@@ -145,10 +144,7 @@ class PulseProvisionerPhase1(PulseProvisioner, CommonStates):
 
     def configuring_device(self):
         # Configure Pulse
-        self._ftf.pulse_cfg_init()
-        self._ftf.pulse_cfg_load()
-        self._ftf.pulse_cfg_set_pulse("polling_rate", 1800)
-        self._ftf.pulse_cfg_save()
+        self._ftf.pulse_cfg_apply({"polling_rate": 1800})
 
         # Configure LoRa
         self._ftf.lora_config(settings.lora.config.join_eui, self.config_app_key)
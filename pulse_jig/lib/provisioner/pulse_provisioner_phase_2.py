@@ -8,7 +8,7 @@ from pulse_jig.config import settings
 from .common_states import CommonStates
 from .pulse_provisioner import PulseProvisioner
 from ..hwspec import HWSpec
-from ..jig_client import JigClientException
+from ..jig_client import JigClientException, abort_on_failure
 from lib.target import Target
 
 logger = logging.getLogger("provisioner")
@@ -85,7 +85,7 @@ class PulseProvisionerPhase2(PulseProvisioner, CommonStates):
     def waiting_for_pcb(self):
         test = lambda: self.is_running() and self._wait_on_header
         # check_for_header will block until we have a header or we've stopped running
-        self._pulse_manager.check_for_header(self._port, continue_test=test)
+        self._boot_header = self._pulse_manager.check_for_header(self._port, continue_test=test, cancel=self._session)
         self.proceed()
 
     def loading_device_rego(self):
@@ -112,11 +112,19 @@ class PulseProvisionerPhase2(PulseProvisioner, CommonStates):
             self.retry()
 
     def running_tests(self):
-        passed = self._ftf.test_self()
+        passed = self._ftf.test_self(
+            on_line=self.log_test_output, abort_when=abort_on_failure, measurements=self.measurements
+        )
 
+        # A failed join attempt can be retried by the firmware within the test,
+        # so we only stream its output rather than aborting on the first failure
         if passed:
             passed = self._ftf.test_lora_connect(
-                settings.lora.test.sub_band, settings.lora.test.join_eui, settings.lora.test.app_key
+                settings.lora.test.sub_band,
+                settings.lora.test.join_eui,
+                settings.lora.test.app_key,
+                on_line=self.log_test_output,
+                measurements=self.measurements,
             )
 
         if passed:
@@ -86,7 +86,7 @@ class PulseProvisionerPhase3(PulseProvisioner, CommonStates):
     def waiting_for_pcb(self):
         test = lambda: self.is_running() and self._wait_on_header
         # check_for_header will block until we have a header or we've stopped running
-        self._pulse_manager.check_for_header(self._port, continue_test=test)
+        self._boot_header = self._pulse_manager.check_for_header(self._port, continue_test=test, cancel=self._session)
         self.proceed()
 
     def loading_device_rego(self):
@@ -133,10 +133,11 @@ class PulseProvisionerPhase3(PulseProvisioner, CommonStates):
         success = self._registrar.submit_provisioning_record(
             hwspec=self.hwspec,
             status=self.provisional_status.name,
-            logs=self._ftf.log,
+            logs=self._ftf.transcript,
             test_firmware_version=self.test_firmware_version,
             prod_firmware_version=self.prod_firmware_version,
             region_ch_plan=self.mode.region_ch_plan,
+            measurements=self.measurements,
         )
         if success:
             self.proceed()
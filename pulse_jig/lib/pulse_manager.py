@@ -4,64 +4,115 @@ import shutil
 import threading
 import time
 from pathlib import Path
-from typing import Callable, Optional
+from typing import Callable, Optional, Union
 
 import gpiozero
-import serial
 
-from .timeout import Timeout, TimeoutNever
+from .boot_header import BootHeader, await_boot_header
+from .cancel import CancelToken
+from .firmware_store import FirmwareImage
+from .mount import FlashError, MountManager, await_mount_ready
+from .protocol import BOOT_HEADER_MARK, ProtocolParser
+from .transport import Transport, mark
 
 logger = logging.getLogger(__name__)
 
+# How often a wait on the PCB sense pin checks for being cancelled. The pin's
+# edges wake the wait straight away, this only bounds how long a cancel takes
+_CANCEL_CHECK_INTERVAL = 0.05
+
+
+def _sleep(seconds: float, cancel: Optional[CancelToken]):
+    if cancel is not None:
+        cancel.sleep(seconds)
+    else:
+        time.sleep(seconds)
+
 
 class PulseManager:
-    def __init__(self, reset_pin: int, pcb_sense_pin: int, xdot_volume: str):
+    def __init__(
+        self,
+        reset_pin: int,
+        pcb_sense_pin: int,
+        xdot_volume: str,
+        mount_probe_write: bool = False,
+        mount_manager: Optional[MountManager] = None,
+        flash_verify_timeout: float = 5,
+    ):
+        """
+        :param xdot_volume: Where the xDot's volume is automounted, unless there's a `mount_manager`.
+        :param mount_manager: Mounts the xDot's volume to flash firmware, rather than relying on automount.
+        :param flash_verify_timeout: Maximum seconds the mount manager waits to check the xDot flashed the firmware.
+        """
         self._reset_pin = gpiozero.OutputDevice(reset_pin, initial_value=True)
         self._pcb_sense_pin = gpiozero.Button(pcb_sense_pin, pull_up=True)
         self._xdot_volume = Path(xdot_volume)
+        self._mount_probe_write = mount_probe_write
+        self._mount_manager = mount_manager
+        self._flash_verify_timeout = flash_verify_timeout
+        # Seconds the xDot's volume took to be ready for the last firmware load, None if it wasn't in time
+        self.mount_ready_time: Optional[float] = None
 
-    def reset_device(self):
+    def reset_device(self, cancel: Optional[CancelToken] = None):
         logger.debug("reset_device()")
         self._reset_pin.off()
-        time.sleep(0.2)
-        self._reset_pin.on()
-        time.sleep(0.2)
+        try:
+            _sleep(0.2, cancel)
+        finally:
+            self._reset_pin.on()
+        _sleep(0.2, cancel)
 
     @property
     def is_connected(self):
         return self._pcb_sense_pin.is_pressed
 
-    def await_removal(self):
-        self._pcb_sense_pin.wait_for_release()
+    def await_connection(self, cancel: Optional[CancelToken] = None):
+        """Blocks until a PCB is connected, woken by the sense pin's edge rather than polling it."""
+        self._await(self._pcb_sense_pin.wait_for_press, cancel)
+
+    def await_removal(self, cancel: Optional[CancelToken] = None):
+        """Blocks until the PCB is removed, woken by the sense pin's edge rather than polling it."""
+        self._await(self._pcb_sense_pin.wait_for_release, cancel)
+
+    @staticmethod
+    def _await(wait: Callable[..., bool], cancel: Optional[CancelToken]):
+        if cancel is None:
+            wait()
+            return
+        # Wait in slices so that cancellation is noticed promptly
+        while not wait(timeout=_CANCEL_CHECK_INTERVAL):
+            cancel.raise_if_cancelled()
 
     def on_removal(self, callback):
         self._pcb_sense_pin.when_released = callback
 
-    def _ensure_for_mount(self, timeout: Optional[float]):
+    def _ensure_for_mount(self, timeout: Optional[float], cancel: Optional[CancelToken] = None):
+        """
+        Waits for the mount to be ready to write the firmware to. Right after
+        being automounted the volume reports no space available for a while,
+        which a copy fails on, so it has to report some as well as being mounted.
         """
-        Asserts that the mount is there.
+        self.mount_ready_time = await_mount_ready(
+            str(self._xdot_volume), timeout, cancel, probe=self._mount_probe_write
+        )
+        if self.mount_ready_time is None:
+            logger.warning(f"{self._xdot_volume} not ready after {timeout}s, copying anyway")
+        else:
+            logger.info(f"{self._xdot_volume} ready after {self.mount_ready_time:.2f}s")
+
+    def load_firmware(
+        self, firmware: Union[Path, FirmwareImage], cancel: Optional[CancelToken] = None, port: Optional[str] = None
+    ):
+        """Flashes the firmware by copying it to the xDot's volume, from memory if it's an image.
+
+        :param port: The xDot's serial port, which a mount manager finds its volume from.
+        :raises FlashError: With a mount manager, as soon as flashing fails, eg. the
+                            image is missing, the write is short or the xDot reports it failed.
         """
-        timer = Timeout(timeout) if timeout else TimeoutNever()
-        while not timer.expired:
-            if os.path.exists(self._xdot_volume) and os.access(self._xdot_volume, os.W_OK):
-                break
-            else:
-                time.sleep(0.1)
-        # XXX TODO this is here because we can't quite detect when the mount is ready.
-        # the behaviour we see on the prod jigs, but not the test jig, is that when
-        # trying to copy the file to the mount it will report that there is not enough
-        # space. if you look at /var/log/syslog you will see that some time after the
-        # device is successfully mounted it changes the available space from 0 to xxxx
-        # bytes... so there is some different behaviour going on on the prod jigs.
-        # the better fix is to not use automount but explicitly mount it ourselves,
-        # which presumably will block perfectly until it is ready...
-        # however this is a significant change and we have encountered numerous 'edge
-        # cases' with mounting the device. for now we take this "tactical fix" and
-        # later we can fix it properly and do extensive testing.
-        time.sleep(2)
-
-    def load_firmware(self, firmware_path: Path):
-        firmware_path = Path(firmware_path)
+        if self._mount_manager is not None:
+            self._flash(firmware, self._mount_manager, cancel, port)
+            return
+
         # Note that on macos the copy returns instantly but on linux
         # it doesn't appear to return until after the reset pin is
         # released.
@@ -70,54 +121,85 @@ class PulseManager:
 
         def do_copy():
             try:
-                shutil.copy(str(firmware_path), self._xdot_volume / firmware_path.name)
+                if isinstance(firmware, FirmwareImage):
+                    (self._xdot_volume / firmware.name).write_bytes(firmware.data)
+                else:
+                    shutil.copy(str(firmware), self._xdot_volume / Path(firmware).name)
             except IOError as e:
                 logger.error(str(e))
 
         # it takes time for the mount to be there
-        self._ensure_for_mount(10)
-
+        self._ensure_for_mount(10, cancel)
+
+        self._copy_in_reset(do_copy, cancel)
+        _sleep(0.2, cancel)
+
+    def _flash(
+        self,
+        firmware: Union[Path, FirmwareImage],
+        manager: MountManager,
+        cancel: Optional[CancelToken],
+        port: Optional[str],
+    ):
+        try:
+            image = firmware if isinstance(firmware, FirmwareImage) else FirmwareImage.read(firmware)
+        except OSError as e:
+            raise FlashError(f"Missing firmware image: {e}") from e
+
+        errors = []
+
+        def do_write():
+            try:
+                manager.write(image)
+            except FlashError as e:
+                errors.append(e)
+
+        manager.mount(10, cancel, port)
+        try:
+            self._copy_in_reset(do_write, cancel)
+        finally:
+            manager.unmount()
+        if errors:
+            raise errors[0]
+        manager.verify(self._flash_verify_timeout, cancel)
+        _sleep(0.2, cancel)
+
+    def _copy_in_reset(self, copy: Callable[[], None], cancel: Optional[CancelToken]):
+        """Runs the copy to the xDot's volume while briefly holding the device in reset."""
         self._reset_pin.off()
         logger.debug("starting copy")
-        copy_thread = threading.Thread(target=do_copy)
+        copy_thread = threading.Thread(target=copy)
         copy_thread.start()
-        time.sleep(0.2)
-        self._reset_pin.on()
-        logger.debug("waiting for copy")
-        copy_thread.join()
-        time.sleep(0.2)
+        try:
+            _sleep(0.2, cancel)
+        finally:
+            self._reset_pin.on()
+            # A copy in progress can't be interrupted, so this always waits for it
+            logger.debug("waiting for copy")
+            copy_thread.join()
 
     def check_for_header(
-        self, port: serial.Serial, timeout: float = None, continue_test: Optional[Callable[[], bool]] = None
-    ) -> bool:
-        """Monitors the port for a boot header from the firmware.
-        Keep reading until the end of the boot header to verify.
-        If found return True.
-        The check consumes all available data
-        from the port.
+        self,
+        port: Transport,
+        timeout: float = None,
+        continue_test: Optional[Callable[[], bool]] = None,
+        cancel: Optional[CancelToken] = None,
+    ) -> Optional[BootHeader]:
+        """Monitors the port for a boot header from the firmware,
+        returning as soon as its closing separator arrives.
+        Everything up to the separator is consumed from the port, and
+        nothing after it, so it's left for the client that talks to the
+        device next.
 
         :param port: the serial port to monitor
         :param timeout: The maximum number of seconds to monitor for.
                         None to wait indefinitely
-        :return bool:
+        :param continue_test: Checked at least every 0.2s, stop monitoring once it returns False
+        :param cancel: If cancelled, raise `Cancelled` promptly
+        :return: The header, None if there wasn't one.
         """
-        terminator = "\r\n"
-        boot_header_separator = "=" * 62
-        if continue_test is None:
-            continue_test = lambda: True
-
-        timer = Timeout(timeout) if timeout else TimeoutNever()
-        while continue_test() and not timer.expired:
-            time.sleep(0.2)
-            boot_header_size = 10  # Number of lines including the separator & starting blank line
-            boot_header_separator_count = 0
-            line_count = 0
-            while port.in_waiting > 0:
-                line = port.readline().decode("utf-8", "ignore")
-                line = line.rstrip(terminator)
-                line_count += 1
-                if line == boot_header_separator:
-                    boot_header_separator_count += 1
-                if boot_header_separator_count == 2 and line_count == boot_header_size:
-                    return True
-        return False
+        mark(port, BOOT_HEADER_MARK)
+        parser = ProtocolParser(port, cancel_token=cancel, read_ahead=False)
+        return await_boot_header(
+            parser.next_token, timeout or None, with_prompt=False, keep_waiting=continue_test or (lambda: True)
+        )
@@ -0,0 +1,387 @@
+import gzip
+import logging
+import struct
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+import serial
+
+from .transport import ScheduledTransport, Transport
+
+logger = logging.getLogger(__name__)
+
+# A recording is a gzip stream of a header followed by one record per chunk
+# of data read or written. Each record holds the time since the previous one
+# in microseconds, so a gap is capped at ~71 minutes.
+MAGIC = b"PJSR"
+VERSION = 1
+_HEADER = struct.Struct("<4sBd")  # magic, version, wall clock time the recording started
+_RECORD = struct.Struct("<BII")  # kind, microseconds since the previous record, length of the data
+
+# Record kinds
+READ = 0  # From the device
+WRITE = 1  # To the device
+MARK = 2  # A note, eg. where a unit starts
+
+SUFFIX = ".pjsr"
+
+
+@dataclass
+class RecordedChunk:
+    at: float  # Seconds since the recording started
+    kind: int
+    data: bytes
+
+
+@dataclass
+class Recording:
+    started: float
+    chunks: List[RecordedChunk]
+
+    def data(self, kind: int) -> bytes:
+        """All of the data of the given kind, eg. everything the device sent."""
+        return b"".join(chunk.data for chunk in self.chunks if chunk.kind == kind)
+
+
+class SessionRecorder:
+    """Writes timestamped, direction-tagged serial data to a recording file."""
+
+    # Reads this close together are stored as one record, as they're typically
+    # one response that arrived in pieces
+    coalesce_reads = 0.002
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._file = gzip.open(self.path, "wb", compresslevel=1)
+        self._last = time.monotonic()
+        self._read = bytearray()
+        self._read_delta = 0
+        self._read_last = 0.0
+        self._file.write(_HEADER.pack(MAGIC, VERSION, time.time()))
+
+    def record(self, kind: int, data: bytes) -> None:
+        with self._lock:
+            if self._file is None:
+                return
+            now = time.monotonic()
+            if kind == READ and self._read and now - self._read_last < self.coalesce_reads:
+                self._read += data
+                self._read_last = now
+                return
+            self._flush_read()
+            if kind == READ:
+                self._read_delta = self._delta(now)
+                self._read += data
+                self._read_last = now
+            else:
+                self._file.write(_RECORD.pack(kind, self._delta(now), len(data)))
+                self._file.write(data)
+                # So that if the jig dies only the response to the last write is lost
+                self._file.flush()
+
+    def mark(self, note: str) -> None:
+        self.record(MARK, note.encode())
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._flush_read()
+                self._file.close()
+                self._file = None
+
+    def _delta(self, now: float) -> int:
+        delta = min(int((now - self._last) * 1e6), 0xFFFFFFFF)
+        self._last = now
+        return delta
+
+    def _flush_read(self) -> None:
+        if self._read:
+            self._file.write(_RECORD.pack(READ, self._read_delta, len(self._read)))
+            self._file.write(self._read)
+            self._read.clear()
+
+
+def read_recording(path: Path) -> Recording:
+    """Reads a recording written by `SessionRecorder`. A truncated last record, eg. from a crash, is dropped."""
+    content = bytearray()
+    with gzip.open(path, "rb") as f:
+        try:
+            while True:
+                block = f.read(65536)
+                if not block:
+                    break
+                content += block
+        except EOFError:
+            # The recording wasn't closed, eg. the jig crashed, keep what was written
+            pass
+    if len(content) < _HEADER.size:
+        raise ValueError(f"{path} is not a recording")
+    magic, version, started = _HEADER.unpack_from(content)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"{path} is not a version {VERSION} recording")
+
+    chunks = []
+    at = 0.0
+    pos = _HEADER.size
+    while pos + _RECORD.size <= len(content):
+        kind, delta, length = _RECORD.unpack_from(content, pos)
+        pos += _RECORD.size
+        if pos + length > len(content):
+            break
+        at += delta / 1e6
+        chunks.append(RecordedChunk(at, kind, bytes(content[pos : pos + length])))
+        pos += length
+    return Recording(started, chunks)
+
+
+class RecordingTransport(Transport):
+    """
+    Passes everything through to another transport and records it. Each time
+    the port is opened a new recording is started in `directory`, and only the
+    `keep` most recent recordings are kept.
+    """
+
+    def __init__(self, port: Transport, directory: Path, keep: int = 200):
+        self._port = port
+        self._directory = Path(directory)
+        self._keep = keep
+        self.recorder: Optional[SessionRecorder] = None
+
+    def __getattr__(self, name):
+        # Anything else, eg. `baudrate`, is the wrapped port's
+        return getattr(self._port, name)
+
+    @property
+    def port(self):
+        return self._port.port
+
+    @port.setter
+    def port(self, port):
+        self._port.port = port
+
+    @property
+    def baudrate(self) -> int:
+        return self._port.baudrate
+
+    @baudrate.setter
+    def baudrate(self, baudrate: int) -> None:
+        self._port.baudrate = baudrate
+
+    @property
+    def timeout(self) -> Optional[float]:
+        return self._port.timeout
+
+    @timeout.setter
+    def timeout(self, timeout: Optional[float]) -> None:
+        self._port.timeout = timeout
+
+    @property
+    def write_timeout(self) -> Optional[float]:
+        return self._port.write_timeout
+
+    @write_timeout.setter
+    def write_timeout(self, timeout: Optional[float]) -> None:
+        self._port.write_timeout = timeout
+
+    @property
+    def is_open(self) -> bool:
+        return self._port.is_open
+
+    def open(self) -> None:
+        self._port.open()
+        self._start_recording()
+
+    def close(self) -> None:
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+        self._port.close()
+
+    @property
+    def in_waiting(self) -> int:
+        return self._port.in_waiting
+
+    def read(self, size: int = 1) -> bytes:
+        data = self._port.read(size)
+        if data and self.recorder is not None:
+            self.recorder.record(READ, data)
+        return data
+
+    def write(self, data: bytes) -> int:
+        written = self._port.write(data)
+        if self.recorder is not None:
+            self.recorder.record(WRITE, bytes(data[:written]))
+        return written
+
+    def reset_input_buffer(self) -> None:
+        self._port.reset_input_buffer()
+
+    def fileno(self) -> int:
+        return self._port.fileno()
+
+    def mark(self, note: str) -> None:
+        """Adds a note to the recording, eg. to show where a unit starts."""
+        if self.recorder is not None:
+            self.recorder.mark(note)
+
+    def _start_recording(self) -> None:
+        try:
+            self._directory.mkdir(parents=True, exist_ok=True)
+            now = time.time()
+            name = time.strftime("%Y%m%d-%H%M%S", time.localtime(now)) + f"-{int(now * 1e6) % 1000000:06d}{SUFFIX}"
+            self.recorder = SessionRecorder(self._directory / name)
+            self._remove_old_recordings()
+        except OSError as e:
+            # Recording is a diagnostic, it mustn't stop the jig
+            logger.error(f"Unable to record session: {e}")
+            self.recorder = None
+
+    def _remove_old_recordings(self) -> None:
+        # The names sort by when they were recorded
+        recordings = sorted(self._directory.glob(f"*{SUFFIX}"))
+        for path in recordings[: max(len(recordings) - self._keep, 0)]:
+            path.unlink()
+
+
+class ReplayDivergence(serial.SerialException):
+    """What was written doesn't match the recording."""
+
+
+class ReplayTransport(ScheduledTransport):
+    """
+    Plays a recording back as the device. Whatever the device sent after each
+    write, or note (see `mark`), is released relative to when that write or
+    note is replayed, so the timing follows the jig rather than the wall clock
+    of the recording.
+
+    :param speed: How many times faster than originally to play the recording,
+                  `float("inf")` for no delays at all.
+    :param max_gap: If set, the longest pause in seconds (before `speed`) between
+                    chunks from the device, eg. to skip the operator's waits.
+    :param strict: Raise `ReplayDivergence` when a write doesn't match the
+                   recording, rather than only noting it in `divergences`.
+                   A command that only differs in its arguments isn't a
+                   divergence, and the device's echo of it is changed to match.
+    """
+
+    def __init__(self, recording: Recording, speed: float = 1.0, max_gap: Optional[float] = None, strict=False):
+        super().__init__("replay://")
+        self.recording = recording
+        self.speed = speed
+        self.max_gap = max_gap
+        self.strict = strict
+        self.divergences: List[tuple] = []
+        self._chunks = recording.chunks
+        self._pos = 0
+        self._expected = bytearray()
+        # Echoes in the recording to replace with what was written instead
+        self._echoes: List[Tuple[bytes, bytes]] = []
+        with self._cond:
+            self._schedule_reads(time.monotonic(), 0.0)
+
+    @property
+    def finished(self) -> bool:
+        """Whether all of the recording has been played."""
+        return self._pos >= len(self._chunks) and not self._pending
+
+    def mark(self, note: str) -> None:
+        """
+        Releases what the device sent after the same note in the recording,
+        relative to now. This is how output that wasn't caused by a write, eg.
+        the boot header after a reset, is kept in step with the jig.
+        """
+        with self._cond:
+            for i in range(self._pos, len(self._chunks)):
+                chunk = self._chunks[i]
+                if chunk.kind == MARK and chunk.data == note.encode():
+                    break
+            else:
+                return
+            now = time.monotonic()
+            for chunk in self._chunks[self._pos : i]:
+                if chunk.kind == READ:
+                    self._play(now, chunk.data)
+                elif chunk.kind == WRITE:
+                    self._diverged(chunk.data, b"")
+            self._pos = i + 1
+            self._schedule_reads(now, chunk.at)
+
+    def _received(self, data: bytes) -> None:
+        now = time.monotonic()
+        written_at = None
+        # Match the write against the next recorded writes. Any device output
+        # recorded before them is released straight away.
+        while len(self._expected) < len(data) and self._pos < len(self._chunks):
+            chunk = self._chunks[self._pos]
+            self._pos += 1
+            if chunk.kind == WRITE:
+                self._expected += chunk.data
+                written_at = chunk.at
+            elif chunk.kind == READ:
+                self._play(now, chunk.data)
+
+        expected = bytes(self._expected[: len(data)])
+        del self._expected[: len(data)]
+        if expected != data:
+            if _same_command(expected, data):
+                # Eg. a serial generated from the time, the device echoes whatever was written
+                self._echoes.append((expected.rstrip(b"\r"), data.rstrip(b"\r")))
+            else:
+                self._diverged(expected, data)
+        if written_at is not None:
+            self._schedule_reads(now, written_at)
+
+    def _diverged(self, expected: bytes, written: bytes) -> None:
+        self.divergences.append((expected, written))
+        logger.warning(f"Replay diverged, expected {expected!r} but got {written!r}")
+        if self.strict:
+            raise ReplayDivergence(f"Expected {expected!r} but got {written!r}")
+
+    def _schedule_reads(self, now: float, recorded_at: float) -> None:
+        # Schedule the device output up to the next recorded write or note
+        due = now
+        previous = recorded_at
+        while self._pos < len(self._chunks) and self._chunks[self._pos].kind == READ:
+            chunk = self._chunks[self._pos]
+            gap = chunk.at - previous
+            if self.max_gap is not None:
+                gap = min(gap, self.max_gap)
+            due += gap / self.speed
+            previous = chunk.at
+            self._play(due, chunk.data)
+            self._pos += 1
+
+    def _play(self, due: float, data: bytes) -> None:
+        for echo in list(self._echoes):
+            recorded, written = echo
+            if recorded in data:
+                data = data.replace(recorded, written, 1)
+                self._echoes.remove(echo)
+        self._schedule(due, data)
+
+
+def _same_command(recorded: bytes, written: bytes) -> bool:
+    # Whole lines of the same command, with different arguments
+    if not recorded.endswith(b"\r") or not written.endswith(b"\r"):
+        return False
+    return recorded.split(maxsplit=1)[:1] == written.split(maxsplit=1)[:1]
+
+
+def open_replay(url: str) -> ReplayTransport:
+    """Creates a transport that plays back a recording from a URL like
+    `replay:///var/log/jig/20240101-120000-000001.pjsr?speed=10&max_gap=1&strict=1`"""
+    parsed = urlparse(url)
+    query = {name: values[-1] for name, values in parse_qs(parsed.query).items()}
+    speed = float(query.pop("speed", 1))
+    max_gap = float(query.pop("max_gap")) if "max_gap" in query else None
+    strict = query.pop("strict", "0").lower() in ("1", "true", "yes")
+    if query:
+        raise ValueError(f"Unknown replay options: {', '.join(query)}")
+    port = ReplayTransport(read_recording(Path(parsed.netloc + parsed.path)), speed, max_gap, strict)
+    port.port = url
+    return port
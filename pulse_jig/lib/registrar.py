@@ -1,14 +1,17 @@
 import enum
 import logging
 import threading
-from time import sleep
+from time import monotonic, sleep
 from typing import Optional
 
 import requests
 
 from pulse_jig.config import settings
 from .api import Api
+from .cancel import CancelToken
 from .hwspec import HWSpec
+from .measurements import Measurements
+from .transcript import Transcript
 
 logger = logging.getLogger("registrar")
 
@@ -44,6 +47,8 @@ class Registrar:
     def __init__(self):
         self._api = Api()
         self._network = NetworkStatus.NOT_CONNECTED
+        # Notified whenever the network status is set, see `wait_for_network`
+        self._network_changed = threading.Condition()
 
     def register_serial(
         self,
@@ -80,27 +85,29 @@ class Registrar:
             response = self._api.add_item(data)
             return True if response.status_code == 201 else False
         except requests.exceptions.ConnectionError:
-            self._network = NetworkStatus.NOT_CONNECTED
+            self._set_network(NetworkStatus.NOT_CONNECTED)
             return False
         except requests.exceptions.ReadTimeout:
-            self._network = NetworkStatus.TIMEOUT
+            self._set_network(NetworkStatus.TIMEOUT)
             return False
         except requests.exceptions.RequestException:
-            self._network = NetworkStatus.ERROR
+            self._set_network(NetworkStatus.ERROR)
             return False
 
     def submit_provisioning_record(
         self,
         hwspec: HWSpec,
         status: str,
-        logs: str,
+        logs: Transcript,
         test_firmware_version: str,
         prod_firmware_version: str = "",
         region_ch_plan: str = "",
+        measurements: Optional[Measurements] = None,
     ):
         data = {
             "status": status,
-            "log": logs,
+            # The transcript is only rendered to flat text here, as it's uploaded
+            "log": logs.render(),
             "provisioning_firmware_ver": test_firmware_version,
             "provisioning_client_ver": self._get_provisioning_client_ver(),
         }
@@ -111,17 +118,20 @@ class Registrar:
         if region_ch_plan != "":
             data["region_ch_plan"] = region_ch_plan
 
+        if measurements and settings.app.submit_measurements:
+            data["measurements"] = measurements.to_dict()
+
         try:
             response = self._api.provisioning_record(hwspec.serial, data)
             return True if response.status_code == 201 else False
         except requests.exceptions.ConnectionError:
-            self._network = NetworkStatus.NOT_CONNECTED
+            self._set_network(NetworkStatus.NOT_CONNECTED)
             return False
         except requests.exceptions.ReadTimeout:
-            self._network = NetworkStatus.TIMEOUT
+            self._set_network(NetworkStatus.TIMEOUT)
             return False
         except requests.exceptions.RequestException:
-            self._network = NetworkStatus.ERROR
+            self._set_network(NetworkStatus.ERROR)
             return False
 
     @threaded
@@ -129,15 +139,15 @@ class Registrar:
         while True:
             try:
                 if self._api.auth_check().status_code == 200:
-                    self._network = NetworkStatus.CONNECTED
+                    self._set_network(NetworkStatus.CONNECTED)
                 else:
-                    self._network = NetworkStatus.ERROR
+                    self._set_network(NetworkStatus.ERROR)
             except requests.exceptions.ConnectionError:
-                self._network = NetworkStatus.NOT_CONNECTED
+                self._set_network(NetworkStatus.NOT_CONNECTED)
             except requests.exceptions.ReadTimeout:
-                self._network = NetworkStatus.TIMEOUT
+                self._set_network(NetworkStatus.TIMEOUT)
             except requests.exceptions.RequestException:
-                self._network = NetworkStatus.ERROR
+                self._set_network(NetworkStatus.ERROR)
             logger.debug(f"network_check(): {self._network.value}")
             sleep(settings.network.ping_interval)
 
@@ -145,6 +155,30 @@ class Registrar:
     def network_status(self) -> NetworkStatus:
         return self._network
 
+    def wait_for_network(self, timeout: Optional[float] = None, cancel: Optional[CancelToken] = None) -> bool:
+        """Blocks until the network is connected, woken as soon as a check or request finds it is.
+
+        :param timeout: Maximum seconds to wait. None to wait indefinitely.
+        :param cancel: If cancelled, raise `Cancelled` promptly
+        :return: Whether the network is connected.
+        """
+        deadline = None if timeout is None else monotonic() + timeout
+        with self._network_changed:
+            while self._network != NetworkStatus.CONNECTED:
+                if cancel is not None:
+                    cancel.raise_if_cancelled()
+                wait = None if deadline is None else deadline - monotonic()
+                if wait is not None and wait <= 0:
+                    return False
+                # Wake up now and then to check for being cancelled
+                self._network_changed.wait(0.1 if cancel is not None and (wait is None or wait > 0.1) else wait)
+            return True
+
+    def _set_network(self, status: NetworkStatus):
+        with self._network_changed:
+            self._network = status
+            self._network_changed.notify_all()
+
     @staticmethod
     def _get_provisioning_client_ver() -> str:
         return settings.VERSION
@@ -0,0 +1,153 @@
+import json
+import logging
+import os
+import time
+from collections import deque
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Deque, Dict, List, Optional, Union
+
+logger = logging.getLogger("timeout_policy")
+
+
+def command_key(cmd: str) -> str:
+    """The command's name, ie. the command without its parameters"""
+    return cmd.split(" ", 1)[0]
+
+
+def timeout_key(cmd: str) -> str:
+    """The name a command's durations are recorded against: its name, and `-v` if it's run
+    verbose, as a test's verbose output can take much longer to send than its quiet result"""
+    name, *args = cmd.split(" ")
+    return f"{name} -v" if "-v" in args else name
+
+
+@dataclass
+class TimeoutCut:
+    """Audit entry for a command that timed out on an adaptive deadline shorter than its ceiling."""
+
+    command: str
+    deadline: float
+    ceiling: float
+    at: float
+
+
+class AdaptiveTimeoutPolicy:
+    """
+    Derives command timeouts from the durations previously observed for the
+    same command, so a hung device is given up on long before the worst case
+    ceiling the caller passes in. A test's quiet and verbose runs are told
+    apart, see `timeout_key`.
+
+    The deadline is a high percentile of the recorded durations plus a margin,
+    but never more than the ceiling. Until a command has `min_samples`
+    durations recorded the ceiling is used as is. Durations are persisted to
+    `path` as JSON so they survive restarts.
+    """
+
+    def __init__(
+        self,
+        path: Optional[Union[str, Path]] = None,
+        percentile: float = 0.99,
+        margin: float = 0.25,
+        min_margin: float = 0.5,
+        min_samples: int = 20,
+        max_samples: int = 200,
+        overrides: Optional[Dict[str, float]] = None,
+        save_every: int = 10,
+    ):
+        """
+        :param path: JSON file to load and save durations from. None to keep them in memory only.
+        :param percentile: Percentile (0-1) of the observed durations the deadline is based on.
+        :param margin: Fraction of the percentile added on top of it.
+        :param min_margin: Minimum seconds added on top of the percentile.
+        :param min_samples: Number of durations needed before a command's deadline is adapted.
+        :param max_samples: Number of most recent durations kept per command.
+        :param overrides: Fixed timeouts per command name, eg. `{"test-port": 30}`. These replace the
+                          ceiling and are never adapted.
+        :param save_every: Number of durations recorded between saves to `path`.
+        """
+        self._path = Path(path) if path is not None else None
+        self._percentile = percentile
+        self._margin = margin
+        self._min_margin = min_margin
+        self._min_samples = min_samples
+        self._max_samples = max_samples
+        self._overrides = dict(overrides or {})
+        self._save_every = save_every
+        self._unsaved = 0
+        self._samples: Dict[str, Deque[float]] = {}
+        self.audit: List[TimeoutCut] = []
+        self._load()
+
+    def timeout(self, cmd: str, ceiling: Optional[float]) -> Optional[float]:
+        """Returns the timeout to use for the given command.
+
+        :param cmd: The command, including any parameters.
+        :param ceiling: The longest the command may take. None or 0 for no timeout, which is never adapted.
+        """
+        name = command_key(cmd)
+        if name in self._overrides:
+            return self._overrides[name]
+        if not ceiling:
+            return ceiling
+        return self._deadline(timeout_key(cmd), ceiling)
+
+    def record(self, cmd: str, duration: float) -> None:
+        """Records the duration of a command that completed."""
+        self._record(timeout_key(cmd), duration)
+
+    def record_timeout(self, cmd: str, deadline: Optional[float], ceiling: Optional[float]) -> None:
+        """Records that a command timed out. If the deadline was cut short by
+        this policy it's added to the audit log."""
+        if deadline and ceiling and deadline < ceiling and command_key(cmd) not in self._overrides:
+            cut = TimeoutCut(command=cmd, deadline=deadline, ceiling=ceiling, at=time.time())
+            self.audit.append(cut)
+            logger.warning(f"Adaptive timeout of {deadline:.2f}s (ceiling {ceiling}s) cut `{cmd}` short")
+
+    def samples(self, cmd: str) -> List[float]:
+        return list(self._samples.get(timeout_key(cmd), ()))
+
+    def save(self) -> None:
+        if self._path is None:
+            return
+        self._unsaved = 0
+        # Write to a temp file first so a power cut can't leave a truncated file behind
+        tmp = self._path.with_name(self._path.name + ".tmp")
+        try:
+            self._path.parent.mkdir(parents=True, exist_ok=True)
+            with open(tmp, "w") as f:
+                json.dump({key: list(samples) for key, samples in self._samples.items()}, f)
+            os.replace(tmp, self._path)
+        except OSError as e:
+            logger.error(f"Could not save timeout history to {self._path}: {e}")
+
+    def _deadline(self, key: str, ceiling: float) -> float:
+        samples = self._samples.get(key)
+        if samples is None or len(samples) < self._min_samples:
+            return ceiling
+        ordered = sorted(samples)
+        p = ordered[min(int(self._percentile * len(ordered)), len(ordered) - 1)]
+        return min(ceiling, p + max(p * self._margin, self._min_margin))
+
+    def _record(self, key: str, duration: float) -> None:
+        samples = self._samples.get(key)
+        if samples is None:
+            samples = self._samples[key] = deque(maxlen=self._max_samples)
+        samples.append(duration)
+        self._unsaved += 1
+        if self._unsaved >= self._save_every:
+            self.save()
+
+    def _load(self) -> None:
+        if self._path is None or not self._path.exists():
+            return
+        try:
+            with open(self._path) as f:
+                data = json.load(f)
+            for key, samples in data.items():
+                self._samples[key] = deque((float(s) for s in samples), maxlen=self._max_samples)
+        except (OSError, ValueError, TypeError, AttributeError) as e:
+            # Losing the history only means falling back to the ceilings
+            logger.error(f"Could not load timeout history from {self._path}: {e}")
+            self._samples.clear()
@@ -0,0 +1,143 @@
+import tempfile
+import time
+from dataclasses import dataclass
+from typing import IO, List, Optional
+
+
+@dataclass
+class CommandRecord:
+    """
+    A single command sent to the device. The raw text of the exchange is held by
+    the transcript between `offset` and `end_offset`.
+    """
+
+    command: str
+    start: float
+    offset: int
+    end: Optional[float] = None
+    end_offset: Optional[int] = None
+    ack: Optional[str] = None
+    body_lines: int = 0
+    # When the ack was received
+    acked: Optional[float] = None
+    # Bytes of the device's response, from the echo to the end of the ack or body. None if it wasn't echoed
+    bytes_in: Optional[int] = None
+
+    @property
+    def duration(self) -> Optional[float]:
+        return None if self.end is None else self.end - self.start
+
+    @property
+    def ack_latency(self) -> Optional[float]:
+        return None if self.acked is None else self.acked - self.start
+
+    @property
+    def body_latency(self) -> Optional[float]:
+        return None if self.acked is None or self.end is None else self.end - self.acked
+
+
+class Transcript:
+    """
+    Records everything sent to and received from a device along with a record
+    per command.
+
+    Text is stored UTF-8 encoded, with small appends joined into chunks. Once
+    the chunks held in memory exceed `max_memory` bytes the oldest are spilled
+    to a temporary file. The flat text is only rendered when asked for.
+    """
+
+    def __init__(self, max_memory: int = 1024 * 1024, chunk_size: int = 64 * 1024):
+        """
+        :param max_memory: Maximum bytes of text to hold in memory before spilling to disk.
+        :param chunk_size: Size that small appends are joined into.
+        """
+        self._max_memory = max_memory
+        self._chunk_size = chunk_size
+        self._spill: Optional[IO[bytes]] = None
+        self.clear()
+
+    def clear(self):
+        if self._spill is not None:
+            self._spill.close()
+        self._spill = None
+        self._spilled = 0
+        self._chunks: List[bytes] = []
+        self._pending: List[bytes] = []
+        self._pending_size = 0
+        self._memory = 0
+        self._size = 0
+        self.records: List[CommandRecord] = []
+
+    def __len__(self) -> int:
+        """Size of the transcript in bytes."""
+        return self._size
+
+    @property
+    def spilled(self) -> int:
+        """Number of bytes that have been spilled to disk."""
+        return self._spilled
+
+    def append(self, text: str):
+        if not text:
+            return
+        data = text.encode("utf-8")
+        self._pending.append(data)
+        self._pending_size += len(data)
+        self._memory += len(data)
+        self._size += len(data)
+        if self._pending_size >= self._chunk_size:
+            self._seal()
+        if self._memory > self._max_memory:
+            self._spill_chunks()
+
+    def begin_command(self, command: str) -> CommandRecord:
+        record = CommandRecord(command=command, start=time.monotonic(), offset=self._size)
+        self.records.append(record)
+        return record
+
+    def end_command(self, record: CommandRecord, ack: Optional[str], body_lines: int = 0):
+        record.end = time.monotonic()
+        record.end_offset = self._size
+        record.ack = ack
+        record.body_lines = body_lines
+
+    def text(self, start: int = 0, end: Optional[int] = None) -> str:
+        """Renders the text between the given byte offsets."""
+        return self._read(start, self._size if end is None else end).decode("utf-8", "replace")
+
+    def render(self) -> str:
+        return self.text()
+
+    def __str__(self) -> str:
+        return self.render()
+
+    def _seal(self):
+        if self._pending:
+            self._chunks.append(b"".join(self._pending))
+            self._pending = []
+            self._pending_size = 0
+
+    def _spill_chunks(self):
+        self._seal()
+        if self._spill is None:
+            self._spill = tempfile.TemporaryFile()
+        self._spill.seek(0, 2)
+        # Spill down to half the cap so we aren't spilling on every append
+        while self._chunks and self._memory > self._max_memory // 2:
+            chunk = self._chunks.pop(0)
+            self._spill.write(chunk)
+            self._spilled += len(chunk)
+            self._memory -= len(chunk)
+
+    def _read(self, start: int, end: int) -> bytes:
+        parts = []
+        if start < self._spilled:
+            self._spill.seek(start)
+            parts.append(self._spill.read(min(end, self._spilled) - start))
+        offset = self._spilled
+        for chunk in self._chunks + self._pending:
+            chunk_end = offset + len(chunk)
+            if chunk_end > start and offset < end:
+                parts.append(chunk[max(start - offset, 0) : end - offset])
+            offset = chunk_end
+        return b"".join(parts)
@@ -0,0 +1,487 @@
+import abc
+import array
+import fcntl
+import heapq
+import io
+import os
+import select
+import socket
+import struct
+import termios
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+import serial
+import serial.rfc2217
+from serial.urlhandler import protocol_socket
+
+# From linux/serial.h, not exposed by the termios module
+_ASYNC_LOW_LATENCY = 0x2000
+
+BACKENDS = ("serial", "rawfd")
+
+# The rate the xDot's firmware starts at, see `JigClient.negotiate_baudrate`
+DEFAULT_BAUDRATE = 115200
+
+# Device URLs that are served over the network, eg. by ser2net
+NETWORK_SCHEMES = ("rfc2217://", "socket://")
+
+
+class Transport(abc.ABC):
+    """
+    The subset of the pyserial `Serial` interface that `JigClient`,
+    `ProtocolParser` and `PulseManager.check_for_header` use to talk to a
+    device. Any pyserial port is a `Transport`, so are the backends below.
+
+    Like pyserial, `read` blocks until `size` bytes have arrived or `timeout`
+    seconds have passed (None to block indefinitely, 0 to not block at all)
+    and failures raise `serial.SerialException`.
+    """
+
+    timeout: Optional[float]
+    write_timeout: Optional[float]
+    baudrate: int
+
+    @abc.abstractmethod
+    def open(self) -> None:
+        pass
+
+    @abc.abstractmethod
+    def close(self) -> None:
+        pass
+
+    @property
+    @abc.abstractmethod
+    def is_open(self) -> bool:
+        pass
+
+    @property
+    @abc.abstractmethod
+    def in_waiting(self) -> int:
+        """Number of bytes that can be read without blocking."""
+
+    @abc.abstractmethod
+    def read(self, size: int = 1) -> bytes:
+        pass
+
+    @abc.abstractmethod
+    def write(self, data: bytes) -> int:
+        pass
+
+    @abc.abstractmethod
+    def reset_input_buffer(self) -> None:
+        pass
+
+    def fileno(self) -> int:
+        """File descriptor that can be waited on for data, if the transport has one."""
+        raise io.UnsupportedOperation("fileno")
+
+
+Transport.register(serial.SerialBase)
+
+
+class RawFdTransport(Transport):
+    """
+    Talks to a tty through its file descriptor with `os.read`/`os.write`,
+    bypassing pyserial. The tty is put in raw, non-blocking mode with the
+    driver's low latency flag set where supported, and a read only falls back
+    to `select` when there's nothing to read already. Changing `timeout` is
+    just an attribute write rather than a tty reconfiguration.
+
+    Like `serial.Serial`, the tty is opened straight away if `port` is given,
+    otherwise it's opened by `open` once `port` has been set.
+    """
+
+    def __init__(
+        self,
+        port: Optional[str] = None,
+        baudrate: int = DEFAULT_BAUDRATE,
+        timeout: Optional[float] = None,
+        write_timeout: Optional[float] = None,
+    ):
+        self.port = port
+        self._baudrate = baudrate
+        self.timeout = timeout
+        self.write_timeout = write_timeout
+        self._fd: Optional[int] = None
+        if port is not None:
+            self.open()
+
+    @property
+    def baudrate(self) -> int:
+        return self._baudrate
+
+    @baudrate.setter
+    def baudrate(self, baudrate: int) -> None:
+        self._baudrate = baudrate
+        if self._fd is not None:
+            self._configure(self._fd)
+
+    @property
+    def is_open(self) -> bool:
+        return self._fd is not None
+
+    def open(self) -> None:
+        if self._fd is not None:
+            raise serial.SerialException("Port is already open.")
+        if self.port is None:
+            raise serial.SerialException("Port must be configured before it can be used.")
+        try:
+            fd = os.open(self.port, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+        except OSError as e:
+            raise serial.SerialException(e.errno, f"could not open port {self.port}: {e}")
+        try:
+            self._configure(fd)
+            self._set_low_latency(fd)
+        except (OSError, termios.error) as e:
+            os.close(fd)
+            raise serial.SerialException(f"could not configure port {self.port}: {e}")
+        self._fd = fd
+
+    def close(self) -> None:
+        if self._fd is not None:
+            fd, self._fd = self._fd, None
+            os.close(fd)
+
+    def fileno(self) -> int:
+        return self._checked_fd()
+
+    @property
+    def in_waiting(self) -> int:
+        buf = fcntl.ioctl(self._checked_fd(), termios.FIONREAD, b"\0\0\0\0")
+        return struct.unpack("I", buf)[0]
+
+    def read(self, size: int = 1) -> bytes:
+        fd = self._checked_fd()
+        if size <= 0:
+            return b""
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        data = bytearray()
+        readable = False
+        while True:
+            try:
+                chunk = os.read(fd, size - len(data))
+            except BlockingIOError:
+                chunk = b""
+            except OSError as e:
+                raise serial.SerialException(f"read failed: {e}")
+            if chunk:
+                data += chunk
+                if len(data) >= size:
+                    break
+                readable = False
+                continue
+            if readable:
+                # select said there was data, so the device has gone away
+                raise serial.SerialException("device reports readiness to read but returned no data")
+
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                break
+            readable = bool(select.select([fd], [], [], remaining)[0])
+            if not readable:
+                break
+        return bytes(data)
+
+    def write(self, data: bytes) -> int:
+        fd = self._checked_fd()
+        deadline = None if self.write_timeout is None else time.monotonic() + self.write_timeout
+        view = memoryview(data)
+        written = 0
+        while written < len(view):
+            try:
+                written += os.write(fd, view[written:])
+                continue
+            except BlockingIOError:
+                pass
+            except OSError as e:
+                raise serial.SerialException(f"write failed: {e}")
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                raise serial.SerialTimeoutException("Write timeout")
+            select.select([], [fd], [], remaining)
+        return written
+
+    def flush(self) -> None:
+        """Waits until all written data has been transmitted."""
+        termios.tcdrain(self._checked_fd())
+
+    def reset_input_buffer(self) -> None:
+        termios.tcflush(self._checked_fd(), termios.TCIFLUSH)
+
+    def _checked_fd(self) -> int:
+        if self._fd is None:
+            raise serial.PortNotOpenError()
+        return self._fd
+
+    def _configure(self, fd: int) -> None:
+        iflag, oflag, cflag, lflag, _, _, cc = termios.tcgetattr(fd)
+        iflag &= ~(
+            termios.IGNBRK
+            | termios.BRKINT
+            | termios.PARMRK
+            | termios.ISTRIP
+            | termios.INLCR
+            | termios.IGNCR
+            | termios.ICRNL
+            | termios.IXON
+            | termios.IXOFF
+            | termios.IXANY
+        )
+        oflag &= ~termios.OPOST
+        lflag &= ~(termios.ECHO | termios.ECHONL | termios.ICANON | termios.ISIG | termios.IEXTEN)
+        cflag &= ~(termios.CSIZE | termios.PARENB | termios.CSTOPB)
+        cflag |= termios.CS8 | termios.CLOCAL | termios.CREAD
+        # Reads return straight away with whatever is there, we wait with select
+        cc[termios.VMIN] = 0
+        cc[termios.VTIME] = 0
+        try:
+            speed = getattr(termios, f"B{self._baudrate}")
+        except AttributeError:
+            raise ValueError(f"Unsupported baud rate: {self._baudrate}")
+        termios.tcsetattr(fd, termios.TCSANOW, [iflag, oflag, cflag, lflag, speed, speed, cc])
+
+    @staticmethod
+    def _set_low_latency(fd: int) -> None:
+        # Stops the UART driver from batching received bytes. USB ACM devices
+        # and ptys don't support this, which is fine - they don't batch.
+        try:
+            buf = array.array("i", [0] * 32)
+            fcntl.ioctl(fd, termios.TIOCGSERIAL, buf)
+            buf[4] |= _ASYNC_LOW_LATENCY
+            fcntl.ioctl(fd, termios.TIOCSSERIAL, buf)
+        except (AttributeError, OSError):
+            pass
+
+
+class LoopbackTransport(Transport):
+    """
+    In-memory transport for tests. Everything written is read back, unless a
+    `responder` is given in which case whatever it returns for each write is
+    read back instead. Data can also be injected with `feed`.
+    """
+
+    def __init__(self, responder: Optional[Callable[[bytes], bytes]] = None):
+        self.port = "loopback"
+        self.timeout: Optional[float] = None
+        self.write_timeout: Optional[float] = None
+        self.baudrate = DEFAULT_BAUDRATE
+        self._responder = responder
+        self._buf = bytearray()
+        self._cond = threading.Condition()
+        self._open = True
+
+    @property
+    def is_open(self) -> bool:
+        return self._open
+
+    def open(self) -> None:
+        if self._open:
+            raise serial.SerialException("Port is already open.")
+        self._open = True
+
+    def close(self) -> None:
+        self._open = False
+
+    @property
+    def in_waiting(self) -> int:
+        self._check_open()
+        return len(self._buf)
+
+    def feed(self, data: bytes) -> None:
+        """Makes the given data available to read."""
+        with self._cond:
+            self._buf += data
+            self._cond.notify_all()
+
+    def read(self, size: int = 1) -> bytes:
+        self._check_open()
+        with self._cond:
+            self._cond.wait_for(lambda: len(self._buf) >= size, self.timeout)
+            data = bytes(self._buf[:size])
+            del self._buf[:size]
+        return data
+
+    def write(self, data: bytes) -> int:
+        self._check_open()
+        self.feed(self._responder(bytes(data)) if self._responder is not None else data)
+        return len(data)
+
+    def reset_input_buffer(self) -> None:
+        with self._cond:
+            self._buf.clear()
+
+    def _check_open(self) -> None:
+        if not self._open:
+            raise serial.PortNotOpenError()
+
+
+class ScheduledTransport(Transport):
+    """
+    In-memory transport whose incoming data is scheduled with `_schedule` to
+    arrive at a given `time.monotonic()` time, for devices that are played
+    back or emulated in-process. Subclasses handle what is written with
+    `_received`, which is called with the lock held.
+    """
+
+    def __init__(self, port: str):
+        self.port = port
+        self.timeout: Optional[float] = None
+        self.write_timeout: Optional[float] = None
+        # Only matters to devices that model the line, eg. the emulator
+        self.baudrate = DEFAULT_BAUDRATE
+        self._cond = threading.Condition()
+        self._buf = bytearray()
+        self._pending: List[Tuple[float, int, bytes]] = []
+        self._seq = 0
+        self._open = True
+
+    @property
+    def is_open(self) -> bool:
+        return self._open
+
+    def open(self) -> None:
+        if self._open:
+            raise serial.SerialException("Port is already open.")
+        self._open = True
+
+    def close(self) -> None:
+        self._open = False
+
+    @property
+    def in_waiting(self) -> int:
+        self._check_open()
+        with self._cond:
+            self._release()
+            return len(self._buf)
+
+    def read(self, size: int = 1) -> bytes:
+        self._check_open()
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        with self._cond:
+            while True:
+                self._release()
+                if len(self._buf) >= size:
+                    break
+                now = time.monotonic()
+                if deadline is not None and now >= deadline:
+                    break
+                wait = None if deadline is None else deadline - now
+                if self._pending:
+                    due = self._pending[0][0] - now
+                    wait = due if wait is None else min(wait, due)
+                self._cond.wait(wait)
+            data = bytes(self._buf[:size])
+            del self._buf[:size]
+        return data
+
+    def write(self, data: bytes) -> int:
+        self._check_open()
+        with self._cond:
+            self._received(bytes(data))
+            self._cond.notify_all()
+        return len(data)
+
+    def reset_input_buffer(self) -> None:
+        with self._cond:
+            self._release()
+            self._buf.clear()
+
+    @abc.abstractmethod
+    def _received(self, data: bytes) -> None:
+        pass
+
+    def _schedule(self, due: float, data: bytes) -> None:
+        self._seq += 1
+        heapq.heappush(self._pending, (due, self._seq, data))
+        self._cond.notify_all()
+
+    def _release(self) -> None:
+        now = time.monotonic()
+        while self._pending and self._pending[0][0] <= now:
+            self._buf += heapq.heappop(self._pending)[2]
+
+    def _check_open(self) -> None:
+        if not self._open:
+            raise serial.PortNotOpenError()
+
+
+class _KeepAliveMixin:
+    """
+    Enables TCP keepalive on a network port once it's open, so a connection
+    that dies silently (eg. a pulled cable) is noticed as a read error within
+    `keepalive_timeout` seconds rather than looking like a device that never
+    answers.
+    """
+
+    keepalive_timeout = 10
+
+    def open(self) -> None:
+        super().open()
+        sock = self._socket
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if hasattr(socket, "TCP_KEEPIDLE"):
+            interval = max(self.keepalive_timeout // 4, 1)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, interval)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+
+
+class SocketTransport(_KeepAliveMixin, protocol_socket.Serial):
+    """Raw TCP connection to a remote serial port, eg. `socket://jig-2:4000` served by ser2net."""
+
+
+class Rfc2217Transport(_KeepAliveMixin, serial.rfc2217.Serial):
+    """RFC 2217 connection to a remote serial port, eg. `rfc2217://jig-2:4000` served by ser2net."""
+
+
+def mark(port: Transport, note: str) -> None:
+    """Notes a point in the conversation that isn't a read or write, eg. that
+    the jig has started waiting for a boot header, for transports that record
+    or replay sessions."""
+    marker = getattr(port, "mark", None)
+    if marker is not None:
+        marker(note)
+
+
+def is_network_url(dev: Optional[str]) -> bool:
+    return dev is not None and dev.startswith(NETWORK_SCHEMES)
+
+
+def create_transport(dev: Optional[str], backend: str = "serial", baudrate: int = DEFAULT_BAUDRATE) -> Transport:
+    """Creates a transport for the given device that is opened later with `open`.
+
+    A lost connection to a network device makes reads and writes raise
+    `serial.SerialException` like an unplugged local one, and closing then
+    opening the transport reconnects.
+
+    An `emulator://` URL connects to an emulated device instead, see
+    `emulator.open_emulator`, and a `replay://` URL plays back a recorded
+    session, see `recording.open_replay`.
+
+    :param dev: Path of the device, eg. /dev/ttyACM0, or a `rfc2217://`, `socket://`, `emulator://` or `replay://` URL.
+    :param backend: One of `BACKENDS`. Ignored for network devices.
+    :param baudrate: Baud rate to open the device at.
+    """
+    if dev is not None and dev.startswith("emulator://"):
+        from .emulator import open_emulator
+
+        return open_emulator(dev)
+    if dev is not None and dev.startswith("replay://"):
+        from .recording import open_replay
+
+        return open_replay(dev)
+    if dev is not None and dev.startswith("socket://"):
+        port = SocketTransport(baudrate=baudrate)
+    elif dev is not None and dev.startswith("rfc2217://"):
+        port = Rfc2217Transport(baudrate=baudrate)
+    elif backend == "serial":
+        port = serial.Serial(baudrate=baudrate)
+    elif backend == "rawfd":
+        port = RawFdTransport(baudrate=baudrate)
+    else:
+        raise ValueError(f"Unknown serial backend: {backend}")
+    port.port = dev
+    return port
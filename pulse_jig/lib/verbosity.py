@@ -0,0 +1,72 @@
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+from .timeout_policy import command_key
+
+# Always run test commands with their verbose output
+VERBOSITY_ALWAYS = "verbose"
+# Run test commands without it, and again with it when they fail
+VERBOSITY_ON_FAILURE = "on_failure"
+# Never run test commands with it
+VERBOSITY_QUIET = "quiet"
+VERBOSITIES = (VERBOSITY_ALWAYS, VERBOSITY_ON_FAILURE, VERBOSITY_QUIET)
+
+# Makes a test command print each step and reading rather than only `PASS`/`FAIL`
+VERBOSE_FLAG = "-v"
+
+
+def with_verbose(cmd: str, verbose: bool) -> str:
+    """The test command with or without `VERBOSE_FLAG`, which goes straight after its name."""
+    name, *args = cmd.split(" ")
+    args = [arg for arg in args if arg != VERBOSE_FLAG]
+    return " ".join([name, VERBOSE_FLAG, *args] if verbose else [name, *args])
+
+
+@dataclass
+class _Cost:
+    runs: int = 0
+    seconds: float = 0.0
+    size: int = 0
+
+    def add(self, seconds: float, size: int) -> None:
+        self.runs += 1
+        self.seconds += seconds
+        self.size += size
+
+
+class VerbosityPolicy:
+    """
+    Decides whether test commands are run with their verbose output, see
+    `VERBOSITIES`, and keeps the mean time and output size of each test's
+    quiet and verbose runs to estimate what running quiet saves.
+
+    With `VERBOSITY_ON_FAILURE` the first run of each test is verbose
+    anyway, so there's a verbose run to compare the quiet ones against.
+    """
+
+    def __init__(self, mode: str = VERBOSITY_ON_FAILURE):
+        if mode not in VERBOSITIES:
+            raise ValueError(f"Unknown test verbosity: {mode}")
+        self.mode = mode
+        self._costs: Dict[Tuple[str, bool], _Cost] = {}
+
+    def verbose_first(self, cmd: str) -> bool:
+        """Whether to run the test with its verbose output to begin with."""
+        if self.mode == VERBOSITY_ON_FAILURE:
+            return (command_key(cmd), True) not in self._costs
+        return self.mode == VERBOSITY_ALWAYS
+
+    @property
+    def rerun_on_failure(self) -> bool:
+        return self.mode == VERBOSITY_ON_FAILURE
+
+    def record(self, cmd: str, verbose: bool, seconds: float, size: int) -> None:
+        """Records how long a run of the test took and how many bytes of output it produced."""
+        self._costs.setdefault((command_key(cmd), verbose), _Cost()).add(seconds, size)
+
+    def verbose_cost(self, cmd: str) -> Optional[Tuple[float, int]]:
+        """The mean seconds and bytes of output of the test's verbose runs, None if it hasn't had one."""
+        cost = self._costs.get((command_key(cmd), True))
+        if cost is None:
+            return None
+        return cost.seconds / cost.runs, cost.size // cost.runs
@@ -46,6 +46,7 @@ xhost +local:
   --volume "${APP_DIR}"/settings.yaml:/usr/src/pulse_jig/settings.yaml \
   --volume "${APP_DIR}"/settings.local.yaml:/usr/src/pulse_jig/settings.local.yaml \
   --volume "${APP_DIR}"/pulse_jig/firmware:/usr/src/pulse_jig/firmware \
+  --volume "${APP_DIR}"/data:/root/.local/share/pulse_jig \
   --privileged \
   pulse-jig "$@"
 
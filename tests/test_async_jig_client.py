@@ -0,0 +1,113 @@
+import asyncio
+import os
+import time
+import tty
+
+from pulse_jig.lib.async_jig_client import AsyncJigClient
+from pulse_jig.lib.cancel import Cancelled
+from pulse_jig.lib.jig_client import JigClient
+import serial
+import pytest
+
+
+@pytest.fixture
+def port():
+    return serial.serial_for_url("loop://")
+
+
+def test_send_command_returns_the_body_on_success(port):
+    port.write(b"> SELF_TEST\r\n+OK\r\ntesting watchdog...OK\r\ntesting EEPROM...OK\r\n.\r\n")
+
+    async def run():
+        async with AsyncJigClient(port) as client:
+            return await client.send_command("SELF_TEST")
+
+    body = asyncio.run(run())
+    assert body == "testing watchdog...OK\ntesting EEPROM...OK"
+
+
+def test_send_command_raises_exception_on_error_response(port):
+    port.write(b"SELF_TEST\r\n-ERR\r\n")
+    client = AsyncJigClient(port)
+    with pytest.raises(JigClient.CommandFailed):
+        asyncio.run(client.send_command("SELF_TEST"))
+
+
+def test_send_command_raises_on_body_timeout(port):
+    port.write(b"SELF_TEST\r\n+OK\r\nsome body\r\n")
+    client = AsyncJigClient(port)
+    start = time.monotonic()
+    with pytest.raises(JigClient.CommandTimeout):
+        asyncio.run(client.send_command("SELF_TEST", timeout=0.2))
+    assert time.monotonic() - start < 1
+
+
+def test_probe_await_connect_can_be_cancelled_and_resynced(port):
+    port.write(b"> probe-await connect\r\n+OK\r\n")
+    client = AsyncJigClient(port)
+
+    async def run():
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(client.probe_await_connect(), 0.2)
+        # The device eventually finishes the cancelled command, then answers the next one
+        port.write(b"Found on port: 2\r\n.\r\n> firmware-version\r\n+OK\r\n1.2.3\r\n.\r\n")
+        return await client.firmware_version()
+
+    assert asyncio.run(run()) == "1.2.3"
+
+
+def test_one_loop_drives_several_devices():
+    ports = [serial.serial_for_url("loop://") for _ in range(3)]
+    for i, port in enumerate(ports):
+        port.write(f"> lora-deveui get\r\n+OK\r\n00:00:00:00:00:00:00:0{i}\r\n.\r\n".encode())
+    clients = [AsyncJigClient(port) for port in ports]
+
+    async def run():
+        try:
+            return await asyncio.gather(*(client.lora_deveui() for client in clients))
+        finally:
+            await asyncio.gather(*(client.aclose() for client in clients))
+
+    assert asyncio.run(run()) == [f"00:00:00:00:00:00:00:0{i}" for i in range(3)]
+
+
+def test_closing_cancels_the_command_and_stops_the_thread(port):
+    port.write(b"> probe-await connect\r\n+OK\r\n")
+    client = AsyncJigClient(port)
+
+    async def run():
+        command = asyncio.ensure_future(client.probe_await_connect())
+        await asyncio.sleep(0.1)
+        start = time.monotonic()
+        await client.aclose()
+        assert time.monotonic() - start < 1
+        with pytest.raises(Cancelled):
+            await command
+
+    asyncio.run(run())
+    assert not any(thread.is_alive() for thread in client._executor._threads)
+
+
+def test_has_the_same_api_as_the_sync_client(port):
+    port.write(b"> hwchunk dump probe probe\r\n+OK\r\ncable_length: 5\r\n.\r\n")
+    client = AsyncJigClient(port)
+    assert asyncio.run(client.hwchunk_get_probe()) == "cable_length: 5"
+    assert client.transcript.records[-1].command == "hwchunk dump probe probe"
+
+
+def test_talks_to_a_real_tty():
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    port = serial.Serial(os.ttyname(slave))
+    client = AsyncJigClient(port)
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        loop.call_later(0.05, os.write, master, b"> hwspec-get serial\r\n+OK\r\nW01-02-1234\r\n.\r\n")
+        return await client.hwspec_get("serial")
+
+    try:
+        assert asyncio.run(run()) == "W01-02-1234"
+    finally:
+        port.close()
+        os.close(master)
@@ -0,0 +1,87 @@
+import time
+
+from pulse_jig.lib.boot_header import BootHeaderRecognizer, FirmwareKind
+from pulse_jig.lib.emulator import PROD_FIRMWARE, EmulatorConfig, EmulatorTransport, FirmwareEmulator
+from pulse_jig.lib.jig_client import JigClient
+from pulse_jig.lib.protocol import ProtocolParser
+from pulse_jig.lib.pulse_manager import PulseManager
+from pulse_jig.lib.transport import LoopbackTransport
+
+SEPARATOR = b"=" * 62
+TEST_HEADER = (
+    SEPARATOR + b"\r\nStarting Functional Tests Firmware\r\nFirmware Version: 1.2.3\r\n" + SEPARATOR + b"\r\n> "
+)
+
+
+def _recognize(data: bytes, with_prompt: bool = True) -> BootHeaderRecognizer:
+    parser = ProtocolParser()
+    parser.feed(data)
+    recognizer = BootHeaderRecognizer(with_prompt)
+    token = parser.next_token(0)
+    while token is not None and not recognizer.feed(token):
+        token = parser.next_token(0)
+    return recognizer
+
+
+def test_recognizes_test_firmware():
+    recognizer = _recognize(b"boot log\r\n" + TEST_HEADER)
+    assert recognizer.complete
+    header = recognizer.header
+    assert (header.kind, header.version, header.prompt) == (FirmwareKind.TEST, "1.2.3", True)
+    assert str(header).splitlines() == [
+        "=" * 62,
+        "Starting Functional Tests Firmware",
+        "Firmware Version: 1.2.3",
+        "=" * 62,
+        ">",
+    ]
+
+
+def test_test_firmware_waits_for_the_prompt():
+    recognizer = _recognize(TEST_HEADER[:-2])
+    assert recognizer.closed and not recognizer.complete
+    assert not recognizer.header.prompt
+    assert _recognize(TEST_HEADER[:-2], with_prompt=False).complete
+
+
+def test_production_firmware_has_no_prompt():
+    header = FirmwareEmulator(EmulatorConfig(firmware=PROD_FIRMWARE)).boot_header()
+    recognizer = _recognize(header)
+    assert recognizer.complete
+    assert (recognizer.header.kind, recognizer.header.version) == (FirmwareKind.PRODUCTION, "2.0.0")
+    assert recognizer.header.build == ""
+
+
+def test_recognizes_the_build():
+    header = FirmwareEmulator(EmulatorConfig(test_firmware_build="5f2c1e9")).boot_header()
+    assert _recognize(header).header.build == "5f2c1e9"
+
+
+def test_read_boot_header_returns_once_complete():
+    port = EmulatorTransport(FirmwareEmulator(EmulatorConfig(speed=100)))
+    port.reboot()
+    client = JigClient(port)
+    start = time.monotonic()
+    header = client.read_boot_header()
+    assert header.kind == FirmwareKind.TEST and header.prompt
+    assert time.monotonic() - start < 0.5
+    assert client.read_boot_header(timeout=0.1) is None
+
+
+def test_skip_boot_header_returns_once_complete():
+    port = LoopbackTransport(lambda _: b"")
+    port.feed(TEST_HEADER)
+    start = time.monotonic()
+    JigClient(port).skip_boot_header()
+    assert time.monotonic() - start < 0.5
+
+
+def test_check_for_header():
+    # Doesn't use any of the manager's pins
+    manager = PulseManager.__new__(PulseManager)
+    port = LoopbackTransport()
+    port.feed(TEST_HEADER + b"leftover\r\n")
+    assert manager.check_for_header(port, timeout=1).kind == FirmwareKind.TEST
+    # What follows the header is left for the client
+    assert port.read(port.in_waiting) == b"> leftover\r\n"
+    assert manager.check_for_header(port, timeout=0.1) is None
@@ -0,0 +1,137 @@
+import threading
+import time
+
+import gpiozero
+import pytest
+import serial
+from gpiozero.pins.mock import MockFactory
+
+from pulse_jig.lib.cancel import CancelToken, Cancelled
+from pulse_jig.lib.jig_client import JigClient
+from pulse_jig.lib.pulse_manager import PulseManager
+
+# Blocking I/O is expected to notice a cancel within ~50ms, allow some slack for slow CI machines
+MAX_TEARDOWN_LATENCY = 0.15
+
+
+@pytest.fixture
+def port():
+    return serial.serial_for_url("loop://")
+
+
+@pytest.fixture
+def pulse_manager():
+    gpiozero.Device.pin_factory = MockFactory()
+    manager = PulseManager(reset_pin=5, pcb_sense_pin=6, xdot_volume="/nonexistent")
+    yield manager
+    gpiozero.Device.pin_factory.reset()
+    gpiozero.Device.pin_factory = None
+
+
+def teardown_latency(token: CancelToken, blocking_call, delay: float = 0.1) -> float:
+    """Cancels the token after `delay` seconds and returns how long `blocking_call` took to raise after that."""
+    cancelled_at = []
+
+    def cancel():
+        cancelled_at.append(time.monotonic())
+        token.cancel()
+
+    timer = threading.Timer(delay, cancel)
+    timer.start()
+    try:
+        with pytest.raises(Cancelled):
+            blocking_call()
+    finally:
+        timer.cancel()
+    assert cancelled_at, "the call returned before it was cancelled"
+    return time.monotonic() - cancelled_at[0]
+
+
+def test_cancelling_a_token_cancels_its_children():
+    parent = CancelToken()
+    child = parent.child()
+    parent.cancel()
+    assert child.cancelled
+    assert parent.child().cancelled
+
+
+def test_cancelling_a_child_leaves_the_parent_alone():
+    parent = CancelToken()
+    parent.child().cancel()
+    assert not parent.cancelled
+    assert not parent.child().cancelled
+
+
+def test_sleep_raises_when_cancelled():
+    token = CancelToken()
+    assert teardown_latency(token, lambda: token.sleep(10)) < MAX_TEARDOWN_LATENCY
+
+
+def test_blocking_command_is_aborted_promptly(port):
+    token = CancelToken()
+    client = JigClient(port, cancel_token=token)
+    assert teardown_latency(token, client.probe_await_connect) < MAX_TEARDOWN_LATENCY
+
+
+def test_blocking_command_is_aborted_by_parent_token(port):
+    parent = CancelToken()
+    client = JigClient(port, cancel_token=parent.child())
+    assert teardown_latency(parent, client.probe_await_recovery) < MAX_TEARDOWN_LATENCY
+
+
+def test_client_fails_immediately_once_cancelled(port):
+    token = CancelToken()
+    token.cancel()
+    client = JigClient(port, cancel_token=token)
+    start = time.monotonic()
+    with pytest.raises(Cancelled):
+        client.send_command("SELF_TEST")
+    assert time.monotonic() - start < MAX_TEARDOWN_LATENCY
+
+
+def test_await_removal_is_aborted_promptly(pulse_manager):
+    gpiozero.Device.pin_factory.pin(6).drive_low()
+    token = CancelToken()
+    assert teardown_latency(token, lambda: pulse_manager.await_removal(cancel=token)) < MAX_TEARDOWN_LATENCY
+
+
+def test_await_removal_returns_on_removal(pulse_manager):
+    pin = gpiozero.Device.pin_factory.pin(6)
+    pin.drive_low()
+    threading.Timer(0.1, pin.drive_high).start()
+    pulse_manager.await_removal(cancel=CancelToken())
+    assert not pulse_manager.is_connected
+
+
+def test_await_connection_wakes_on_the_edge_without_spinning(pulse_manager):
+    pin = gpiozero.Device.pin_factory.pin(6)
+    connected_at = []
+
+    def connect():
+        connected_at.append(time.monotonic())
+        pin.drive_low()
+
+    threading.Timer(0.5, connect).start()
+    cpu_start = time.thread_time()
+    pulse_manager.await_connection(cancel=CancelToken())
+    woken_at = time.monotonic()
+    assert pulse_manager.is_connected
+    assert woken_at - connected_at[0] < 0.01
+    # Idle for half a second, the wait should have used a small fraction of that
+    assert time.thread_time() - cpu_start < 0.05
+
+
+def test_await_connection_is_aborted_promptly(pulse_manager):
+    token = CancelToken()
+    assert teardown_latency(token, lambda: pulse_manager.await_connection(cancel=token)) < MAX_TEARDOWN_LATENCY
+
+
+def test_reset_device_releases_reset_when_cancelled(pulse_manager):
+    token = CancelToken()
+    assert teardown_latency(token, lambda: pulse_manager.reset_device(cancel=token), delay=0.05) < MAX_TEARDOWN_LATENCY
+    assert gpiozero.Device.pin_factory.pin(5).state
+
+
+def test_check_for_header_is_aborted_promptly(pulse_manager, port):
+    token = CancelToken()
+    assert teardown_latency(token, lambda: pulse_manager.check_for_header(port, cancel=token)) < MAX_TEARDOWN_LATENCY
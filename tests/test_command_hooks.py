@@ -0,0 +1,118 @@
+import pytest
+import serial
+
+from pulse_jig.lib.command_hooks import CommandHook, LatencyHistogram, LatencyHistogramHook
+from pulse_jig.lib.jig_client import BatchCommand, JigClient
+
+
+@pytest.fixture
+def port():
+    return serial.serial_for_url("loop://")
+
+
+class RecordingHook(CommandHook):
+    def __init__(self):
+        self.before_events = []
+        self.after_events = []
+
+    def before(self, event):
+        self.before_events.append(event)
+
+    def after(self, event):
+        self.after_events.append(event)
+
+
+def test_hooks_see_each_command(port):
+    port.write(b"> hwspec-get serial\r\n+OK\r\nW01-02-1234\r\n.\r\n")
+    client = JigClient(port)
+    hook = RecordingHook()
+    client.add_hook(hook)
+    client.hwspec_get("serial")
+
+    [before] = hook.before_events
+    assert (before.command, before.params, before.bytes_out) == ("hwspec-get", "serial", len("hwspec-get serial\r"))
+    assert before.outcome is None
+
+    [after] = hook.after_events
+    assert after.outcome == "ok"
+    # From the echo to the end of the body
+    assert after.bytes_in == len("hwspec-get serial\r\n+OK\r\nW01-02-1234\r\n.\r\n")
+    assert after.ack_latency >= 0
+    assert after.body_latency >= 0
+
+
+def test_hooks_see_outcome_of_failed_commands(port):
+    port.write(b"> hwspec-get bogus\r\n-ERR unknown key\r\n")
+    client = JigClient(port)
+    hook = RecordingHook()
+    client.add_hook(hook)
+    with pytest.raises(JigClient.CommandFailed):
+        client.hwspec_get("bogus")
+    assert hook.after_events[0].outcome == "error"
+    assert hook.after_events[0].ack_latency is None
+
+
+def test_hooks_see_each_command_in_a_batch(port):
+    port.write(b"> hwspec-get serial\r\n+OK\r\nW01-02-1234\r\n.\r\n")
+    port.write(b"> hwspec-get rev\r\n+OK\r\nr1b\r\n.\r\n")
+    client = JigClient(port)
+    hook = RecordingHook()
+    client.add_hook(hook)
+    client.hwspec_get_many(["serial", "rev"])
+    assert [e.params for e in hook.after_events] == ["serial", "rev"]
+
+
+def test_hooks_count_the_bytes_of_each_pipelined_command(port):
+    responses = [
+        b"> hwspec-get serial\r\n+OK\r\nW01-02-1234\r\n.\r\n",
+        b"> hwspec-set name Jos\xc3\xa9\r\n+OK\r\n",
+        b"> hwspec-get rev\r\n+OK\r\nr1b\r\n\r\n.\r\n",
+    ]
+    port.write(b"".join(responses))
+    client = JigClient(port)
+    hook = RecordingHook()
+    client.add_hook(hook)
+    client.send_commands(["hwspec-get serial", BatchCommand("hwspec-set name José", has_body=False), "hwspec-get rev"])
+    # Each is written before the response to the first is read, so the transcript spans overlap
+    assert [e.bytes_out for e in hook.after_events] == [18, 22, 15]
+    assert [e.bytes_in for e in hook.after_events] == [len(response) - 2 for response in responses]
+
+
+def test_removed_hook_is_not_called(port):
+    port.write(b"> firmware-version\r\n+OK\r\n1.2.3\r\n.\r\n")
+    client = JigClient(port)
+    hook = RecordingHook()
+    client.add_hook(hook)
+    client.remove_hook(hook)
+    client.firmware_version()
+    assert hook.after_events == []
+
+
+def test_histogram_percentiles():
+    histogram = LatencyHistogram()
+    for latency in [0.003] * 90 + [0.3] * 10:
+        histogram.add(latency)
+    assert histogram.percentile(0.5) == 0.005
+    assert histogram.percentile(0.95) == 0.5
+    assert histogram.max == 0.3
+
+
+def test_latency_histogram_hook_aggregates_by_command(port):
+    port.write(b"> firmware-version\r\n+OK\r\n1.2.3\r\n.\r\n")
+    port.write(b"> hwspec-get bogus\r\n-ERR unknown key\r\n")
+    client = JigClient(port)
+    hook = LatencyHistogramHook()
+    client.add_hook(hook)
+    client.firmware_version()
+    with pytest.raises(JigClient.CommandFailed):
+        client.hwspec_get("bogus")
+
+    summary = hook.summary()
+    assert summary["firmware-version"]["count"] == 1
+    assert summary["firmware-version"]["ok"] == 1
+    assert summary["hwspec-get"] == {"count": 0, "error": 1}
+    assert hook.percentile("firmware-version", 0.95) is not None
+    assert "hwspec-get: n=0 error=1" in hook.format()
+
+    hook.reset()
+    assert hook.summary() == {}
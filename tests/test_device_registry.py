@@ -0,0 +1,104 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from pulse_jig.lib.cancel import Cancelled, CancelToken
+from pulse_jig.lib.device_registry import XDOT_PID, XDOT_VID, Device, DeviceEvent, DeviceRegistry, _to_devices
+
+
+def _port(device, vid=XDOT_VID, pid=XDOT_PID, serial_number="X1"):
+    return SimpleNamespace(
+        device=device,
+        vid=vid,
+        pid=pid,
+        serial_number=serial_number,
+        usb_device_path="/sys/devices/usb1/1-1",
+        location="1-1",
+    )
+
+
+def test_lists_only_xdots():
+    ports = [_port("/dev/ttyACM1", serial_number="X2"), _port("/dev/ttyUSB0", vid=0x0403), _port("/dev/ttyACM0")]
+    assert _to_devices(ports, XDOT_VID, XDOT_PID) == [
+        Device("/dev/ttyACM0", "X1", "/sys/devices/usb1/1-1", "1-1"),
+        Device("/dev/ttyACM1", "X2", "/sys/devices/usb1/1-1", "1-1"),
+    ]
+
+
+def _registry(directory, watch_dir=None, **options) -> DeviceRegistry:
+    # Stands in for /dev, each tty file's content is the device's serial number
+    def scan():
+        return [Device(str(path), path.read_text(), None, None) for path in sorted(directory.glob("tty*"))]
+
+    registry = DeviceRegistry(scan, watch_dir=str(watch_dir or directory), **options)
+    registry.start()
+    return registry
+
+
+def _plug_in(path, serial_number, delay):
+    def create():
+        # Appears complete like a device node, rather than empty then written to
+        staging = path.with_name("staging")
+        staging.write_text(serial_number)
+        staging.rename(path)
+
+    threading.Timer(delay, create).start()
+
+
+def test_woken_as_soon_as_the_device_appears(tmp_path):
+    registry = _registry(tmp_path, poll_interval=10)
+    events = []
+    registry.add_listener(lambda event, device: events.append((event, device.serial_number)))
+    try:
+        assert registry.watching
+        assert registry.wait_for("X1", timeout=0) is None
+
+        _plug_in(tmp_path / "ttyACM1", "X1", 0.05)
+        start = time.monotonic()
+        device = registry.wait_for("X1", timeout=5)
+        assert time.monotonic() - start < 1
+        assert device.path == str(tmp_path / "ttyACM1")
+        assert registry.find(device.path) == device
+
+        (tmp_path / "ttyACM1").unlink()
+        (tmp_path / "other").write_text("")
+        time.sleep(0.1)
+        assert registry.devices == []
+        assert events == [(DeviceEvent.ADDED, "X1"), (DeviceEvent.REMOVED, "X1")]
+    finally:
+        registry.stop()
+
+
+def test_waits_for_a_change_since(tmp_path):
+    (tmp_path / "ttyACM0").write_text("X1")
+    registry = _registry(tmp_path, poll_interval=10)
+    try:
+        generation = registry.generation
+        assert registry.wait_for("X1", timeout=0.1, since=generation) is None
+        (tmp_path / "ttyACM0").chmod(0o600)
+        assert registry.wait_for("X1", timeout=1, since=generation) is not None
+    finally:
+        registry.stop()
+
+
+def test_polls_without_inotify(tmp_path):
+    registry = _registry(tmp_path, watch_dir=tmp_path / "missing", poll_interval=0.05)
+    try:
+        _plug_in(tmp_path / "ttyACM0", "X1", 0.05)
+        assert registry.wait_for("X1", timeout=5) is not None
+        assert not registry.watching
+    finally:
+        registry.stop()
+
+
+def test_wait_is_cancellable(tmp_path):
+    registry = _registry(tmp_path)
+    cancel = CancelToken()
+    threading.Timer(0.05, cancel.cancel).start()
+    try:
+        with pytest.raises(Cancelled):
+            registry.wait_for("X1", timeout=5, cancel=cancel)
+    finally:
+        registry.stop()
@@ -0,0 +1,121 @@
+import time
+
+import pytest
+
+from pulse_jig.lib.emulator import (
+    EmulatorConfig,
+    EmulatorTransport,
+    FirmwareEmulator,
+    PROD_FIRMWARE,
+    register_emulator,
+)
+from pulse_jig.lib.jig_client import JigClient, JigClientException
+from pulse_jig.lib.transport import create_transport
+
+
+def _client(**options) -> JigClient:
+    config = EmulatorConfig(speed=1000, seed=1, **options)
+    return JigClient(EmulatorTransport(FirmwareEmulator(config)), retry_deadline=1)
+
+
+def test_firmware_version():
+    assert _client().firmware_version() == "1.2.3"
+
+
+def test_hwspec_round_trip():
+    client = _client()
+    assert not client.hwspec_load("pulse")
+
+    client.hwspec_set_many({"serial": "W01-2-1234", "assembly_id": "16"})
+    client.hwspec_save("pulse")
+    assert client.hwspec_load("pulse")
+    # Integer fields are reported in hex, like the firmware
+    assert client.hwspec_get_many(["serial", "assembly_id"]) == {"serial": "W01-2-1234", "assembly_id": "0x10"}
+    with pytest.raises(JigClient.CommandFailed):
+        client.hwspec_get("bogus")
+
+
+def test_write_protected_probe():
+    client = _client(write_protected=True)
+    client.enable_external_port(1)
+    with pytest.raises(JigClient.CommandFailed):
+        client.hwspec_save("probe")
+
+
+def test_probe_chunk_and_recovery():
+    client = _client()
+    assert client.probe_await_connect() == 1
+    assert client.hwchunk_write_probe_and_verify(2500)
+    assert client.hwchunk_get_probe() == "cable length: 2500mm"
+    client.probe_await_recovery()
+    # The next probe is blank
+    with pytest.raises(JigClient.CommandFailed):
+        client.hwchunk_get_probe()
+
+
+def test_tests_pass_and_fail_at_the_configured_rate():
+    assert _client().test_port()
+    lines = []
+    assert not _client(failure_rates={"test-self": 1}).test_self(on_line=lines.append)
+    assert lines[-1] == "FAIL"
+    assert any(line.endswith("...FAIL") for line in lines)
+
+
+def test_latency_is_scaled_by_speed():
+    client = _client()
+    start = time.monotonic()
+    client.test_port()
+    # test-port takes ~20s on the device
+    assert 0.01 < time.monotonic() - start < 1
+
+
+def test_reboot_and_production_firmware():
+    port = EmulatorTransport(FirmwareEmulator(EmulatorConfig(speed=1000)))
+    port.reboot()
+    client = JigClient(port)
+    client.skip_boot_header()
+    assert client.firmware_version() == "1.2.3"
+
+    port.reboot(PROD_FIRMWARE)
+    header = port.emulator.boot_header().decode()
+    assert "Starting Production Firmware" in header
+    assert "Firmware Version: 2.0.0" in header
+    # The production firmware doesn't answer test commands
+    port.timeout = 0.05
+    assert port.read(1000) == header.encode()
+    port.write(b"firmware-version\r")
+    assert port.read(100) == b""
+
+
+def test_garbled_echoes_are_retried():
+    client = _client(garble_rate=1)
+    with pytest.raises(JigClientException):
+        client.firmware_version()
+    assert client.retry_stats.retries > 0
+    assert client.retry_stats.exhausted == 1
+
+
+def test_emulator_urls():
+    port = create_transport("emulator://?speed=10&seed=3&fail=test-port:0.5,hwspec-save:1&provisioned=1")
+    config = port.emulator.config
+    assert (config.speed, config.seed, config.provisioned) == (10, 3, True)
+    assert config.failure_rates == {"test-port": 0.5, "hwspec-save": 1}
+
+    shared = EmulatorTransport()
+    register_emulator("jig", shared)
+    assert create_transport("emulator://jig") is shared
+    with pytest.raises(ValueError):
+        create_transport("emulator://?bogus=1")
+
+
+def test_line_rate_bounds_throughput():
+    def duration(baudrate):
+        config = EmulatorConfig(seed=1, latency={}, line_rate=True, samples=50)
+        client = JigClient(EmulatorTransport(FirmwareEmulator(config)))
+        assert client.negotiate_baudrate(baudrate)
+        start = time.monotonic()
+        assert client.test_port()
+        return time.monotonic() - start
+
+    # About 8KB of output, ie. 0.7s at 115200 baud
+    assert duration(115200) > 4 * duration(921600)
@@ -0,0 +1,65 @@
+from pulse_jig.lib.boot_header import BootHeader, FirmwareKind
+from pulse_jig.lib.firmware_store import FirmwareStore
+
+
+def _header(version, kind=FirmwareKind.TEST, build="5f2c1e9"):
+    return BootHeader(kind, version, f"Firmware Version: {version}", build=build)
+
+
+def test_skips_the_flash_once_the_image_has_booted_as_the_running_build(tmp_path):
+    path = tmp_path / "test.bin"
+    path.write_bytes(b"\x01" * 1024)
+    store = FirmwareStore([path])
+    image = store.get(path)
+    assert image.data == path.read_bytes()
+    assert store.get(path) is image
+
+    # Not known until it's been flashed
+    assert not store.is_flashed(image, _header("1.2.3"))
+    store.learn(image, _header("1.2.3"))
+    assert store.is_flashed(image, _header("1.2.3"))
+    assert not store.is_flashed(image, _header("1.2.2"))
+    assert not store.is_flashed(image, _header("1.2.3", FirmwareKind.PRODUCTION))
+    assert not store.is_flashed(image, None)
+    # A different build with the same version
+    assert not store.is_flashed(image, _header("1.2.3", build="0d1e2f3"))
+    assert store.stats["test.bin"].loads == 6
+    assert store.stats["test.bin"].hit_rate == 1 / 6
+
+
+def test_never_skips_firmware_without_a_build(tmp_path):
+    path = tmp_path / "test.bin"
+    path.write_bytes(b"\x01" * 1024)
+    store = FirmwareStore()
+    image = store.get(path)
+    store.learn(image, _header("1.2.3", build=""))
+    assert store.version_of(image) is None
+    assert not store.is_flashed(image, _header("1.2.3", build=""))
+
+
+def test_a_rebuilt_image_is_flashed_again(tmp_path):
+    path = tmp_path / "test.bin"
+    path.write_bytes(b"\x01" * 1024)
+    store = FirmwareStore()
+    store.learn(store.get(path), _header("1.2.3"))
+
+    path.write_bytes(b"\x02" * 1025)
+    image = store.get(path)
+    assert image.data == b"\x02" * 1025
+    assert not store.is_flashed(image, _header("1.2.3"))
+    assert store.get(tmp_path / "missing.bin") is None
+
+
+def test_versions_are_kept_between_runs(tmp_path):
+    path = tmp_path / "test.bin"
+    path.write_bytes(b"\x01" * 1024)
+    versions = tmp_path / "pulse_jig" / "firmware_versions.json"
+    store = FirmwareStore([path], versions)
+    store.learn(store.get(path), _header("1.2.3"))
+
+    store = FirmwareStore([path], versions)
+    assert store.is_flashed(store.get(path), _header("1.2.3"))
+
+    versions.write_text("{not json")
+    store = FirmwareStore([path], versions)
+    assert store.version_of(store.get(path)) is None
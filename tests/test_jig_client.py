@@ -1,4 +1,7 @@
-from pulse_jig.lib.jig_client import JigClient, JigClientException
+from pulse_jig.lib.emulator import EmulatorConfig, EmulatorTransport, FirmwareEmulator
+from pulse_jig.lib.jig_client import BatchCommand, JigClient, JigClientException, abort_on_failure, is_idempotent
+import time
+
 import serial
 import pytest
 
@@ -76,3 +79,274 @@ def test_run_test_cmd_fails_on_no_status(port):
     port.write(b".\r\n")
     client = JigClient(port)
     assert client.run_test_cmd("SELF_TEST") is False
+
+
+def test_send_commands_returns_each_body_in_order(port):
+    port.write(b"> hwspec-get serial\r\n+OK\r\nW01-02-1234\r\n.\r\n")
+    port.write(b"> hwspec-set iecex_cert N/A\r\n+OK\r\n")
+    port.write(b"> hwspec-get iecex_cert\r\n+OK\r\nN/A\r\n.\r\n")
+    client = JigClient(port)
+    cmds = ["hwspec-get serial", BatchCommand("hwspec-set iecex_cert N/A", has_body=False), "hwspec-get iecex_cert"]
+    assert client.send_commands(cmds) == ["W01-02-1234", "", "N/A"]
+
+
+def test_send_commands_attributes_error_to_failing_command(port):
+    port.write(b"> hwspec-get serial\r\n+OK\r\nW01-02-1234\r\n.\r\n")
+    port.write(b"> hwspec-get bogus\r\n-ERR unknown key\r\n")
+    port.write(b"> hwspec-get iecex_cert\r\n+OK\r\nN/A\r\n.\r\n")
+    client = JigClient(port)
+    with pytest.raises(JigClient.CommandFailed) as e:
+        client.send_commands(["hwspec-get serial", "hwspec-get bogus", "hwspec-get iecex_cert"])
+    assert e.value.cmd == "hwspec-get bogus"
+    assert e.value.index == 1
+
+
+def test_send_commands_raises_on_protocol_error(port):
+    port.write(b"> hwspec-get serial\r\n+OK\r\nW01-02-1234\r\n.\r\n")
+    port.write(b"> hwspec-get other\r\n")
+    client = JigClient(port)
+    with pytest.raises(JigClientException):
+        client.send_commands(["hwspec-get serial", "hwspec-get iecex_cert"])
+
+
+def test_send_command_streams_body_lines(port):
+    port.write(b"> SELF_TEST\r\n+OK\r\ntesting watchdog...OK\r\ntesting EEPROM...OK\r\n.\r\n")
+    client = JigClient(port)
+    lines = []
+    client.send_command("SELF_TEST", on_line=lines.append)
+    assert lines == ["testing watchdog...OK", "testing EEPROM...OK"]
+
+
+def test_run_test_cmd_aborts_early_and_resyncs(port):
+    port.write(b"> test-port -v 0x0f 1\r\n+OK\r\nport 1...OK\r\nport 2...FAIL\r\n")
+    client = JigClient(port)
+    assert client.run_test_cmd("test-port -v 0x0f 1", timeout=60, abort_when=abort_on_failure) is False
+
+    # The rest of the aborted test's output is discarded before the next command
+    port.write(b"port 3...OK\r\nFAIL\r\n.\r\n> firmware-version\r\n+OK\r\n1.2.3\r\n.\r\n")
+    assert client.firmware_version() == "1.2.3"
+
+
+def test_resync_fails_if_aborted_command_never_finishes(port):
+    port.write(b"> test-self -v\r\n+OK\r\ntesting EEPROM...FAIL\r\n")
+    client = JigClient(port)
+    with pytest.raises(JigClient.CommandAborted):
+        client.send_command("test-self -v", timeout=0.5, abort_when=abort_on_failure)
+    with pytest.raises(JigClientException):
+        client.firmware_version()
+
+
+class ScriptedPort:
+    """Fake port that answers each line written to it with the next scripted response."""
+
+    def __init__(self, responses):
+        self._responses = list(responses)
+        self._buf = bytearray()
+        self.timeout = None
+        self.write_timeout = None
+        self.flushes = 0
+
+    @property
+    def in_waiting(self):
+        return len(self._buf)
+
+    def write(self, data):
+        if self._responses:
+            self._buf += self._responses.pop(0)
+
+    def read(self, size=1):
+        if not self._buf:
+            time.sleep(self.timeout or 0)
+        data = bytes(self._buf[:size])
+        del self._buf[:size]
+        return data
+
+    def reset_input_buffer(self):
+        self.flushes += 1
+        self._buf.clear()
+
+
+def test_is_idempotent():
+    assert is_idempotent("hwspec-get serial")
+    assert is_idempotent("lora-deveui get")
+    assert not is_idempotent("hwspec-set serial W01-02-1234")
+    assert not is_idempotent("test-self -v")
+
+
+def test_idempotent_command_is_retried_after_garbled_echo():
+    port = ScriptedPort([b"> firmwa\x00re-version\r\n+OK\r\n", b"> firmware-version\r\n+OK\r\n1.2.3\r\n.\r\n> "])
+    client = JigClient(port)
+    assert client.firmware_version() == "1.2.3"
+    assert port.flushes == 1
+    assert client.retry_stats.retries == 1
+    assert client.retry_stats.recovered == 1
+
+
+def test_idempotent_batch_is_retried_after_missing_ack():
+    first = b"> hwspec-get serial\r\n"
+    good = b"> hwspec-get serial\r\n+OK\r\nW01-02-1234\r\n.\r\n"
+    port = ScriptedPort([first, b"", good, b"> hwspec-get rev\r\n+OK\r\nr1b\r\n.\r\n"])
+    client = JigClient(port)
+    assert client.hwspec_get_many(["serial", "rev"]) == {"serial": "W01-02-1234", "rev": "r1b"}
+    assert client.retry_stats.recovered == 1
+
+
+def test_retries_are_bounded_by_attempts():
+    port = ScriptedPort([b"> lora-deveui get\r\n"] * 5)
+    client = JigClient(port, max_attempts=2)
+    with pytest.raises(JigClientException):
+        client.lora_deveui()
+    assert client.retry_stats.retries == 1
+    assert client.retry_stats.exhausted == 1
+
+
+def test_non_idempotent_command_is_not_retried():
+    port = ScriptedPort([b"> hwspec-set serial W01\r\n", b"> hwspec-set serial W01\r\n+OK\r\n"])
+    client = JigClient(port)
+    with pytest.raises(JigClientException):
+        client.hwspec_set("serial", "W01")
+    assert port.flushes == 0
+    assert client.retry_stats.retries == 0
+
+
+def test_error_response_is_not_retried():
+    port = ScriptedPort([b"> hwspec-get bogus\r\n-ERR unknown key\r\n"])
+    client = JigClient(port)
+    with pytest.raises(JigClient.CommandFailed):
+        client.hwspec_get("bogus")
+    assert client.retry_stats.retries == 0
+
+
+def _emulated_client(**options):
+    port = EmulatorTransport(FirmwareEmulator(EmulatorConfig(speed=1000, seed=1, **options)))
+    return JigClient(port, cache_reads=True), port.emulator
+
+
+def test_repeated_reads_are_cached():
+    client, emulator = _emulated_client(provisioned=True)
+    client.hwspec_load("pulse")
+    assert client.firmware_version() == client.firmware_version()
+    first = client.hwspec_get_many(["serial", "assembly_id"])
+    assert client.hwspec_get_many(["assembly_id", "serial", "hw_revision"])["serial"] == first["serial"]
+    assert emulator.commands.count("firmware-version") == 1
+    assert emulator.commands.count("hwspec-get serial") == 1
+    assert client.cache_stats.hits == 3
+    assert client.cache_stats.misses == 4
+
+
+def test_writes_and_resets_invalidate_the_cache():
+    client, emulator = _emulated_client(provisioned=True)
+    client.hwspec_load("pulse")
+    client.hwspec_get("serial")
+    client.hwspec_set("serial", "W01-2-9999")
+    assert client.hwspec_get("serial") == "W01-2-9999"
+
+    # Within a batch, a read is only cached if nothing after it changes it
+    client.send_commands(["hwspec-get assembly_id", BatchCommand("hwspec-set assembly_id 2", has_body=False)])
+    assert client.hwspec_get("assembly_id") == "0x2"
+
+    client.firmware_version()
+    client.invalidate_cache()
+    client.firmware_version()
+    assert emulator.commands.count("firmware-version") == 2
+    assert emulator.commands.count("hwspec-get serial") == 2
+    assert emulator.commands.count("hwspec-get assembly_id") == 2
+
+
+def test_cached_probe_reads_are_per_port():
+    client, emulator = _emulated_client()
+    client.enable_external_port(1)
+    client.hwchunk_write_probe_and_verify(2500)
+    assert client.hwchunk_get_probe() == client.hwchunk_get_probe()
+    client.enable_external_port(2)
+    client.hwchunk_get_probe()
+    client.enable_external_port(1)
+    client.probe_await_recovery()
+    with pytest.raises(JigClient.CommandFailed):
+        # The next probe is blank
+        client.hwchunk_get_probe()
+    assert emulator.commands.count("hwchunk dump probe probe") == 3
+
+
+def test_external_port_is_kept_enabled_between_contexts():
+    client, emulator = _emulated_client()
+    with client.external_port(1):
+        client.hwspec_load("probe")
+    # Port independent commands don't need it disabled
+    client.firmware_version()
+    with client.external_port(1):
+        with client.external_port(1):
+            client.hwspec_save("probe")
+    assert emulator.commands.count("port-enable 1") == 1
+    assert "port-enable none" not in emulator.commands
+
+    client.test_self()
+    assert emulator.commands[-2:] == ["platform prp-disable", "test-self -v"]
+    assert client.external_port_stats.commands_saved == 6
+
+
+def test_hwspec_is_set_with_the_external_port_disabled():
+    client, emulator = _emulated_client()
+    with client.external_port(1):
+        client.hwspec_load("probe")
+    client.hwspec_set("serial", "W01-2-1000")
+    assert emulator.commands[-2:] == ["platform prp-disable", "hwspec-set serial W01-2-1000"]
+
+    with client.external_port(1):
+        pass
+    client.release_external_port()
+    assert emulator.commands[-1] == "platform prp-disable"
+    client.release_external_port()
+    assert emulator.commands.count("port-enable none") == 2
+
+
+def test_failing_to_disable_the_external_port_is_an_error():
+    client, _ = _emulated_client()
+
+    def disable():
+        raise JigClientException("Line not echoed back: ")
+
+    client.disable_external_port = disable
+    with pytest.raises(JigClientException, match="Unable to disable external port 1"):
+        with client.external_port(1):
+            raise JigClient.CommandFailed("")
+
+
+def test_external_port_is_switched_and_restored_on_errors():
+    client, emulator = _emulated_client()
+    with client.external_port(1):
+        pass
+    with client.external_port(2):
+        with pytest.raises(ValueError):
+            with client.external_port(3):
+                pass
+    assert emulator.commands.count("port-enable none") == 1
+    with pytest.raises(RuntimeError):
+        with client.external_port(2):
+            raise RuntimeError()
+    assert emulator.commands[-1] == "platform prp-disable"
+    assert client.external_port_stats.enables == 2
+    assert client.external_port_stats.disables == 2
+
+
+def test_negotiates_a_faster_baud_rate():
+    client, emulator = _emulated_client()
+    assert client.negotiate_baudrate(921600)
+    assert (client._port.baudrate, emulator.baudrate) == (921600, 921600)
+    assert client.test_port()
+
+    # The device restarts at the default rate, which the port has to be back at for its header
+    client.restore_baudrate()
+    client._port.reboot()
+    assert client.read_boot_header().prompt
+    assert client.firmware_version() == "1.2.3"
+
+
+def test_falls_back_when_the_link_fails_at_a_faster_rate():
+    client, emulator = _emulated_client(baud_limit=230400)
+    assert not client.negotiate_baudrate(921600, revert_time=0.01)
+    assert (client._port.baudrate, emulator.baudrate) == (115200, 115200)
+    assert client.firmware_version() == "1.2.3"
+    # Rates the firmware doesn't support are refused outright
+    assert not client.negotiate_baudrate(250000)
+    assert client.negotiate_baudrate(230400)
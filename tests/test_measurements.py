@@ -0,0 +1,77 @@
+import math
+
+from pulse_jig.lib.emulator import EmulatorConfig, EmulatorTransport, FirmwareEmulator
+from pulse_jig.lib.jig_client import JigClient, abort_on_failure
+from pulse_jig.lib.measurements import Measurement, Measurements
+
+
+def test_parses_readings():
+    measurements = Measurements()
+    body = "\n".join(
+        [
+            "port 1 ch 0: adc=0.512 min=0.400 PASS",
+            "port 2 ch 3: adc=0.100 min=0.400 FAIL",
+            "port 3...OK",
+            "vbat=3.3 vusb=5.01",
+            "PASS",
+        ]
+    )
+    assert measurements.parse("test-port", body) == 4
+    assert list(measurements) == [
+        Measurement("test-port", "adc", 1, 0, 0.512, 0.4, True),
+        Measurement("test-port", "adc", 2, 3, 0.1, 0.4, False),
+        Measurement("test-port", "vbat", None, None, 3.3, None, None),
+        Measurement("test-port", "vusb", None, None, 5.01, None, None),
+    ]
+    assert measurements.failed() == [measurements[1]]
+
+
+def test_step_results_without_readings_add_nothing():
+    # The test firmware's step output as the original client tests have it
+    measurements = Measurements()
+    assert measurements.parse("test-self", "testing watchdog...OK\ntesting EEPROM...OK\nPASS") == 0
+    assert measurements.parse("test-port", "port 1...OK\nport 2...FAIL\nFAIL") == 0
+    assert measurements.failed() == []
+
+
+def test_stored_in_typed_arrays():
+    measurements = Measurements()
+    measurements.parse("test-ta3k", "port 1 ch 0: adc=0.5 min=0.4 OK\nport 1 ch 1: adc=0.6 OK")
+    assert measurements.values.typecode == "d"
+    assert list(measurements.values) == [0.5, 0.6]
+    assert math.isnan(measurements.limits[1])
+    assert measurements.to_dict() == {
+        "test": ["test-ta3k", "test-ta3k"],
+        "name": ["adc", "adc"],
+        "port": [1, 1],
+        "channel": [0, 1],
+        "value": [0.5, 0.6],
+        "limit": [0.4, None],
+        "passed": [True, True],
+    }
+
+
+def test_lines_with_out_of_range_ports_are_skipped():
+    measurements = Measurements()
+    body = "port 200 ch 0: adc=0.5 OK\nport 1 ch 40000: adc=0.5 OK\nport 99999 ch 1: adc=0.5 OK"
+    assert measurements.parse("test-port", body) == 1
+    assert (measurements.to_dict()["port"], measurements.to_dict()["channel"]) == ([200], [0])
+
+
+def _client(**options) -> JigClient:
+    config = EmulatorConfig(speed=1000, seed=1, **options)
+    return JigClient(EmulatorTransport(FirmwareEmulator(config)))
+
+
+def test_collected_from_test_commands():
+    measurements = Measurements()
+    assert _client().test_ta3k(1, 0.25, measurements=measurements)
+    assert len(measurements) == 3
+    assert all(m.limit == 0.25 and m.value > 0.25 and m.passed for m in measurements)
+
+
+def test_collected_up_to_an_abort():
+    measurements = Measurements()
+    client = _client(failure_rates={"test-port": 1})
+    assert not client.test_port(abort_when=abort_on_failure, measurements=measurements)
+    assert measurements[len(measurements) - 1].passed is False
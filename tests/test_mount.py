@@ -0,0 +1,177 @@
+import subprocess
+import threading
+from pathlib import Path
+
+import gpiozero
+import pytest
+from gpiozero.pins.mock import MockFactory
+
+from pulse_jig.lib.cancel import Cancelled, CancelToken
+from pulse_jig.lib.firmware_store import FirmwareImage
+from pulse_jig.lib.mount import (
+    FAIL_FILE,
+    MOUNT_OPTIONS,
+    FlashError,
+    MountManager,
+    await_mount_ready,
+    find_block_device,
+    mount_points,
+    probe_write,
+)
+from pulse_jig.lib.pulse_manager import PulseManager
+
+
+def _mountinfo(path, *mount_points):
+    lines = [f"{i} 1 8:{i} / {point} rw,relatime - vfat /dev/sd{i} rw" for i, point in enumerate(mount_points)]
+    path.write_text("".join(line + "\n" for line in lines))
+
+
+def test_mount_points(tmp_path):
+    mountinfo = tmp_path / "mountinfo"
+    _mountinfo(mountinfo, "/", "/media/pi/XDOT\\040VOL")
+    assert mount_points(str(mountinfo)) == {"/", "/media/pi/XDOT VOL"}
+    assert mount_points(str(tmp_path / "missing")) is None
+
+
+def test_ready_once_mounted_with_space(tmp_path):
+    volume = tmp_path / "XDOT"
+    volume.mkdir()
+    mountinfo = tmp_path / "mountinfo"
+    _mountinfo(mountinfo, "/")
+    free = {"bytes": 0}
+
+    def automount():
+        _mountinfo(mountinfo, "/", str(volume))
+        # The space is only reported some time after it's mounted
+        threading.Timer(0.1, free.update, kwargs={"bytes": 1024}).start()
+
+    threading.Timer(0.1, automount).start()
+    elapsed = await_mount_ready(
+        str(volume), 5, probe=True, mountinfo=str(mountinfo), free_space=lambda path: free["bytes"]
+    )
+    assert 0.2 <= elapsed < 1
+    assert list(volume.iterdir()) == []
+
+
+def test_not_ready_in_time(tmp_path):
+    mountinfo = tmp_path / "mountinfo"
+    _mountinfo(mountinfo, "/")
+    assert await_mount_ready(str(tmp_path), 0.1, mountinfo=str(mountinfo)) is None
+    # Without a mount table it only has to be writable
+    assert await_mount_ready(str(tmp_path), 0.1, mountinfo=str(tmp_path / "missing")) is not None
+    assert not probe_write(str(tmp_path / "missing"))
+
+
+def test_wait_is_cancellable(tmp_path):
+    cancel = CancelToken()
+    threading.Timer(0.05, cancel.cancel).start()
+    with pytest.raises(Cancelled):
+        await_mount_ready(str(tmp_path / "missing"), None, cancel)
+
+
+def _sysfs(root):
+    # An xDot at USB port 1-1.2, with its serial port and its volume's block device
+    usb = root / "devices" / "usb1" / "1-1" / "1-1.2"
+    (usb / "1-1.2:1.1" / "tty" / "ttyACM0").mkdir(parents=True)
+    (usb / "1-1.2:1.0" / "host0" / "block" / "sda" / "sda1").mkdir(parents=True)
+    (usb / "1-1.2:1.0" / "host0" / "block" / "sda" / "sda1" / "partition").write_text("1")
+    (root / "devices" / "virtual" / "block" / "loop0").mkdir(parents=True)
+    for name in ("tty", "block"):
+        (root / "class" / name).mkdir(parents=True)
+    (root / "class" / "tty" / "ttyACM0").symlink_to(usb / "1-1.2:1.1" / "tty" / "ttyACM0")
+    (usb / "1-1.2:1.1" / "tty" / "ttyACM0" / "device").symlink_to(usb / "1-1.2:1.1")
+    (root / "class" / "block" / "sda").symlink_to(usb / "1-1.2:1.0" / "host0" / "block" / "sda")
+    (root / "class" / "block" / "sda1").symlink_to(usb / "1-1.2:1.0" / "host0" / "block" / "sda" / "sda1")
+    (root / "class" / "block" / "loop0").symlink_to(root / "devices" / "virtual" / "block" / "loop0")
+
+
+def test_finds_the_block_device_sharing_the_serial_ports_usb_device(tmp_path):
+    _sysfs(tmp_path)
+    assert find_block_device("/dev/ttyACM0", sysfs=str(tmp_path)) == "/dev/sda1"
+    assert find_block_device("/dev/ttyACM1", sysfs=str(tmp_path)) is None
+
+
+def _image(data=b"\x01" * 200_000):
+    return FirmwareImage(Path("test.bin"), data, "digest")
+
+
+def test_writes_to_a_directory_stand_in(tmp_path):
+    manager = MountManager(str(tmp_path))
+    manager.mount(1)
+    manager.write(_image())
+    manager.unmount()
+    manager.verify(1)
+    assert (tmp_path / "test.bin").read_bytes() == _image().data
+
+    (tmp_path / FAIL_FILE).write_text("The interface firmware FAILED to reset/halt the target MCU\n")
+    with pytest.raises(FlashError, match="FAILED to reset/halt"):
+        manager.verify(1)
+    with pytest.raises(FlashError):
+        MountManager(str(tmp_path / "missing")).mount(1)
+
+
+def test_mounts_writes_and_checks_the_flash(tmp_path):
+    volume = tmp_path / "xdot"
+    commands = []
+    # Attached, then detached while flashing, then attached again
+    devices = iter(["/dev/sda1", "/dev/sda1", None, "/dev/sda1"])
+    ports = []
+
+    def find_device(port):
+        ports.append(port)
+        return next(devices, "/dev/sda1")
+
+    manager = MountManager(str(volume), find_device, run=commands.append)
+
+    manager.mount(1, port="/dev/ttyACM0")
+    manager.write(_image())
+    manager.unmount()
+    # The remount shows the xDot's failure
+    (volume / FAIL_FILE).write_text("")
+    with pytest.raises(FlashError):
+        manager.verify(1)
+    assert commands == [
+        ["mount", "-t", "vfat", "-o", MOUNT_OPTIONS, "/dev/sda1", str(volume)],
+        ["umount", str(volume)],
+        ["mount", "-t", "vfat", "-o", MOUNT_OPTIONS, "/dev/sda1", str(volume)],
+        ["umount", str(volume)],
+    ]
+    assert set(ports) == {"/dev/ttyACM0"}
+
+
+def test_finds_the_volume_from_the_current_serial_port(tmp_path):
+    _sysfs(tmp_path / "sys")
+    commands = []
+    manager = MountManager(
+        str(tmp_path / "xdot"), lambda port: find_block_device(port, sysfs=str(tmp_path / "sys")), run=commands.append
+    )
+    with pytest.raises(FlashError, match="serial port isn't known"):
+        manager.mount(0.1)
+    # The xDot came back as another node, which has no volume
+    with pytest.raises(FlashError, match="didn't appear"):
+        manager.mount(0.1, port="/dev/ttyACM1")
+    manager.mount(0.1, port="/dev/ttyACM0")
+    assert commands[-1][-2:] == ["/dev/sda1", str(tmp_path / "xdot")]
+
+
+def test_mount_fails_promptly(tmp_path):
+    def fail(args):
+        raise subprocess.CalledProcessError(32, args, stderr="mount: wrong fs type\n")
+
+    with pytest.raises(FlashError, match="wrong fs type"):
+        MountManager(str(tmp_path), lambda port: "/dev/sda1", run=fail).mount(1, port="/dev/ttyACM0")
+    with pytest.raises(FlashError, match="didn't appear"):
+        MountManager(str(tmp_path), lambda port: None).mount(0.1, port="/dev/ttyACM0")
+
+
+def test_pulse_manager_flashes_through_the_mount_manager(tmp_path):
+    gpiozero.Device.pin_factory = MockFactory()
+    try:
+        manager = PulseManager(5, 6, "/nonexistent", mount_manager=MountManager(str(tmp_path)))
+        manager.load_firmware(_image())
+        assert (tmp_path / "test.bin").exists()
+        with pytest.raises(FlashError, match="Missing firmware image"):
+            manager.load_firmware(tmp_path / "missing.bin")
+    finally:
+        gpiozero.Device.pin_factory.reset()
+        gpiozero.Device.pin_factory = None
@@ -0,0 +1,118 @@
+import socket
+import threading
+import time
+
+import pytest
+import serial
+
+from pulse_jig.lib.jig_client import JigClient
+from pulse_jig.lib.transport import SocketTransport, create_transport, is_network_url
+
+
+class FakeSer2Net:
+    """TCP server that answers each command like the device, after `delay` seconds."""
+
+    def __init__(self, delay: float = 0):
+        self.delay = delay
+        self._server = socket.create_server(("127.0.0.1", 0))
+        self.url = f"socket://127.0.0.1:{self._server.getsockname()[1]}"
+        self.connections = []
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self._server.accept()
+            except OSError:
+                return
+            self.connections.append(conn)
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        buf = b""
+        while True:
+            try:
+                data = conn.recv(1024)
+            except OSError:
+                return
+            if not data:
+                return
+            buf += data
+            while b"\r" in buf:
+                line, buf = buf.split(b"\r", 1)
+                time.sleep(self.delay)
+                try:
+                    conn.sendall(b"> " + line + b"\r\n+OK\r\n1.2.3\r\n.\r\n")
+                except OSError:
+                    return
+
+    def drop_connections(self):
+        for conn in self.connections:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            conn.close()
+        self.connections.clear()
+
+    def close(self):
+        # Shutting down wakes the thread blocked in accept, otherwise it keeps the socket listening
+        try:
+            self._server.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._server.close()
+        self.drop_connections()
+
+
+@pytest.fixture
+def server():
+    server = FakeSer2Net()
+    yield server
+    server.close()
+
+
+def test_network_urls_get_network_transports():
+    assert is_network_url("socket://jig-2:4000")
+    assert is_network_url("rfc2217://jig-2:4000")
+    assert not is_network_url("/dev/ttyACM0")
+    assert not is_network_url(None)
+    port = create_transport("socket://jig-2:4000", "rawfd")
+    assert isinstance(port, SocketTransport)
+    assert not port.is_open
+
+
+def test_jig_client_over_socket(server):
+    port = create_transport(server.url)
+    port.open()
+    assert JigClient(port).firmware_version() == "1.2.3"
+
+
+def test_connection_loss_raises_and_reconnects(server):
+    port = create_transport(server.url)
+    port.open()
+    client = JigClient(port)
+    assert client.firmware_version() == "1.2.3"
+
+    server.drop_connections()
+    with pytest.raises(serial.SerialException):
+        client.firmware_version()
+
+    # This is what waiting_for_serial does
+    port.close()
+    port.open()
+    assert JigClient(port).firmware_version() == "1.2.3"
+
+
+def test_unreachable_device_fails_to_open(server):
+    port = create_transport(server.url)
+    server.close()
+    with pytest.raises(serial.SerialException):
+        port.open()
+
+
+def test_link_latency_extends_ack_timeout(server):
+    server.delay = 0.7
+    port = create_transport(server.url)
+    port.open()
+    assert JigClient(port, link_latency=0.5).firmware_version() == "1.2.3"
@@ -0,0 +1,79 @@
+from pulse_jig.lib.protocol import BOOT_HEADER_SEPARATOR, ProtocolParser, Token, TokenKind
+import serial
+import pytest
+
+
+@pytest.fixture
+def parser():
+    return ProtocolParser()
+
+
+def drain(parser):
+    tokens = []
+    token = parser.next_token(0)
+    while token is not None:
+        tokens.append(token)
+        token = parser.next_token(0)
+    return tokens
+
+
+def test_tokenizes_a_response_split_across_reads(parser):
+    parser.expect_response(has_body=True)
+    for chunk in [b"> SELF", b"_TEST\r\n+O", b"K\r\nline one\r", b"\n.\r\n"]:
+        parser.feed(chunk)
+    assert drain(parser) == [
+        Token(TokenKind.PROMPT, "> "),
+        Token(TokenKind.ECHO, "SELF_TEST"),
+        Token(TokenKind.ACK, "+OK"),
+        Token(TokenKind.BODY, "line one"),
+        Token(TokenKind.BODY_END, "."),
+    ]
+
+
+def test_tokenizes_pipelined_responses(parser):
+    parser.expect_response(has_body=False)
+    parser.expect_response(has_body=True)
+    parser.feed(b"> hwspec-set a 1\r\n+OK\r\n> hwspec-get a\r\n+OK\r\n1\r\n.\r\n")
+    assert [t.kind for t in drain(parser)] == [
+        TokenKind.PROMPT,
+        TokenKind.ECHO,
+        TokenKind.ACK,
+        TokenKind.PROMPT,
+        TokenKind.ECHO,
+        TokenKind.ACK,
+        TokenKind.BODY,
+        TokenKind.BODY_END,
+    ]
+
+
+def test_error_response_ends_the_command(parser):
+    parser.expect_response(has_body=True)
+    parser.feed(b"hwspec-get bogus\r\n-ERR unknown key\r\n")
+    assert drain(parser)[-1] == Token(TokenKind.ERROR, "-ERR unknown key")
+    parser.feed(b"stray\r\n")
+    assert drain(parser) == [Token(TokenKind.LINE, "stray")]
+
+
+def test_tolerates_invalid_utf8(parser):
+    parser.expect_response(has_body=True)
+    parser.feed(b"cmd\r\n+OK\r\nbad \xff byte\r\n.\r\n")
+    assert Token(TokenKind.BODY, "bad � byte") in drain(parser)
+
+
+def test_tokenizes_boot_header(parser):
+    separator = BOOT_HEADER_SEPARATOR.encode()
+    parser.feed(b"\r\n" + separator + b"\r\nStarting Functional Tests Firmware\r\n" + separator + b"\r\n> ")
+    assert [t.kind for t in drain(parser)] == [
+        TokenKind.HEADER_SEPARATOR,
+        TokenKind.HEADER,
+        TokenKind.HEADER_SEPARATOR,
+        TokenKind.PROMPT,
+    ]
+
+
+def test_next_token_reads_from_port_and_times_out():
+    port = serial.serial_for_url("loop://")
+    parser = ProtocolParser(port)
+    port.write(b"unexpected\r\n")
+    assert parser.next_token(0.5) == Token(TokenKind.LINE, "unexpected")
+    assert parser.next_token(0.1) is None
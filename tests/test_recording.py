@@ -0,0 +1,135 @@
+import gzip
+import time
+
+import pytest
+
+from pulse_jig.lib.emulator import EmulatorConfig, EmulatorTransport, FirmwareEmulator
+from pulse_jig.lib.jig_client import JigClient
+from pulse_jig.lib.recording import (
+    READ,
+    WRITE,
+    RecordingTransport,
+    ReplayDivergence,
+    ReplayTransport,
+    read_recording,
+)
+from pulse_jig.lib.transport import create_transport
+
+
+def _emulator(**options) -> EmulatorTransport:
+    port = EmulatorTransport(FirmwareEmulator(EmulatorConfig(speed=100, seed=1, **options)))
+    port.close()
+    return port
+
+
+def _record_session(tmp_path, **options):
+    port = RecordingTransport(_emulator(**options), tmp_path)
+    port.open()
+    client = JigClient(port)
+    version = client.firmware_version()
+    passed = client.test_self()
+    port.close()
+    [path] = tmp_path.glob("*.pjsr")
+    return path, version, passed
+
+
+def test_records_both_directions(tmp_path):
+    path, _, _ = _record_session(tmp_path)
+    recording = read_recording(path)
+    assert recording.data(WRITE) == b"firmware-version\rtest-self -v\r"
+    assert b"+OK\r\n1.2.3\r\n.\r\n" in recording.data(READ)
+    times = [chunk.at for chunk in recording.chunks]
+    assert times == sorted(times)
+
+
+def test_replay_reproduces_session(tmp_path):
+    path, version, passed = _record_session(tmp_path, failure_rates={"test-self": 1})
+    port = ReplayTransport(read_recording(path), speed=float("inf"))
+    client = JigClient(port)
+    assert client.firmware_version() == version
+    assert client.test_self() == passed is False
+    assert port.finished
+    assert port.divergences == []
+
+
+def test_replay_keeps_or_compresses_timing(tmp_path):
+    path, _, _ = _record_session(tmp_path)
+    recording = read_recording(path)
+
+    def replay_time(**options):
+        client = JigClient(ReplayTransport(recording, **options))
+        start = time.monotonic()
+        client.firmware_version()
+        client.test_self()
+        return time.monotonic() - start
+
+    # test-self takes ~3s on the device, so ~30ms at 100x
+    assert replay_time() > 0.02
+    assert replay_time(max_gap=0.001) < 0.02
+
+
+def test_replay_divergence(tmp_path):
+    path, _, _ = _record_session(tmp_path)
+    port = ReplayTransport(read_recording(path), speed=float("inf"))
+    JigClient(port).firmware_version()
+    port.write(b"test-port -v 0x0f 1\r")
+    assert port.divergences
+    strict = ReplayTransport(read_recording(path), speed=float("inf"), strict=True)
+    with pytest.raises(ReplayDivergence):
+        strict.write(b"hwspec-get serial\r")
+
+
+def test_replay_url(tmp_path):
+    path, _, _ = _record_session(tmp_path)
+    port = create_transport(f"replay://{path}?speed=10&max_gap=0.5")
+    assert (port.speed, port.max_gap, port.strict) == (10, 0.5, False)
+    assert JigClient(port).firmware_version() == "1.2.3"
+    with pytest.raises(ValueError):
+        create_transport(f"replay://{path}?bogus=1")
+
+
+def test_truncated_recording_is_readable(tmp_path):
+    path, _, _ = _record_session(tmp_path)
+    data = gzip.decompress(path.read_bytes())
+    path.write_bytes(gzip.compress(data[:-3]))
+    assert read_recording(path).data(WRITE) == b"firmware-version\rtest-self -v\r"
+
+
+def test_old_recordings_are_removed(tmp_path):
+    port = RecordingTransport(_emulator(), tmp_path, keep=2)
+    for _ in range(4):
+        port.open()
+        port.close()
+    assert len(list(tmp_path.glob("*.pjsr"))) == 2
+
+
+def test_boot_header_is_replayed_when_the_jig_waits_for_it(tmp_path):
+    port = RecordingTransport(_emulator(), tmp_path)
+    port.open()
+    port.reboot()
+    client = JigClient(port)
+    client.skip_boot_header()
+    client.firmware_version()
+    port.close()
+    [path] = tmp_path.glob("*.pjsr")
+
+    replay = ReplayTransport(read_recording(path), speed=float("inf"))
+    time.sleep(0.01)
+    # Held back until the jig starts waiting for it, as it would come after a reset
+    assert replay.in_waiting == 0
+    client = JigClient(replay)
+    client.skip_boot_header()
+    assert client.firmware_version() == "1.2.3"
+    assert replay.divergences == []
+
+
+def test_changed_arguments_are_echoed_back(tmp_path):
+    port = RecordingTransport(_emulator(), tmp_path)
+    port.open()
+    JigClient(port).hwspec_set("serial", "W01-2-1000")
+    port.close()
+    [path] = tmp_path.glob("*.pjsr")
+
+    replay = ReplayTransport(read_recording(path), speed=float("inf"), strict=True)
+    JigClient(replay).hwspec_set("serial", "W01-2-2000")
+    assert replay.divergences == []
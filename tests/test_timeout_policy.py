@@ -0,0 +1,98 @@
+import pytest
+import serial
+
+from pulse_jig.lib.jig_client import JigClient
+from pulse_jig.lib.timeout_policy import AdaptiveTimeoutPolicy
+
+
+def learn(policy, cmd, duration, count=20):
+    for _ in range(count):
+        policy.record(cmd, duration)
+
+
+def test_uses_ceiling_until_enough_samples():
+    policy = AdaptiveTimeoutPolicy(min_samples=20)
+    learn(policy, "test-self -v", 1.0, count=19)
+    assert policy.timeout("test-self -v", 10) == 10
+
+
+def test_derives_deadline_from_percentile_plus_margin():
+    policy = AdaptiveTimeoutPolicy(percentile=0.99, margin=0.25, min_margin=0.5)
+    learn(policy, "test-ta3k -v -a 0.4 0x1 1", 4.0)
+    # Recorded against the command name, so parameters don't matter
+    assert policy.timeout("test-ta3k -v -a 0.6 0x2 1", 20) == pytest.approx(5.0)
+
+
+def test_deadline_is_bounded_by_ceiling():
+    policy = AdaptiveTimeoutPolicy()
+    learn(policy, "test-port -v 0x0f 1", 59)
+    assert policy.timeout("test-port -v 0x0f 1", 60) == 60
+
+
+def test_no_timeout_is_never_adapted():
+    policy = AdaptiveTimeoutPolicy()
+    learn(policy, "probe-await connect", 3)
+    assert policy.timeout("probe-await connect", None) is None
+
+
+def test_quiet_and_verbose_runs_are_timed_apart():
+    policy = AdaptiveTimeoutPolicy(overrides={"test-port": 30})
+    learn(policy, "test-ta3k -a 0.4 1", 0.5)
+    assert policy.timeout("test-ta3k -a 0.4 1", 20) == pytest.approx(1.0)
+    # The verbose rerun of a quiet failure isn't cut off by the quiet runs' deadline
+    assert policy.timeout("test-ta3k -v -a 0.4 1", 20) == 20
+    assert policy.timeout("test-port -v 0x0f 1", 60) == 30
+
+
+def test_override_replaces_ceiling():
+    policy = AdaptiveTimeoutPolicy(overrides={"test-port": 30})
+    learn(policy, "test-port -v 0x0f 1", 1)
+    assert policy.timeout("test-port -v 0x0f 1", 60) == 30
+
+
+def test_history_survives_restart(tmp_path):
+    path = tmp_path / "data" / "timeouts.json"
+    policy = AdaptiveTimeoutPolicy(path, save_every=5)
+    learn(policy, "test-self -v", 2.0)
+    assert AdaptiveTimeoutPolicy(path).timeout("test-self -v", 10) == pytest.approx(2.5)
+
+
+def test_corrupt_history_falls_back_to_ceilings(tmp_path):
+    path = tmp_path / "timeouts.json"
+    path.write_text("{not json")
+    assert AdaptiveTimeoutPolicy(path).timeout("test-self -v", 10) == 10
+
+
+def test_jig_client_records_durations_and_audits_cut_short_commands():
+    port = serial.serial_for_url("loop://")
+    policy = AdaptiveTimeoutPolicy(min_margin=0.1)
+    client = JigClient(port, timeout_policy=policy)
+
+    port.write(b"> test-self -v\r\n+OK\r\nPASS\r\n.\r\n")
+    assert client.test_self()
+    assert len(policy.samples("test-self -v")) == 1
+
+    learn(policy, "test-self -v", 0.1)
+    port = serial.serial_for_url("loop://")
+    port.write(b"> test-self -v\r\n+OK\r\n")
+    # A test that times out fails rather than raising
+    assert not JigClient(port, timeout_policy=policy).test_self()
+    assert [cut.command for cut in policy.audit] == ["test-self -v"]
+    assert policy.audit[0].ceiling == 10
+
+
+def test_batched_commands_go_through_the_policy():
+    port = serial.serial_for_url("loop://")
+    policy = AdaptiveTimeoutPolicy(min_margin=0.1)
+    client = JigClient(port, timeout_policy=policy)
+
+    port.write(b"> hwspec-get serial\r\n+OK\r\nW01\r\n.\r\n> hwspec-get name\r\n+OK\r\nTA3K\r\n.\r\n")
+    assert client.hwspec_get_many(["serial", "name"]) == {"serial": "W01", "name": "TA3K"}
+    assert len(policy.samples("hwspec-get")) == 2
+
+    learn(policy, "hwspec-get", 0.1)
+    port = serial.serial_for_url("loop://")
+    port.write(b"> hwspec-get serial\r\n+OK\r\n")
+    with pytest.raises(JigClient.CommandTimeout, match="in batch"):
+        JigClient(port, timeout_policy=policy, max_attempts=1).hwspec_get_many(["serial", "name"])
+    assert [cut.command for cut in policy.audit] == ["hwspec-get serial"]
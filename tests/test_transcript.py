@@ -0,0 +1,49 @@
+from pulse_jig.lib.jig_client import JigClient
+from pulse_jig.lib.transcript import Transcript
+import serial
+
+
+def test_renders_appended_text_in_order():
+    transcript = Transcript(chunk_size=8)
+    for part in ["SELF_TEST\r", "> SELF_TEST\r\n", "+OK\r\n", "é\r\n", ".\r\n"]:
+        transcript.append(part)
+    assert transcript.render() == "SELF_TEST\r> SELF_TEST\r\n+OK\r\né\r\n.\r\n"
+
+
+def test_spills_to_disk_beyond_memory_limit():
+    transcript = Transcript(max_memory=1024, chunk_size=128)
+    lines = [f"port 1 ch {i}: 0.512 PASS\r\n" for i in range(500)]
+    for line in lines:
+        transcript.append(line)
+    assert transcript.spilled > 0
+    assert transcript.render() == "".join(lines)
+    assert transcript.text(len(transcript) - len(lines[-1])) == lines[-1]
+
+
+def test_clear_discards_everything():
+    transcript = Transcript(max_memory=16, chunk_size=4)
+    transcript.append("a" * 64)
+    transcript.begin_command("cmd")
+    transcript.clear()
+    assert transcript.render() == ""
+    assert transcript.spilled == 0
+    assert transcript.records == []
+
+
+def test_jig_client_records_each_command():
+    port = serial.serial_for_url("loop://")
+    port.write(b"> SELF_TEST\r\n+OK\r\ntesting watchdog...OK\r\nPASS\r\n.\r\n")
+    client = JigClient(port)
+    client.send_command("SELF_TEST")
+
+    # loop:// also reads back what the client wrote, after the response
+    assert client.log.startswith("SELF_TEST\r> SELF_TEST\r\n+OK\r\ntesting watchdog...OK\r\nPASS\r\n.\r\n")
+    [record] = client.transcript.records
+    assert record.command == "SELF_TEST"
+    assert record.ack == "+OK"
+    assert record.body_lines == 2
+    assert record.duration >= 0
+    assert "testing watchdog...OK\r\nPASS\r\n" in client.transcript.text(record.offset, record.end_offset)
+
+    client.reset_logs()
+    assert client.log == ""
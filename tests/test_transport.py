@@ -0,0 +1,110 @@
+import os
+import threading
+import time
+import tty
+
+import pytest
+import serial
+
+from pulse_jig.lib.jig_client import JigClient
+from pulse_jig.lib.transport import LoopbackTransport, RawFdTransport, Transport, create_transport
+
+
+def respond(data: bytes) -> bytes:
+    cmd = data.decode().strip()
+    return f"> {cmd}\r\n+OK\r\n1.2.3\r\n.\r\n".encode()
+
+
+@pytest.fixture
+def pty():
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    yield master, os.ttyname(slave)
+    os.close(master)
+    os.close(slave)
+
+
+def test_pyserial_ports_are_transports():
+    assert isinstance(serial.serial_for_url("loop://"), Transport)
+
+
+def test_create_transport_returns_a_closed_transport():
+    port = create_transport("/dev/ttyACM0", "rawfd")
+    assert isinstance(port, RawFdTransport)
+    assert port.port == "/dev/ttyACM0"
+    assert not port.is_open
+    assert isinstance(create_transport("/dev/ttyACM0"), serial.Serial)
+    with pytest.raises(ValueError):
+        create_transport("/dev/ttyACM0", "carrier-pigeon")
+
+
+def test_loopback_reads_back_writes():
+    port = LoopbackTransport()
+    port.write(b"hello")
+    assert port.in_waiting == 5
+    assert port.read(5) == b"hello"
+
+
+def test_loopback_read_times_out_with_partial_data():
+    port = LoopbackTransport()
+    port.timeout = 0.05
+    port.feed(b"ab")
+    assert port.read(3) == b"ab"
+
+
+def test_jig_client_over_loopback():
+    client = JigClient(LoopbackTransport(respond))
+    assert client.firmware_version() == "1.2.3"
+
+
+def test_rawfd_reads_and_writes(pty):
+    master, path = pty
+    port = RawFdTransport(path)
+    port.write(b"ping\r")
+    assert os.read(master, 16) == b"ping\r"
+
+    os.write(master, b"pong\r\n")
+    time.sleep(0.01)
+    assert port.in_waiting == 6
+    port.timeout = 1
+    assert port.read(6) == b"pong\r\n"
+
+
+def test_rawfd_read_times_out_with_partial_data(pty):
+    master, path = pty
+    port = RawFdTransport(path, timeout=0.05)
+    os.write(master, b"ab")
+    start = time.monotonic()
+    assert port.read(3) == b"ab"
+    assert time.monotonic() - start >= 0.05
+
+
+def test_rawfd_reset_input_buffer(pty):
+    master, path = pty
+    port = RawFdTransport(path, timeout=0)
+    os.write(master, b"junk")
+    time.sleep(0.01)
+    port.reset_input_buffer()
+    assert port.read(4) == b""
+
+
+def test_rawfd_open_errors_are_serial_exceptions(tmp_path):
+    port = create_transport(str(tmp_path / "missing"), "rawfd")
+    with pytest.raises(serial.SerialException):
+        port.open()
+    with pytest.raises(serial.SerialException):
+        port.read()
+
+
+def test_jig_client_over_rawfd(pty):
+    master, path = pty
+
+    def device():
+        data = b""
+        while not data.endswith(b"\r"):
+            data += os.read(master, 64)
+        os.write(master, respond(data))
+
+    threading.Thread(target=device, daemon=True).start()
+    client = JigClient(RawFdTransport(path))
+    assert client.firmware_version() == "1.2.3"
@@ -0,0 +1,76 @@
+import pytest
+
+from pulse_jig.lib.emulator import EmulatorConfig, EmulatorTransport, FirmwareEmulator
+from pulse_jig.lib.jig_client import JigClient, abort_on_failure
+from pulse_jig.lib.measurements import Measurements
+from pulse_jig.lib.verbosity import (
+    VERBOSITY_ALWAYS,
+    VERBOSITY_ON_FAILURE,
+    VERBOSITY_QUIET,
+    VerbosityPolicy,
+    with_verbose,
+)
+
+
+def test_with_verbose():
+    assert with_verbose("test-port -v 0x0f 1", False) == "test-port 0x0f 1"
+    assert with_verbose("test-port 0x0f 1", True) == "test-port -v 0x0f 1"
+    assert with_verbose("test-self -v", True) == "test-self -v"
+    with pytest.raises(ValueError):
+        VerbosityPolicy("loud")
+
+
+def _client(policy, **options):
+    config = EmulatorConfig(speed=1000, seed=1, latency={}, **options)
+    port = EmulatorTransport(FirmwareEmulator(config))
+    return JigClient(port, verbosity=policy), port.emulator
+
+
+def test_quiet_after_a_verbose_run_and_verbose_again_on_failure():
+    policy = VerbosityPolicy(VERBOSITY_ON_FAILURE)
+    client, emulator = _client(policy, samples=20)
+    assert client.test_port() and client.test_port()
+    assert emulator.commands == ["test-port -v 0x0f 1", "test-port 0x0f 1"]
+    assert client.verbosity_stats.quiet_runs == 1
+    assert client.verbosity_stats.bytes_saved > 2000
+
+    # A later unit, whose test fails
+    client, emulator = _client(policy, failure_rates={"test-port": 1})
+    measurements = Measurements()
+    assert not client.test_port(measurements=measurements)
+    assert emulator.commands == ["test-port 0x0f 1", "test-port -v 0x0f 1"]
+    assert measurements.failed()
+    assert client.verbosity_stats.reruns == 1
+    assert client.verbosity_stats.bytes_saved < 0
+
+
+def test_the_verbose_rerun_is_not_aborted_early():
+    policy = VerbosityPolicy(VERBOSITY_ON_FAILURE)
+    client, emulator = _client(policy, samples=5)
+    assert client.test_port()
+
+    client, emulator = _client(policy, samples=5, failure_rates={"test-port": 1})
+    lines = []
+    measurements = Measurements()
+    assert not client.test_port(on_line=lines.append, abort_when=abort_on_failure, measurements=measurements)
+    assert emulator.commands == ["test-port 0x0f 1", "test-port -v 0x0f 1"]
+    # The quiet run's verdict, then all of the verbose run up to its own verdict
+    assert lines[0] == "FAIL"
+    assert lines[-2].endswith(" FAIL") and lines[-1] == "FAIL"
+    assert len(lines) > 2
+    assert measurements.failed()
+    assert client.verbosity_stats.seconds_saved < 0
+
+
+def test_always_and_never_verbose():
+    client, emulator = _client(VerbosityPolicy(VERBOSITY_ALWAYS))
+    client.test_self()
+    client.test_self()
+    assert emulator.commands == ["test-self -v"] * 2
+
+    client, emulator = _client(VerbosityPolicy(VERBOSITY_QUIET), failure_rates={"test-self": 1})
+    assert not client.test_self()
+    assert emulator.commands == ["test-self"]
+    # Commands without -v are left alone
+    client.test_lora_connect("1", "eui", "key")
+    assert client.verbosity_stats.quiet_runs == 1